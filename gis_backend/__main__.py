@@ -1,12 +1,31 @@
 from argparse import ArgumentParser
+from pathlib import Path
 
+from ._compiled_graph import compile_graph
+from ._compiled_graph import graph_fingerprint
+from ._compiled_graph import load_compiled_graph
+from ._compiled_graph import save_compiled_graph
+from ._contraction_hierarchy import build_contraction_hierarchy
+from ._contraction_hierarchy import save_contraction_hierarchy
+from ._geocode_cache import GeocodeCache
 from ._osmnx_wrapper import ox
 from ._pickling import save_object
+from ._route_cache import RouteCache
+from ._spatial_index import build_spatial_index
 
 parser = ArgumentParser(description='Fetch OSM map data')
-parser.add_argument('--fetch-place', type=str, required=True)
+parser.add_argument('--fetch-place', type=str)
+parser.add_argument('--build-contraction-hierarchy', action='store_true',
+                    help='Preprocess the graph for fast point-to-point routing')
+parser.add_argument('--import-addresses', type=str, metavar='CSV_FILE',
+                    help='Add a table of address, latitude, longitude to the geocode cache')
 args = parser.parse_args()
 
+if (args.fetch_place is None and not args.build_contraction_hierarchy and
+        args.import_addresses is None):
+    parser.error('Nothing to do: use --fetch-place, --build-contraction-hierarchy and/or '
+                 '--import-addresses.')
+
 # See https://wiki.openstreetmap.org/wiki/Key:highway
 include_highways = [
     'motorway',
@@ -40,19 +59,65 @@ custom_filter = (
     f'["access"!~"{exclude_accesses}"]'
 )
 
-graph = ox.graph_from_place(
-    args.fetch_place,
-    retain_all=True,
-    truncate_by_edge=True,
-    custom_filter=custom_filter,
-    simplify=False
-)
 
-graph = ox.add_edge_speeds(graph)
-graph = ox.add_edge_travel_times(graph)
+def _fetch_place(place):
+    graph = ox.graph_from_place(
+        place,
+        retain_all=True,
+        truncate_by_edge=True,
+        custom_filter=custom_filter,
+        simplify=False
+    )
+
+    graph = ox.add_edge_speeds(graph)
+    graph = ox.add_edge_travel_times(graph)
+
+    nodes, edges = ox.graph_to_gdfs(graph)
+
+    save_object(graph, 'gis_data/graph.pickle')
+    save_object(nodes, 'gis_data/nodes.pickle')
+    save_object(edges, 'gis_data/edges.pickle')
+
+    # Compact CSR form of the graph which the query provider memory-maps at startup
+    compiled_graph = compile_graph(graph)
+    save_compiled_graph(compiled_graph, 'gis_data/compiled_graph')
+    save_object(
+        build_spatial_index(compiled_graph['lat'], compiled_graph['long']),
+        'gis_data/compiled_graph/spatial_index.pickle'
+    )
+
+    # Cached routes are keyed by graph fingerprint. Routes of other graphs can never be hit again.
+    route_cache = RouteCache('gis_data/route_cache.sqlite')
+    route_cache.discard_other_graphs(graph_fingerprint(compiled_graph))
+    route_cache.close()
+
+
+def _build_contraction_hierarchies(compiled_graph):
+    fingerprint = graph_fingerprint(compiled_graph)
+    for metric in ['length', 'travel_time']:
+        hierarchy = build_contraction_hierarchy(
+            compiled_graph['offsets'],
+            compiled_graph['targets'],
+            compiled_graph[metric]
+        )
+        save_contraction_hierarchy(
+            hierarchy,
+            f'gis_data/contraction_hierarchy/{metric}',
+            fingerprint
+        )
+
+
+if args.fetch_place is not None:
+    _fetch_place(args.fetch_place)
 
-nodes, edges = ox.graph_to_gdfs(graph)
+# Builds from the saved graph, either the one just fetched or one fetched by an earlier run
+if args.build_contraction_hierarchy:
+    if not Path('gis_data/compiled_graph/fingerprint.txt').exists():
+        parser.error('No compiled graph in gis_data: use --fetch-place first.')
+    _build_contraction_hierarchies(load_compiled_graph('gis_data/compiled_graph'))
 
-save_object(graph, 'gis_data/graph.pickle')
-save_object(nodes, 'gis_data/nodes.pickle')
-save_object(edges, 'gis_data/edges.pickle')
+if args.import_addresses is not None:
+    geocode_cache = GeocodeCache('gis_data/geocode_cache.sqlite')
+    num_imported = geocode_cache.import_table(args.import_addresses)
+    geocode_cache.close()
+    print(f'Imported {num_imported} addresses into the geocode cache.')
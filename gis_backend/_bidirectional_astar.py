@@ -0,0 +1,85 @@
+from collections.abc import Callable
+from heapq import heappop
+from heapq import heappush
+from math import inf
+
+import scipy.sparse as sparse
+
+
+def bidirectional_astar(forward: sparse.csr_matrix, backward: sparse.csr_matrix,
+                        lower_bound: Callable[[int, int], float],
+                        src: int, dst: int) -> tuple[list[int] | None, int]:
+    """
+    Bidirectional A* with average potentials
+    :param forward: graph whose rows hold the edges leaving each node
+    :param backward: transposed graph whose rows hold the edges entering each node
+    :param lower_bound: admissible and consistent estimate of the distance between two nodes
+    :param src: node index to route from
+    :param dst: node index to route to
+    :return: node indices of the shortest path or None if unreachable, and the number of nodes
+        settled by both searches
+    """
+    if src == dst:
+        return [src], 0
+
+    # Both searches share one potential so that they agree on when they have met. Averaging
+    # the two estimates keeps the reduced edge weights non-negative in both directions.
+    potentials = dict()
+
+    def _potential(_node):
+        if _node not in potentials:
+            potentials[_node] = (lower_bound(_node, dst) - lower_bound(src, _node)) / 2
+        return potentials[_node]
+
+    graphs = (forward, backward)
+    signs = (1, -1)
+    distances = ({src: 0.0}, {dst: 0.0})
+    parents = ({src: -1}, {dst: -1})
+    settled = (set(), set())
+    heaps = ([(_potential(src), src)], [(-_potential(dst), dst)])
+
+    best_distance = inf
+    meeting_node = None
+
+    while heaps[0] and heaps[1]:
+        if heaps[0][0][0] + heaps[1][0][0] >= best_distance:
+            break
+
+        # Expand the side with the smaller frontier key
+        direction = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+        _, x = heappop(heaps[direction])
+        if x in settled[direction]:
+            continue
+        settled[direction].add(x)
+
+        graph = graphs[direction]
+        start, end = graph.indptr[x], graph.indptr[x + 1]
+        distance = distances[direction][x]
+        for y, weight in zip(graph.indices[start:end].tolist(), graph.data[start:end].tolist()):
+            new_distance = distance + weight
+            if new_distance < distances[direction].get(y, inf):
+                distances[direction][y] = new_distance
+                parents[direction][y] = x
+                heappush(
+                    heaps[direction],
+                    (new_distance + signs[direction] * _potential(y), y)
+                )
+
+                opposite_distance = distances[1 - direction].get(y)
+                if opposite_distance is not None and \
+                        new_distance + opposite_distance < best_distance:
+                    best_distance = new_distance + opposite_distance
+                    meeting_node = y
+
+    num_settled = len(settled[0]) + len(settled[1])
+    if meeting_node is None:
+        return None, num_settled
+
+    path = [meeting_node]
+    while parents[0][path[-1]] >= 0:
+        path.append(parents[0][path[-1]])
+    path.reverse()
+    while parents[1][path[-1]] >= 0:
+        path.append(parents[1][path[-1]])
+
+    return path, num_settled
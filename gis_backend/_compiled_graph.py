@@ -0,0 +1,331 @@
+import hashlib
+import math
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import dijkstra
+
+from ._bidirectional_astar import bidirectional_astar
+from ._pickling import load_object
+
+# Arrays making up a compiled graph. Each array is saved as its own .npy file so that it can be
+# memory-mapped read-only, letting processes on the same machine share the pages.
+#
+# node_ids:     OSM id of each node, sorted ascending. The position of an id is its node index.
+# lat, long:    Coordinates of each node.
+# offsets:      CSR row pointers. Edges leaving node i are offsets[i]:offsets[i + 1].
+# targets:      CSR column indices. The node index at the head of each edge.
+# length:       Length of each edge in meters.
+# travel_time:  Travel time of each edge in seconds.
+_array_dtypes = {
+    'node_ids': np.int64,
+    'lat': np.float64,
+    'long': np.float64,
+    'offsets': np.int32,
+    'targets': np.int32,
+    'length': np.float32,
+    'travel_time': np.float32,
+}
+
+_metrics = ['length', 'travel_time']
+
+_earth_radius_meters = 6371009
+
+
+def compile_graph(graph) -> dict[str, np.ndarray]:
+    node_ids = np.array(sorted(graph.nodes), dtype=np.int64)
+    index_of_node = {node: index for index, node in enumerate(node_ids.tolist())}
+
+    lat = np.array([graph.nodes[node]['y'] for node in node_ids.tolist()])
+    long = np.array([graph.nodes[node]['x'] for node in node_ids.tolist()])
+
+    # Parallel edges are collapsed into one edge. Each metric keeps its own minimum, which is
+    # the edge osmnx picks when it turns a node path into a route.
+    weights: dict[tuple[int, int], list[float]] = dict()
+    for u, v, data in graph.edges(data=True):
+        if u == v:
+            continue
+        edge = index_of_node[u], index_of_node[v]
+        metric_values = [data[metric] for metric in _metrics]
+        if edge in weights:
+            weights[edge] = [min(pair) for pair in zip(weights[edge], metric_values)]
+        else:
+            weights[edge] = metric_values
+
+    edges = sorted(weights)
+    sources = np.array([u for u, _ in edges], dtype=np.int32)
+    targets = np.array([v for _, v in edges], dtype=np.int32)
+
+    offsets = np.zeros(len(node_ids) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=len(node_ids)), out=offsets[1:])
+
+    compiled = {
+        'node_ids': node_ids,
+        'lat': lat,
+        'long': long,
+        'offsets': offsets,
+        'targets': targets,
+    }
+    for column, metric in enumerate(_metrics):
+        compiled[metric] = np.array([weights[edge][column] for edge in edges])
+
+    return {
+        name: np.ascontiguousarray(array, dtype=_array_dtypes[name])
+        for name, array in compiled.items()
+    }
+
+
+def graph_fingerprint(compiled: dict[str, np.ndarray]) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for name in _array_dtypes:
+        digest.update(np.ascontiguousarray(compiled[name]).tobytes())
+    return digest.hexdigest()
+
+
+def save_compiled_graph(compiled: dict[str, np.ndarray], folder):
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    for name in _array_dtypes:
+        np.save(folder / f'{name}.npy', compiled[name])
+
+    # Identifies the graph version for results derived from it, such as cached routes
+    (folder / 'fingerprint.txt').write_text(graph_fingerprint(compiled))
+
+
+def load_compiled_graph(folder) -> dict[str, np.ndarray]:
+    folder = Path(folder)
+    return {
+        name: np.load(folder / f'{name}.npy', mmap_mode='r')
+        for name in _array_dtypes
+    }
+
+
+def _seconds_to_hours(sec):
+    return sec / 60 / 60
+
+
+@dataclass
+class Route:
+    path: list
+    length: float
+    duration_hours: float
+
+    def metric(self, metric='length') -> float:
+        assert metric in _metrics
+        return self.duration_hours if metric == 'travel_time' else self.length
+
+
+class _LazyArrays:
+    def __init__(self, folder):
+        self._folder = Path(folder)
+        self._arrays: dict[str, np.ndarray] = dict()
+
+    def __getitem__(self, name) -> np.ndarray:
+        if name not in self._arrays:
+            self._arrays[name] = np.load(self._folder / f'{name}.npy', mmap_mode='r')
+        return self._arrays[name]
+
+
+class CompiledGraph:
+    def __init__(self, folder):
+        self._folder = Path(folder)
+
+        # Arrays are memory-mapped the first time a query needs them
+        self._arrays = _LazyArrays(folder)
+
+        # scipy works on float64 weights. The converted matrices are built once per metric and
+        # kept for the lifetime of the graph.
+        self._csgraphs: dict[str, sparse.csr_matrix] = dict()
+
+        # Sorted (source * num_nodes + target) key of every edge, for vectorized edge lookup
+        self._edge_keys: np.ndarray | None = None
+
+        # Fastest speed on any edge in meters per second, bounding travel time from distance
+        self._max_speed: float | None = None
+
+        # KD-tree over node coordinates for snapping coordinates to nodes
+        self._spatial_index = None
+
+    @property
+    def fingerprint(self) -> str:
+        return (self._folder / 'fingerprint.txt').read_text().strip()
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self._arrays['node_ids'])
+
+    def index_of_node(self, node) -> int:
+        node_ids = self._arrays['node_ids']
+        index = int(np.searchsorted(node_ids, node))
+        if index >= len(node_ids) or node_ids[index] != node:
+            raise KeyError(f'Node {node} is not in the compiled graph.')
+        return index
+
+    def node_of_index(self, index: int):
+        return int(self._arrays['node_ids'][index])
+
+    def coord_of_node(self, node) -> tuple[float, float]:
+        index = self.index_of_node(node)
+        return float(self._arrays['lat'][index]), float(self._arrays['long'][index])
+
+    def nearest_nodes(self, lats, longs) -> list:
+        # scikit-learn is slow to import and only needed for snapping
+        from ._spatial_index import build_spatial_index
+        from ._spatial_index import query_nearest
+
+        if self._spatial_index is None:
+            index_file = self._folder / 'spatial_index.pickle'
+            if index_file.exists():
+                self._spatial_index = load_object(index_file)
+            else:
+                self._spatial_index = build_spatial_index(
+                    self._arrays['lat'], self._arrays['long'])
+
+        nearest = query_nearest(self._spatial_index, lats, longs)
+        return self._arrays['node_ids'][nearest].tolist()
+
+    def nearest_node(self, lat, long):
+        return self.nearest_nodes([lat], [long])[0]
+
+    def _edge_positions(self, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        if self._edge_keys is None:
+            offsets = np.asarray(self._arrays['offsets'])
+            edge_sources = np.repeat(np.arange(self.num_nodes, dtype=np.int64), np.diff(offsets))
+            self._edge_keys = edge_sources * self.num_nodes + self._arrays['targets']
+
+        keys = sources.astype(np.int64) * self.num_nodes + targets
+        positions = np.searchsorted(self._edge_keys, keys)
+        if np.any(positions >= len(self._edge_keys)) or np.any(self._edge_keys[positions] != keys):
+            raise KeyError('Path contains a pair of nodes not joined by an edge.')
+        return positions
+
+    def route_of_indices(self, indices: list[int]) -> Route:
+        indices = np.asarray(indices, dtype=np.int64)
+        positions = self._edge_positions(indices[:-1], indices[1:])
+        return Route(
+            path=self._arrays['node_ids'][indices].tolist(),
+            length=float(np.sum(self._arrays['length'][positions], dtype=np.float64)),
+            duration_hours=_seconds_to_hours(
+                float(np.sum(self._arrays['travel_time'][positions], dtype=np.float64))),
+        )
+
+    def csgraph(self, metric: str, reverse=False) -> sparse.csr_matrix:
+        assert metric in _metrics
+
+        key = metric, reverse
+        if key not in self._csgraphs:
+            if reverse:
+                graph = self.csgraph(metric).transpose().tocsr()
+            else:
+                graph = sparse.csr_matrix(
+                    (
+                        np.asarray(self._arrays[metric], dtype=np.float64),
+                        self._arrays['targets'],
+                        self._arrays['offsets'],
+                    ),
+                    shape=(self.num_nodes, self.num_nodes)
+                )
+            self._csgraphs[key] = graph
+        return self._csgraphs[key]
+
+    def _shortest_path_tree(self, root: int, metric: str, reverse: bool) -> np.ndarray:
+        # A reverse tree is searched over the transposed graph. Its predecessors point one hop
+        # closer to the root along the original edge directions.
+        _, predecessors = dijkstra(
+            self.csgraph(metric, reverse=reverse), indices=root, return_predecessors=True)
+        return predecessors
+
+    @staticmethod
+    def _unwind(predecessors: np.ndarray, root: int, leaf: int) -> list[int] | None:
+        if leaf != root and predecessors[leaf] < 0:
+            return None
+
+        path = [leaf]
+        while path[-1] != root:
+            path.append(int(predecessors[path[-1]]))
+        return path
+
+    def shortest_routes_from(self, src_node, dst_nodes, metric='length') -> dict:
+        src = self.index_of_node(src_node)
+        predecessors = self._shortest_path_tree(src, metric, reverse=False)
+
+        routes = dict()
+        for dst_node in dst_nodes:
+            path = self._unwind(predecessors, src, self.index_of_node(dst_node))
+            routes[dst_node] = None if path is None else self.route_of_indices(path[::-1])
+        return routes
+
+    def shortest_routes_to(self, dst_node, src_nodes, metric='length') -> dict:
+        dst = self.index_of_node(dst_node)
+        predecessors = self._shortest_path_tree(dst, metric, reverse=True)
+
+        routes = dict()
+        for src_node in src_nodes:
+            path = self._unwind(predecessors, dst, self.index_of_node(src_node))
+            routes[src_node] = None if path is None else self.route_of_indices(path)
+        return routes
+
+    def shortest_route(self, src_node, dst_node, metric='length') -> Route | None:
+        return self.shortest_routes_from(src_node, [dst_node], metric=metric)[dst_node]
+
+    def _great_circle_meters(self, u: int, v: int) -> float:
+        lat, long = self._arrays['lat'], self._arrays['long']
+        lat1, long1 = math.radians(lat[u]), math.radians(long[u])
+        lat2, long2 = math.radians(lat[v]), math.radians(long[v])
+        a = (
+                math.sin((lat2 - lat1) / 2) ** 2 +
+                math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2
+        )
+        return 2 * _earth_radius_meters * math.asin(min(1.0, math.sqrt(a)))
+
+    def _lower_bound_scale(self, metric: str) -> float:
+        # Edge lengths are great-circle distances between their end nodes, stored as float32.
+        # The bound is shrunk slightly so that rounding can never make it overestimate.
+        slack = 1 - 1e-6
+
+        if metric == 'length':
+            return slack
+
+        if self._max_speed is None:
+            length = np.asarray(self._arrays['length'], dtype=np.float64)
+            travel_time = np.asarray(self._arrays['travel_time'], dtype=np.float64)
+            moving = travel_time > 0
+            self._max_speed = float(np.max(length[moving] / travel_time[moving]))
+        return slack / self._max_speed
+
+    def duration_lower_bounds(self, src_nodes, dst_nodes) -> np.ndarray:
+        """
+        Bounds the travel time between nodes from below without searching the graph
+        :param src_nodes: nodes to travel from
+        :param dst_nodes: nodes to travel to
+        :return: matrix of hours by source and destination node
+        """
+        src = np.array([self.index_of_node(node) for node in src_nodes], dtype=np.int64)
+        dst = np.array([self.index_of_node(node) for node in dst_nodes], dtype=np.int64)
+
+        lat = np.radians(np.asarray(self._arrays['lat']))
+        long = np.radians(np.asarray(self._arrays['long']))
+        lat1, long1 = lat[src][:, None], long[src][:, None]
+        lat2, long2 = lat[dst][None, :], long[dst][None, :]
+        a = (
+                np.sin((lat2 - lat1) / 2) ** 2 +
+                np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2) ** 2
+        )
+        meters = 2 * _earth_radius_meters * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+        return _seconds_to_hours(self._lower_bound_scale('travel_time') * meters)
+
+    def shortest_route_astar(self, src_node, dst_node, metric='length') -> Route | None:
+        scale = self._lower_bound_scale(metric)
+        path, _ = bidirectional_astar(
+            self.csgraph(metric),
+            self.csgraph(metric, reverse=True),
+            lambda _u, _v: scale * self._great_circle_meters(_u, _v),
+            self.index_of_node(src_node),
+            self.index_of_node(dst_node),
+        )
+        return None if path is None else self.route_of_indices(path)
+
+    def route_of_path(self, path) -> Route:
+        return self.route_of_indices([self.index_of_node(node) for node in path])
@@ -0,0 +1,314 @@
+from heapq import heappop
+from heapq import heappush
+from math import inf
+from pathlib import Path
+
+import numpy as np
+
+# Arrays making up a contraction hierarchy over the node indices of a compiled graph.
+#
+# rank:             Contraction order of each node. Searches only move towards higher ranks.
+# up_offsets:       CSR row pointers into up_edges.
+# up_edges:         Edges leaving each node towards a higher rank, used by forward searches.
+# down_offsets:     CSR row pointers into down_edges.
+# down_edges:       Edges entering each node from a higher rank, used by backward searches.
+# edge_tail:        Node index at the tail of each edge.
+# edge_head:        Node index at the head of each edge.
+# edge_weight:      Weight of each edge.
+# edge_child_a:     First half of a shortcut, or -1 for an edge of the compiled graph.
+# edge_child_b:     Second half of a shortcut, or -1 for an edge of the compiled graph.
+_array_dtypes = {
+    'rank': np.int32,
+    'up_offsets': np.int64,
+    'up_edges': np.int64,
+    'down_offsets': np.int64,
+    'down_edges': np.int64,
+    'edge_tail': np.int32,
+    'edge_head': np.int32,
+    'edge_weight': np.float64,
+    'edge_child_a': np.int64,
+    'edge_child_b': np.int64,
+}
+
+
+def _to_csr(adjacency: list[list[int]]) -> tuple[np.ndarray, np.ndarray]:
+    offsets = np.zeros(len(adjacency) + 1, dtype=np.int64)
+    np.cumsum([len(edges) for edges in adjacency], out=offsets[1:])
+    edges = np.fromiter(
+        (edge for node_edges in adjacency for edge in node_edges),
+        dtype=np.int64, count=offsets[-1]
+    )
+    return offsets, edges
+
+
+def build_contraction_hierarchy(offsets: np.ndarray, targets: np.ndarray, weights: np.ndarray,
+                                witness_settle_limit=64) -> dict[str, np.ndarray]:
+    num_nodes = len(offsets) - 1
+    offsets = offsets.tolist()
+    targets = targets.tolist()
+    weights = np.asarray(weights, dtype=np.float64).tolist()
+
+    edge_tail = list()
+    edge_head = list()
+    edge_weight = list()
+    edge_child_a = list()
+    edge_child_b = list()
+
+    # Edges between nodes not yet contracted, keyed by the node at the other end
+    out_edges: list[dict[int, int]] = [dict() for _ in range(num_nodes)]
+    in_edges: list[dict[int, int]] = [dict() for _ in range(num_nodes)]
+
+    def _add_edge(_tail, _head, _weight, _child_a=-1, _child_b=-1):
+        existing = out_edges[_tail].get(_head)
+        if existing is not None and edge_weight[existing] <= _weight:
+            return
+
+        edge = len(edge_tail)
+        edge_tail.append(_tail)
+        edge_head.append(_head)
+        edge_weight.append(_weight)
+        edge_child_a.append(_child_a)
+        edge_child_b.append(_child_b)
+        out_edges[_tail][_head] = edge
+        in_edges[_head][_tail] = edge
+
+    for u in range(num_nodes):
+        for position in range(offsets[u], offsets[u + 1]):
+            _add_edge(u, targets[position], weights[position])
+
+    def _witness_distances(_source, _excluded, _max_distance, _targets):
+        # A bounded local search. Stopping early only costs extra shortcuts, never correctness.
+        distances = {_source: 0.0}
+        heap = [(0.0, _source)]
+        num_settled = 0
+        targets_left = len(_targets)
+        while heap and num_settled < witness_settle_limit:
+            distance, x = heappop(heap)
+            if distance > distances[x]:
+                continue
+            if distance > _max_distance:
+                break
+            if x in _targets:
+                targets_left -= 1
+                if targets_left == 0:
+                    break
+            num_settled += 1
+            for y, edge in out_edges[x].items():
+                if y == _excluded:
+                    continue
+                new_distance = distance + edge_weight[edge]
+                if new_distance < distances.get(y, inf):
+                    distances[y] = new_distance
+                    heappush(heap, (new_distance, y))
+        return distances
+
+    def _shortcuts_for(_node):
+        shortcuts = list()
+        if not out_edges[_node]:
+            return shortcuts
+
+        max_out_weight = max(edge_weight[edge] for edge in out_edges[_node].values())
+        for u, edge_uv in in_edges[_node].items():
+            via_weight = edge_weight[edge_uv]
+            witnesses = _witness_distances(
+                u, _node, via_weight + max_out_weight, out_edges[_node].keys() - {u})
+            for w, edge_vw in out_edges[_node].items():
+                if w == u:
+                    continue
+                shortcut_weight = via_weight + edge_weight[edge_vw]
+                if witnesses.get(w, inf) > shortcut_weight:
+                    shortcuts.append((u, w, shortcut_weight, edge_uv, edge_vw))
+        return shortcuts
+
+    num_contracted_neighbors = [0] * num_nodes
+
+    def _priority(_node):
+        # Edge difference plus the number of contracted neighbors keeps the hierarchy shallow
+        num_edges = len(out_edges[_node]) + len(in_edges[_node])
+        return (
+                len(_shortcuts_for(_node)) - num_edges +
+                num_contracted_neighbors[_node]
+        )
+
+    queue = [(_priority(node), node) for node in range(num_nodes)]
+    queue.sort()
+
+    rank = [0] * num_nodes
+    up_adjacency: list[list[int]] = [list() for _ in range(num_nodes)]
+    down_adjacency: list[list[int]] = [list() for _ in range(num_nodes)]
+
+    next_rank = 0
+    while queue:
+        _, node = heappop(queue)
+
+        # Priorities go stale as neighbors get contracted, so they are refreshed lazily
+        priority = _priority(node)
+        if queue and priority > queue[0][0]:
+            heappush(queue, (priority, node))
+            continue
+
+        for u, w, shortcut_weight, edge_uv, edge_vw in _shortcuts_for(node):
+            _add_edge(u, w, shortcut_weight, edge_uv, edge_vw)
+
+        # Every neighbor left is contracted later, so these edges all lead up the hierarchy
+        up_adjacency[node] = list(out_edges[node].values())
+        down_adjacency[node] = list(in_edges[node].values())
+
+        for w in out_edges[node]:
+            del in_edges[w][node]
+            num_contracted_neighbors[w] += 1
+        for u in in_edges[node]:
+            del out_edges[u][node]
+            num_contracted_neighbors[u] += 1
+        out_edges[node] = dict()
+        in_edges[node] = dict()
+
+        rank[node] = next_rank
+        next_rank += 1
+
+    up_offsets, up_edges = _to_csr(up_adjacency)
+    down_offsets, down_edges = _to_csr(down_adjacency)
+
+    hierarchy = {
+        'rank': rank,
+        'up_offsets': up_offsets,
+        'up_edges': up_edges,
+        'down_offsets': down_offsets,
+        'down_edges': down_edges,
+        'edge_tail': edge_tail,
+        'edge_head': edge_head,
+        'edge_weight': edge_weight,
+        'edge_child_a': edge_child_a,
+        'edge_child_b': edge_child_b,
+    }
+    return {
+        name: np.asarray(array, dtype=_array_dtypes[name])
+        for name, array in hierarchy.items()
+    }
+
+
+def save_contraction_hierarchy(hierarchy: dict[str, np.ndarray], folder, graph_fingerprint: str):
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    for name in _array_dtypes:
+        np.save(folder / f'{name}.npy', hierarchy[name])
+
+    # A hierarchy is only valid for the exact graph it was built from
+    (folder / 'fingerprint.txt').write_text(graph_fingerprint)
+
+
+class ContractionHierarchy:
+    def __init__(self, folder):
+        self._folder = Path(folder)
+        self._loaded = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        arrays = {
+            name: np.load(self._folder / f'{name}.npy', mmap_mode='r')
+            for name in _array_dtypes
+        }
+
+        # Queries touch few nodes but many Python-level lookups, which are much faster on lists.
+        # The lists hold a private copy of the whole hierarchy, several times the size of the
+        # arrays on disk, in every process that queries it. They are built on the first query
+        # so that processes which never route, or route with other algorithms, do not pay it.
+        self._up_offsets = arrays['up_offsets'].tolist()
+        self._up_edges = arrays['up_edges'].tolist()
+        self._down_offsets = arrays['down_offsets'].tolist()
+        self._down_edges = arrays['down_edges'].tolist()
+        self._edge_tail = arrays['edge_tail'].tolist()
+        self._edge_head = arrays['edge_head'].tolist()
+        self._edge_weight = arrays['edge_weight'].tolist()
+        self._edge_child_a = arrays['edge_child_a'].tolist()
+        self._edge_child_b = arrays['edge_child_b'].tolist()
+        self._loaded = True
+
+    @staticmethod
+    def exists(folder, graph_fingerprint: str) -> bool:
+        fingerprint_file = Path(folder) / 'fingerprint.txt'
+        return (
+                fingerprint_file.exists() and
+                fingerprint_file.read_text().strip() == graph_fingerprint
+        )
+
+    def _unpack(self, edges: list[int]) -> list[int]:
+        heads = list()
+        stack = list(reversed(edges))
+        while stack:
+            edge = stack.pop()
+            if self._edge_child_a[edge] < 0:
+                heads.append(self._edge_head[edge])
+            else:
+                stack.append(self._edge_child_b[edge])
+                stack.append(self._edge_child_a[edge])
+        return heads
+
+    def shortest_path(self, src: int, dst: int) -> list[int] | None:
+        if src == dst:
+            return [src]
+
+        self._load()
+
+        # Forward search climbs from src over up edges, backward search climbs from dst over
+        # down edges. The shortest path goes up and then down, meeting at its highest node.
+        distances = ({src: 0.0}, {dst: 0.0})
+        parent_edges = (dict(), dict())
+        heaps = ([(0.0, src)], [(0.0, dst)])
+        adjacency = (
+            (self._up_offsets, self._up_edges, self._edge_head),
+            (self._down_offsets, self._down_edges, self._edge_tail),
+        )
+
+        best_distance = inf
+        meeting_node = None
+        direction = 0
+        while heaps[0] or heaps[1]:
+            if not heaps[direction]:
+                direction = 1 - direction
+
+            heap = heaps[direction]
+            distance, x = heappop(heap)
+            if distance > distances[direction][x]:
+                continue
+
+            if distance >= best_distance:
+                heap.clear()
+                continue
+
+            opposite_distance = distances[1 - direction].get(x)
+            if opposite_distance is not None and distance + opposite_distance < best_distance:
+                best_distance = distance + opposite_distance
+                meeting_node = x
+
+            offsets, edges, far_end = adjacency[direction]
+            for edge in edges[offsets[x]:offsets[x + 1]]:
+                y = far_end[edge]
+                new_distance = distance + self._edge_weight[edge]
+                if new_distance < distances[direction].get(y, inf):
+                    distances[direction][y] = new_distance
+                    parent_edges[direction][y] = edge
+                    heappush(heap, (new_distance, y))
+
+            direction = 1 - direction
+
+        if meeting_node is None:
+            return None
+
+        up_path = list()
+        x = meeting_node
+        while x != src:
+            edge = parent_edges[0][x]
+            up_path.append(edge)
+            x = self._edge_tail[edge]
+        up_path.reverse()
+
+        down_path = list()
+        x = meeting_node
+        while x != dst:
+            edge = parent_edges[1][x]
+            down_path.append(edge)
+            x = self._edge_head[edge]
+
+        return [src] + self._unpack(up_path + down_path)
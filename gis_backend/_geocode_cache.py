@@ -0,0 +1,63 @@
+import csv
+import sqlite3
+from collections.abc import Iterable
+
+
+def normalize_address(address: str) -> str:
+    return ' '.join(address.split()).casefold()
+
+
+class GeocodeCache:
+    def __init__(self, filename):
+        self._connection = sqlite3.connect(filename)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS addresses ('
+            'address TEXT PRIMARY KEY, lat REAL, long REAL) WITHOUT ROWID'
+        )
+        self._connection.commit()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def get_coords(self, addresses: Iterable[str]) -> dict[str, tuple[float, float]]:
+        # Keys of the result are the addresses as given, looked up by their normalized form.
+        # Every spelling of an address gets its coordinates.
+        keys: dict[str, list[str]] = dict()
+        for address in addresses:
+            keys.setdefault(normalize_address(address), list()).append(address)
+
+        cursor = self._connection.cursor()
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (address TEXT)')
+        cursor.execute('DELETE FROM wanted')
+        cursor.executemany('INSERT INTO wanted VALUES (?)', ((key,) for key in keys))
+        rows = cursor.execute(
+            'SELECT addresses.address, lat, long '
+            'FROM wanted JOIN addresses ON addresses.address = wanted.address'
+        ).fetchall()
+        cursor.execute('DELETE FROM wanted')
+
+        return {
+            address: (lat, long)
+            for key, lat, long in rows
+            for address in keys[key]
+        }
+
+    def put_coords(self, coords: dict[str, tuple[float, float]]) -> None:
+        self._connection.executemany(
+            'INSERT OR REPLACE INTO addresses VALUES (?, ?, ?)',
+            (
+                (normalize_address(address), lat, long)
+                for address, (lat, long) in coords.items()
+            )
+        )
+        self._connection.commit()
+
+    def import_table(self, filename) -> int:
+        # CSV file with the columns address, latitude and longitude
+        with open(filename, 'r', newline='') as file:
+            coords = {
+                row['address']: (float(row['latitude']), float(row['longitude']))
+                for row in csv.DictReader(file)
+            }
+        self.put_coords(coords)
+        return len(coords)
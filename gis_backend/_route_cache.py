@@ -0,0 +1,75 @@
+import sqlite3
+import zlib
+from collections.abc import Iterable
+
+import numpy as np
+
+from ._compiled_graph import Route
+
+
+def _compress_path(path: list) -> bytes:
+    # Consecutive OSM ids along a path tend to be close, so their deltas compress well
+    nodes = np.asarray(path, dtype=np.int64)
+    return zlib.compress(np.diff(nodes, prepend=0).tobytes())
+
+
+def _decompress_path(blob: bytes) -> list:
+    deltas = np.frombuffer(zlib.decompress(blob), dtype=np.int64)
+    return np.cumsum(deltas).tolist()
+
+
+class RouteCache:
+    def __init__(self, filename):
+        self._connection = sqlite3.connect(filename)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS routes ('
+            'fingerprint TEXT, metric TEXT, src INTEGER, dst INTEGER, '
+            'length REAL, duration_hours REAL, geometry BLOB, '
+            'PRIMARY KEY (fingerprint, metric, src, dst)) WITHOUT ROWID'
+        )
+        self._connection.commit()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def get_routes(self, fingerprint: str, pairs: Iterable[tuple[int, int]],
+                   metric: str) -> dict[tuple[int, int], Route]:
+        # The requested pairs are joined against the cache in one query
+        cursor = self._connection.cursor()
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (src INTEGER, dst INTEGER)')
+        cursor.execute('DELETE FROM wanted')
+        cursor.executemany('INSERT INTO wanted VALUES (?, ?)', pairs)
+        rows = cursor.execute(
+            'SELECT routes.src, routes.dst, length, duration_hours, geometry '
+            'FROM wanted JOIN routes ON routes.src = wanted.src AND routes.dst = wanted.dst '
+            'WHERE fingerprint = ? AND metric = ?',
+            (fingerprint, metric)
+        ).fetchall()
+        cursor.execute('DELETE FROM wanted')
+
+        return {
+            (src, dst): Route(
+                path=_decompress_path(geometry),
+                length=length,
+                duration_hours=duration_hours
+            )
+            for src, dst, length, duration_hours, geometry in rows
+        }
+
+    def put_routes(self, fingerprint: str, routes: dict[tuple[int, int], Route],
+                   metric: str) -> None:
+        self._connection.executemany(
+            'INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (
+                (fingerprint, metric, src, dst,
+                 route.length, route.duration_hours, _compress_path(route.path))
+                for (src, dst), route in routes.items()
+                if route is not None
+            )
+        )
+        self._connection.commit()
+
+    def discard_other_graphs(self, fingerprint: str) -> None:
+        self._connection.execute('DELETE FROM routes WHERE fingerprint != ?', (fingerprint,))
+        self._connection.commit()
+        self._connection.execute('VACUUM')
@@ -0,0 +1,23 @@
+import numpy as np
+from sklearn.neighbors import KDTree
+
+
+def _unit_vectors(lats, longs) -> np.ndarray:
+    # Straight-line distance between points on the unit sphere grows with their great-circle
+    # distance, so a Euclidean KD-tree over these vectors finds the great-circle nearest node.
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    longs = np.radians(np.asarray(longs, dtype=np.float64))
+    return np.column_stack([
+        np.cos(lats) * np.cos(longs),
+        np.cos(lats) * np.sin(longs),
+        np.sin(lats),
+    ])
+
+
+def build_spatial_index(lats, longs) -> KDTree:
+    return KDTree(_unit_vectors(lats, longs))
+
+
+def query_nearest(index: KDTree, lats, longs) -> np.ndarray:
+    _, nearest = index.query(_unit_vectors(lats, longs), k=1)
+    return nearest[:, 0]
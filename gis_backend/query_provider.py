@@ -1,40 +1,218 @@
-import osmnx.routing as ox_routing
+from pathlib import Path
 
-from ._osmnx_wrapper import ox
-from ._pickling import load_object
+from ._compiled_graph import CompiledGraph
+from ._compiled_graph import Route
+from ._contraction_hierarchy import ContractionHierarchy
+from ._geocode_cache import GeocodeCache
+from ._geocode_cache import normalize_address
+from ._route_cache import RouteCache
 
-_graph = load_object('gis_data/graph.pickle')
-_nodes = load_object('gis_data/nodes.pickle')
-_edges = load_object('gis_data/edges.pickle')
 
+class GraphQueryProvider:
+    def __init__(self, folder='gis_data'):
+        self._folder = Path(folder)
+        self._graph: CompiledGraph | None = None
+        self._route_cache: RouteCache | None = None
+        self._geocode_cache: GeocodeCache | None = None
+        self._hierarchies: dict[str, ContractionHierarchy | None] = dict()
 
-def _seconds_to_hours(sec):
-    return sec / 60 / 60
+    @property
+    def folder(self) -> Path:
+        return self._folder
+
+    @property
+    def graph(self) -> CompiledGraph:
+        if self._graph is None:
+            self._graph = CompiledGraph(self._folder / 'compiled_graph')
+        return self._graph
+
+    @property
+    def route_cache(self) -> RouteCache:
+        if self._route_cache is None:
+            self._route_cache = RouteCache(self._folder / 'route_cache.sqlite')
+        return self._route_cache
+
+    def contraction_hierarchy(self, metric='length') -> ContractionHierarchy | None:
+        if metric not in self._hierarchies:
+            folder = self._folder / 'contraction_hierarchy' / metric
+            self._hierarchies[metric] = (
+                ContractionHierarchy(folder)
+                if ContractionHierarchy.exists(folder, self.graph.fingerprint) else None
+            )
+        return self._hierarchies[metric]
+
+    @property
+    def geocode_cache(self) -> GeocodeCache:
+        if self._geocode_cache is None:
+            self._geocode_cache = GeocodeCache(self._folder / 'geocode_cache.sqlite')
+        return self._geocode_cache
+
+    def release(self) -> None:
+        self._graph = None
+        self._hierarchies = dict()
+        if self._route_cache is not None:
+            self._route_cache.close()
+            self._route_cache = None
+        if self._geocode_cache is not None:
+            self._geocode_cache.close()
+            self._geocode_cache = None
+
+    def get_node_near_coord(self, lat, long):
+        return self.graph.nearest_node(lat=lat, long=long)
+
+    def get_nodes_near_coords(self, lats, longs) -> list:
+        return self.graph.nearest_nodes(lats=lats, longs=longs)
+
+    def geocode_addresses(self, addresses) -> dict[str, tuple[float, float]]:
+        addresses = set(addresses)
+        coords = self.geocode_cache.get_coords(addresses)
+
+        missing_addresses = sorted(addresses - coords.keys())
+        if missing_addresses:
+            # osmnx is slow to import and only needed when the cache misses
+            from ._osmnx_wrapper import ox
+
+            # Nominatim takes one query per request, so each distinct address is resolved once
+            # and its coordinates shared by all its spellings
+            resolved = dict()
+            for address in missing_addresses:
+                key = normalize_address(address)
+                if key not in resolved:
+                    resolved[key] = ox.geocode(address)
+                coords[address] = resolved[key]
+            self.geocode_cache.put_coords(resolved)
+
+        return coords
+
+    def get_node_near_address(self, address):
+        return self.get_nodes_near_addresses([address])[address]
+
+    def get_nodes_near_addresses(self, addresses) -> dict:
+        coords = self.geocode_addresses(addresses)
+        nodes = self.get_nodes_near_coords(
+            lats=[lat for lat, _ in coords.values()],
+            longs=[long for _, long in coords.values()]
+        )
+        return dict(zip(coords, nodes))
+
+    def get_coord_of_node(self, node):
+        return self.graph.coord_of_node(node)
+
+    def get_shortest_route_between(self, src_node, dst_node, metric='length',
+                                   algorithm=None) -> Route | None:
+        assert algorithm in [None, 'dijkstra', 'astar', 'contraction_hierarchy']
+
+        # By default, use the contraction hierarchy of the metric when one was built
+        if algorithm is None:
+            has_hierarchy = self.contraction_hierarchy(metric) is not None
+            algorithm = 'contraction_hierarchy' if has_hierarchy else 'dijkstra'
+
+        if algorithm == 'dijkstra':
+            return self.graph.shortest_route(src_node, dst_node, metric=metric)
+
+        if algorithm == 'astar':
+            return self.graph.shortest_route_astar(src_node, dst_node, metric=metric)
+
+        hierarchy = self.contraction_hierarchy(metric)
+        if hierarchy is None:
+            raise ValueError(f'No contraction hierarchy was built for metric "{metric}".')
+
+        path = hierarchy.shortest_path(
+            self.graph.index_of_node(src_node), self.graph.index_of_node(dst_node))
+        return None if path is None else self.graph.route_of_indices(path)
+
+    def get_shortest_routes_from(self, src_node, dst_nodes,
+                                 metric='length') -> dict[object, Route | None]:
+        return self.graph.shortest_routes_from(src_node, dst_nodes, metric=metric)
+
+    def get_shortest_routes_to(self, dst_node, src_nodes,
+                               metric='length') -> dict[object, Route | None]:
+        return self.graph.shortest_routes_to(dst_node, src_nodes, metric=metric)
+
+    def get_duration_lower_bounds(self, src_nodes, dst_nodes):
+        return self.graph.duration_lower_bounds(src_nodes, dst_nodes)
+
+    def get_cached_routes(self, pairs, metric='length') -> dict[tuple, Route]:
+        return self.route_cache.get_routes(self.graph.fingerprint, pairs, metric=metric)
+
+    def cache_routes(self, routes: dict[tuple, Route | None], metric='length') -> None:
+        self.route_cache.put_routes(self.graph.fingerprint, routes, metric=metric)
+
+    def get_shortest_path_between(self, src_node, dst_node, metric='length'):
+        route = self.get_shortest_route_between(src_node, dst_node, metric=metric)
+        return None if route is None else route.path
+
+    def get_path_metric(self, path, metric='length'):
+        return self.graph.route_of_path(path).metric(metric)
+
+
+_default_provider: GraphQueryProvider | None = None
+
+
+def get_default_provider() -> GraphQueryProvider:
+    global _default_provider
+    if _default_provider is None:
+        _default_provider = GraphQueryProvider()
+    return _default_provider
+
+
+def set_default_provider(provider: GraphQueryProvider | None) -> None:
+    global _default_provider
+    _default_provider = provider
 
 
 def get_node_near_coord(lat, long):
-    return ox.nearest_nodes(_graph, X=long, Y=lat)
+    return get_default_provider().get_node_near_coord(lat=lat, long=long)
 
 
 def get_node_near_address(address):
-    lat, long = ox.geocode(address)
-    return get_node_near_coord(lat=lat, long=long)
+    return get_default_provider().get_node_near_address(address)
+
+
+def get_nodes_near_coords(lats, longs):
+    return get_default_provider().get_nodes_near_coords(lats=lats, longs=longs)
+
+
+def geocode_addresses(addresses):
+    return get_default_provider().geocode_addresses(addresses)
+
+
+def get_nodes_near_addresses(addresses):
+    return get_default_provider().get_nodes_near_addresses(addresses)
 
 
 def get_coord_of_node(node):
-    point = _nodes['geometry'][node]
-    lat = point.y
-    long = point.x
-    return lat, long
+    return get_default_provider().get_coord_of_node(node)
+
+
+def get_shortest_route_between(src_node, dst_node, metric='length', algorithm=None):
+    return get_default_provider().get_shortest_route_between(
+        src_node, dst_node, metric=metric, algorithm=algorithm)
+
+
+def get_shortest_routes_from(src_node, dst_nodes, metric='length'):
+    return get_default_provider().get_shortest_routes_from(src_node, dst_nodes, metric=metric)
+
+
+def get_shortest_routes_to(dst_node, src_nodes, metric='length'):
+    return get_default_provider().get_shortest_routes_to(dst_node, src_nodes, metric=metric)
+
+
+def get_duration_lower_bounds(src_nodes, dst_nodes):
+    return get_default_provider().get_duration_lower_bounds(src_nodes, dst_nodes)
+
+
+def get_cached_routes(pairs, metric='length'):
+    return get_default_provider().get_cached_routes(pairs, metric=metric)
+
+
+def cache_routes(routes, metric='length'):
+    return get_default_provider().cache_routes(routes, metric=metric)
 
 
 def get_shortest_path_between(src_node, dst_node, metric='length'):
-    return ox_routing.shortest_path(_graph, src_node, dst_node, weight=metric)
+    return get_default_provider().get_shortest_path_between(src_node, dst_node, metric=metric)
 
 
 def get_path_metric(path, metric='length'):
-    assert metric in ['length', 'travel_time']
-
-    gdf = ox_routing.route_to_gdf(_graph, path, weight=metric)
-    result = gdf[metric].sum()
-    return _seconds_to_hours(result) if metric == 'travel_time' else result
+    return get_default_provider().get_path_metric(path, metric=metric)
@@ -1,5 +1,11 @@
 from ._json_io import JSONStorageProvider
 from ._problem_description import VehicleRoutingProblem
 from ._problem_description import VehicleRoutingProblemSolution
+from ._compiled_problem import CompiledProblem
 from ._gurobi_delegate import GurobiTourPlanner
+from ._alns_planner import ALNSTourPlanner
 from ._plotter import plot_solution_to_file
+from ._decomposition_planner import DecompositionTourPlanner
+from ._incremental_planner import IncrementalTourPlanner
+from ._column_generation_planner import ColumnGenerationTourPlanner
+from ._highs_delegate import HiGHSTourPlanner
@@ -0,0 +1,324 @@
+import math
+import time
+
+import numpy as np
+
+from ._compiled_problem import CompiledProblem
+from ._construction import order_interchangeable_routes
+from ._insertion import InsertionSlots
+from ._problem_description import VehicleRoutingProblem
+from ._route_schedule import RouteEvaluator
+from ._solution_values import solution_from_routes
+
+
+class _SearchState:
+    def __init__(self, compiled: CompiledProblem, evaluator: RouteEvaluator,
+                 routes: list[list[int]], unassigned: list[int]):
+        self.routes = routes
+        self.unassigned = unassigned
+        self.route_costs = [evaluator.cost(v, route) for v, route in enumerate(routes)]
+        self.slots = InsertionSlots(compiled, routes)
+
+    def copy_routes(self) -> list[list[int]]:
+        return [list(route) for route in self.routes]
+
+    def cost(self, unassigned_penalty: float) -> float:
+        return sum(self.route_costs) + unassigned_penalty * len(self.unassigned)
+
+
+class ALNSTourPlanner:
+    """
+    Plans tours by adaptive large neighborhood search
+
+    Each iteration removes some waypoints from the current routes and inserts them back. The
+    removal and insertion heuristics are picked at random, favoring the ones that recently led
+    to better routes, and worse routes are accepted by simulated annealing. Routes satisfy the
+    time windows, no-wait scheduling and cargo limits of the Gurobi model, and the search
+    minimizes the cost of trips, dispatches and recalls.
+    """
+
+    def __init__(self, time_limit_seconds: float = 10.0, max_iterations: int | None = None,
+                 max_removals: int = 30, seed: int | None = None):
+        self._time_limit_seconds = time_limit_seconds
+        self._max_iterations = max_iterations
+        self._max_removals = max_removals
+        self._seed = seed
+
+        # Weights of the operators adapt every segment to the scores they earned
+        self._segment_iterations = 100
+        self._reaction = 0.2
+        self._scores = {'best': 10.0, 'improved': 5.0, 'accepted': 2.0}
+
+        # Simulated annealing accepts a route set 5% worse with probability one half at first,
+        # cooling to a thousandth of the initial temperature by the end of the search
+        self._initial_worsening = 0.05
+        self._final_temperature_ratio = 1e-3
+
+        self._removals = [
+            self._random_removal,
+            self._worst_removal,
+            self._related_removal,
+            self._route_removal,
+        ]
+        self._insertions = [
+            self._greedy_insertion,
+            self._regret_insertion,
+        ]
+
+    def solve(self, problem: VehicleRoutingProblem):
+        compiled = CompiledProblem(problem)
+        evaluator = RouteEvaluator(compiled)
+        routes = self.plan_routes(compiled, evaluator=evaluator)
+        return solution_from_routes(compiled, routes, evaluator)
+
+    def plan_routes(self, compiled: CompiledProblem, initial_routes: list[list[int]] | None = None,
+                    evaluator: RouteEvaluator | None = None) -> list[list[int]]:
+        """
+        Searches for low cost routes
+        :param compiled: problem to plan routes for
+        :param initial_routes: feasible routes to start from, or None to construct them
+        :param evaluator: evaluator of the same problem, to share its cached arrays
+        :return: waypoint indices visited by each vehicle
+        """
+        start_time = time.monotonic()
+        if evaluator is None:
+            evaluator = RouteEvaluator(compiled)
+        rng = np.random.default_rng(self._seed)
+
+        if initial_routes is None:
+            routes = [list() for _ in range(compiled.num_vehicles)]
+            unassigned = np.lexsort((compiled.earliest_arrival, compiled.latest_arrival)).tolist()
+        else:
+            routes = [list(route) for route in initial_routes]
+            visited = {j for route in routes for j in route}
+            unassigned = [j for j in range(compiled.num_waypoints) if j not in visited]
+
+        state = _SearchState(compiled, evaluator, routes, list())
+        self._greedy_insertion(state, evaluator, unassigned, rng, randomize=False)
+
+        # Waypoints left out are penalized beyond the cost of any set of routes
+        unassigned_penalty = 2 * (
+                np.sum(compiled.trip_cost) +
+                np.sum(np.max(compiled.dispatch_cost + compiled.recall_cost, axis=0)) + 1
+        )
+
+        current_cost = state.cost(unassigned_penalty)
+        best_routes, best_cost = state.copy_routes(), current_cost
+        best_unassigned = list(state.unassigned)
+
+        initial_temperature = max(
+            -self._initial_worsening * sum(state.route_costs) / math.log(0.5), 1e-9)
+
+        removal_weights = np.ones(len(self._removals))
+        insertion_weights = np.ones(len(self._insertions))
+        removal_scores = np.zeros(len(self._removals))
+        insertion_scores = np.zeros(len(self._insertions))
+        removal_uses = np.zeros(len(self._removals))
+        insertion_uses = np.zeros(len(self._insertions))
+
+        iteration = 0
+        while compiled.num_waypoints > 0:
+            progress = (time.monotonic() - start_time) / self._time_limit_seconds
+            if self._max_iterations is not None:
+                progress = max(progress, iteration / self._max_iterations)
+            if progress >= 1:
+                break
+            iteration += 1
+
+            removal = rng.choice(len(self._removals), p=removal_weights / removal_weights.sum())
+            insertion = rng.choice(
+                len(self._insertions), p=insertion_weights / insertion_weights.sum())
+            removal_uses[removal] += 1
+            insertion_uses[insertion] += 1
+
+            previous_routes = state.copy_routes()
+            previous_costs = list(state.route_costs)
+            previous_unassigned = list(state.unassigned)
+
+            num_removals = int(rng.integers(
+                min(4, compiled.num_waypoints),
+                max(min(self._max_removals, compiled.num_waypoints // 3), 4) + 1
+            ))
+            removed = self._removals[removal](state, evaluator, num_removals, rng)
+            pending = state.unassigned + removed
+            state.unassigned = list()
+            self._insertions[insertion](state, evaluator, pending, rng)
+
+            new_cost = state.cost(unassigned_penalty)
+            temperature = initial_temperature * self._final_temperature_ratio ** progress
+            if new_cost < best_cost - 1e-9:
+                score = self._scores['best']
+            elif new_cost < current_cost - 1e-9:
+                score = self._scores['improved']
+            elif rng.random() < math.exp(-(new_cost - current_cost) / temperature):
+                score = self._scores['accepted']
+            else:
+                score = 0.0
+
+            if score > 0:
+                current_cost = new_cost
+                if new_cost < best_cost - 1e-9:
+                    best_routes, best_cost = state.copy_routes(), new_cost
+                    best_unassigned = list(state.unassigned)
+            else:
+                changed = [
+                    v for v, route in enumerate(previous_routes) if state.routes[v] != route
+                ]
+                state.routes[:] = previous_routes
+                state.route_costs = previous_costs
+                state.unassigned = previous_unassigned
+                state.slots.update(changed)
+
+            removal_scores[removal] += score
+            insertion_scores[insertion] += score
+            if iteration % self._segment_iterations == 0:
+                for weights, scores, uses in (
+                        (removal_weights, removal_scores, removal_uses),
+                        (insertion_weights, insertion_scores, insertion_uses)):
+                    used = uses > 0
+                    weights[used] = (
+                            (1 - self._reaction) * weights[used] +
+                            self._reaction * scores[used] / uses[used]
+                    )
+                    np.maximum(weights, 1e-2, out=weights)
+                    scores[:] = 0
+                    uses[:] = 0
+
+        if best_unassigned:
+            raise RuntimeError(
+                f'Unable to fit {len(best_unassigned)} waypoints into feasible tours.')
+
+        return order_interchangeable_routes(compiled, best_routes)
+
+    @staticmethod
+    def _remove(state: _SearchState, evaluator: RouteEvaluator, v: int, position: int) -> bool:
+        # Vehicles never wait, so taking a waypoint out can shift later arrivals out of their
+        # time windows. Such removals are skipped.
+        route = state.routes[v]
+        remaining = route[:position] + route[position + 1:]
+        if remaining and evaluator.schedule(v, remaining) is None:
+            return False
+
+        state.routes[v] = remaining
+        state.route_costs[v] = evaluator.cost(v, remaining)
+        return True
+
+    def _remove_waypoints(self, state: _SearchState, evaluator: RouteEvaluator,
+                          candidates, num_removals: int) -> list[int]:
+        location = {
+            j: v
+            for v, route in enumerate(state.routes)
+            for j in route
+        }
+        removed = list()
+        for j in candidates:
+            if len(removed) >= num_removals:
+                break
+            v = location.get(j)
+            if v is None:
+                continue
+            if self._remove(state, evaluator, v, state.routes[v].index(j)):
+                removed.append(j)
+
+        state.slots.update({location[j] for j in removed})
+        return removed
+
+    def _random_removal(self, state, evaluator, num_removals, rng) -> list[int]:
+        return self._remove_waypoints(
+            state, evaluator, rng.permutation(state.slots.compiled.num_waypoints).tolist(),
+            num_removals)
+
+    def _worst_removal(self, state, evaluator, num_removals, rng) -> list[int]:
+        compiled = state.slots.compiled
+        savings = np.full(compiled.num_waypoints, -np.inf)
+        for v, route in enumerate(state.routes):
+            for position, j in enumerate(route):
+                remaining = route[:position] + route[position + 1:]
+                savings[j] = state.route_costs[v] - evaluator.cost(v, remaining)
+
+        # Randomized so that repeated calls do not keep removing the same waypoints
+        noise = rng.uniform(0.8, 1.2, compiled.num_waypoints)
+        candidates = np.argsort(-(savings * noise), kind='stable')
+        return self._remove_waypoints(state, evaluator, candidates.tolist(), num_removals)
+
+    def _related_removal(self, state, evaluator, num_removals, rng) -> list[int]:
+        compiled = state.slots.compiled
+        seed_waypoint = int(rng.integers(compiled.num_waypoints))
+
+        # Waypoints cheap to travel between and with close time windows are related
+        trip_cost = state.slots.trip_cost
+        distance = np.minimum(trip_cost[seed_waypoint], trip_cost[:, seed_waypoint])
+        distance[seed_waypoint] = 0
+        finite = np.isfinite(distance)
+        scale = np.max(distance[finite]) if np.any(finite) else 1
+        with np.errstate(invalid='ignore'):
+            window_center = np.where(
+                np.isfinite(compiled.earliest_arrival) & np.isfinite(compiled.latest_arrival),
+                (compiled.earliest_arrival + compiled.latest_arrival) / 2, 0)
+        window_gap = np.abs(window_center - window_center[seed_waypoint])
+        window_scale = np.max(window_gap) if np.max(window_gap) > 0 else 1
+        relatedness = (
+                np.where(finite, distance, 2 * scale) / max(scale, 1e-9) +
+                window_gap / window_scale
+        )
+        candidates = np.argsort(relatedness, kind='stable')
+        return self._remove_waypoints(state, evaluator, candidates.tolist(), num_removals)
+
+    def _route_removal(self, state, evaluator, num_removals, rng) -> list[int]:
+        used = [v for v, route in enumerate(state.routes) if route]
+        if not used:
+            return list()
+
+        v = int(rng.choice(used))
+        removed = state.routes[v]
+        state.routes[v] = list()
+        state.route_costs[v] = 0.0
+        state.slots.update([v])
+        return removed
+
+    @staticmethod
+    def _insert(state: _SearchState, evaluator: RouteEvaluator, j: int, slot: int):
+        v = int(state.slots.slot_vehicle[slot])
+        state.slots.insert(j, slot)
+        state.route_costs[v] = evaluator.cost(v, state.routes[v])
+
+    def _greedy_insertion(self, state, evaluator, pending, rng, randomize=True):
+        # Waypoints go in one at a time, each at its cheapest feasible position
+        order = rng.permutation(len(pending)).tolist() if randomize else range(len(pending))
+        for index in order:
+            j = pending[index]
+            costs = state.slots.costs(j)
+            slot = int(np.argmin(costs))
+            if np.isfinite(costs[slot]):
+                self._insert(state, evaluator, j, slot)
+            else:
+                state.unassigned.append(j)
+
+    def _regret_insertion(self, state, evaluator, pending, rng):
+        # The waypoint losing the most by not getting its best vehicle goes in first
+        pending = list(pending)
+        while pending:
+            best = None
+            for j in pending:
+                costs = state.slots.costs(j)
+                vehicle_costs = np.minimum.reduceat(costs, state.slots.route_offsets)
+                if len(vehicle_costs) > 1:
+                    cheapest, second = np.partition(vehicle_costs, 1)[:2]
+                else:
+                    cheapest, second = vehicle_costs[0], np.inf
+                if not np.isfinite(cheapest):
+                    regret = -np.inf
+                elif np.isfinite(second):
+                    regret = second - cheapest
+                else:
+                    regret = np.inf
+                if best is None or regret > best[0]:
+                    best = regret, j, int(np.argmin(costs))
+
+            regret, j, slot = best
+            pending.remove(j)
+            if regret == -np.inf:
+                # Nothing left fits anywhere
+                state.unassigned.extend([j] + pending)
+                break
+            self._insert(state, evaluator, j, slot)
@@ -0,0 +1,94 @@
+import numpy as np
+
+# Arcs are pruned when no schedule of the tour planning model can use them. Pruning works from
+# travel time lower bounds before routing, and from the routed travel times afterwards. Only
+# the tests that stay valid when travel times grow are applied to lower bounds. Routed travel
+# times are infinite between unreachable nodes, which drops the arc whatever its time windows.
+_tolerance = 1e-9
+
+
+def feasible_trips(origin_earliest: np.ndarray, origin_latest: np.ndarray,
+                   origin_dwell: np.ndarray, origin_demand: np.ndarray,
+                   target_earliest: np.ndarray, target_latest: np.ndarray,
+                   target_demand: np.ndarray, max_capacity: float, durations: np.ndarray,
+                   exact: bool) -> np.ndarray:
+    """
+    Marks the trips between waypoints that some vehicle may take
+    :param origin_earliest: earliest arrival hour of each origin waypoint
+    :param origin_latest: latest arrival hour of each origin waypoint
+    :param origin_dwell: dwell hours of each origin waypoint
+    :param origin_demand: cargo demand of each origin waypoint
+    :param target_earliest: earliest arrival hour of each target waypoint
+    :param target_latest: latest arrival hour of each target waypoint
+    :param target_demand: cargo demand of each target waypoint
+    :param max_capacity: largest cargo capacity of any vehicle
+    :param durations: matrix of trip hours by origin and target waypoint
+    :param exact: whether durations are routed travel times rather than lower bounds
+    :return: boolean matrix by origin and target waypoint
+    """
+    with np.errstate(invalid='ignore'):
+        departure = origin_earliest + origin_dwell
+        feasible = departure[:, None] + durations <= target_latest[None, :] + _tolerance
+        if exact:
+            latest_departure = origin_latest + origin_dwell
+            feasible &= np.isfinite(durations)
+            feasible &= (
+                    latest_departure[:, None] + durations >= target_earliest[None, :] - _tolerance
+            )
+
+    # The cargo on board before a trip must cover the demand of its origin, plus the demand of
+    # its target twice since the model keeps at least that much on board after a drop-off.
+    needed = np.maximum(
+        np.maximum(origin_demand, 0)[:, None],
+        (target_demand + np.maximum(target_demand, 0))[None, :]
+    )
+    allowed = np.minimum(max_capacity, max_capacity + target_demand)[None, :]
+    feasible &= needed <= allowed + _tolerance
+    return feasible
+
+
+def feasible_dispatches(activity_earliest: np.ndarray, activity_latest: np.ndarray,
+                        earliest: np.ndarray, latest: np.ndarray, durations: np.ndarray,
+                        exact: bool) -> np.ndarray:
+    """
+    Marks the waypoints each vehicle may be dispatched to
+    :param activity_earliest: earliest activity hour of each vehicle
+    :param activity_latest: latest activity hour of each vehicle
+    :param earliest: earliest arrival hour of each waypoint
+    :param latest: latest arrival hour of each waypoint
+    :param durations: matrix of dispatch hours by vehicle and waypoint
+    :param exact: whether durations are routed travel times rather than lower bounds
+    :return: boolean matrix by vehicle and waypoint
+    """
+    with np.errstate(invalid='ignore'):
+        feasible = activity_earliest[:, None] + durations <= latest[None, :] + _tolerance
+        if exact:
+            feasible &= np.isfinite(durations)
+            feasible &= activity_latest[:, None] + durations >= earliest[None, :] - _tolerance
+    return feasible
+
+
+def feasible_recalls(activity_earliest: np.ndarray, activity_latest: np.ndarray,
+                     earliest: np.ndarray, latest: np.ndarray, dwell: np.ndarray,
+                     durations: np.ndarray, exact: bool) -> np.ndarray:
+    """
+    Marks the waypoints each vehicle may be recalled from
+    :param activity_earliest: earliest activity hour of each vehicle
+    :param activity_latest: latest activity hour of each vehicle
+    :param earliest: earliest arrival hour of each waypoint
+    :param latest: latest arrival hour of each waypoint
+    :param dwell: dwell hours of each waypoint
+    :param durations: matrix of recall hours by vehicle and waypoint
+    :param exact: whether durations are routed travel times rather than lower bounds
+    :return: boolean matrix by vehicle and waypoint
+    """
+    with np.errstate(invalid='ignore'):
+        departure = earliest + dwell
+        feasible = departure[None, :] + durations <= activity_latest[:, None] + _tolerance
+        if exact:
+            latest_departure = latest + dwell
+            feasible &= np.isfinite(durations)
+            feasible &= (
+                    latest_departure[None, :] + durations >= activity_earliest[:, None] - _tolerance
+            )
+    return feasible
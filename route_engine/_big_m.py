@@ -0,0 +1,103 @@
+import numpy as np
+
+from ._compiled_problem import CompiledProblem
+
+_tolerance = 1e-9
+
+
+def _finite_or(values: np.ndarray, fallback: float) -> np.ndarray:
+    return np.where(np.isfinite(values), np.maximum(values, 0), fallback)
+
+
+class BigMConstants:
+    """
+    Big-M constants of the conditional equalities of the tour planning model, one per row
+
+    Each constant is the largest violation the row can see when its binary variable is clear,
+    given the ranges its variables can take. Arrivals lie within the time window of the waypoint
+    and the activity window of the vehicle, and dispatch and return times within the activity
+    window. Rows over unbounded ranges fall back to the global M-values of the model.
+    """
+
+    def __init__(self, compiled: CompiledProblem):
+        self.compiled = compiled
+
+        earliest_activity = compiled.earliest_activity[:, None]
+        latest_activity = compiled.latest_activity[:, None]
+
+        # Range of arrival times of each vehicle at each waypoint. A vehicle arrives after it is
+        # dispatched and leaves before it returns, since no trip takes negative time.
+        arrival_lb = np.maximum(compiled.earliest_arrival[None, :], earliest_activity)
+        arrival_ub = np.minimum(compiled.latest_arrival[None, :],
+                                latest_activity - compiled.dwell[None, :])
+
+        # Vehicles cannot visit waypoints with an empty range. Their arrival times are pinned to
+        # the lower end, and the trips, dispatches and recalls reaching them are not allowed.
+        self.visit_allowed = arrival_lb <= arrival_ub + _tolerance
+        self.arrival_lb = arrival_lb
+        self.arrival_ub = np.where(self.visit_allowed, arrival_ub, arrival_lb)
+
+        self.trip_allowed = (
+                self.visit_allowed[:, compiled.trip_origin] &
+                self.visit_allowed[:, compiled.trip_target]
+        )
+        self.dispatch_allowed = compiled.dispatch_allowed & self.visit_allowed
+        self.recall_allowed = compiled.recall_allowed & self.visit_allowed
+
+        self._set_capacity_constants()
+        self._set_time_constants()
+
+    def _set_capacity_constants(self):
+        compiled = self.compiled
+        origin = compiled.trip_origin
+        target = compiled.trip_target
+        demand = compiled.cargo_demand
+
+        # M-value of the original model, the sum of the absolute value of demands, used for
+        # vehicles without a cargo capacity
+        capacity_m = float(np.sum(np.abs(demand)))
+        capacity_lb = np.maximum(demand, 0)[None, :]
+        capacity_ub = compiled.cargo_capacity[:, None]
+
+        # 3.4-1: capacity_u[origin] - capacity_u[target] == demand[target]
+        with np.errstate(invalid='ignore'):
+            self.capacity_trip_upper = _finite_or(
+                capacity_ub - capacity_lb[:, target] - demand[target], capacity_m)
+            self.capacity_trip_lower = _finite_or(
+                demand[target] - capacity_lb[:, origin] + capacity_ub, capacity_m)
+
+    def _set_time_constants(self):
+        compiled = self.compiled
+        origin = compiled.trip_origin
+        target = compiled.trip_target
+        earliest_activity = compiled.earliest_activity[:, None]
+        latest_activity = compiled.latest_activity[:, None]
+
+        # M-value of the original model, the sum of all the time delays
+        time_m = float(
+            np.sum(compiled.dispatch_duration) + np.sum(compiled.recall_duration) +
+            np.sum(compiled.dwell) +
+            np.sum(compiled.trip_duration)
+        )
+
+        with np.errstate(invalid='ignore'):
+            # 3.5-1: time_u[target] - time_u[origin] == trip duration + dwell[origin]
+            value = compiled.trip_duration + compiled.dwell[origin]
+            self.time_trip_upper = _finite_or(
+                self.arrival_ub[:, target] - self.arrival_lb[:, origin] - value, time_m)
+            self.time_trip_lower = _finite_or(
+                value - self.arrival_lb[:, target] + self.arrival_ub[:, origin], time_m)
+
+            # 3.5-2: time_u - time_s == dispatch duration
+            value = compiled.dispatch_duration
+            self.time_dispatch_upper = _finite_or(
+                self.arrival_ub - earliest_activity - value, time_m)
+            self.time_dispatch_lower = _finite_or(
+                value - self.arrival_lb + latest_activity, time_m)
+
+            # 3.5-3: time_e - time_u == recall duration + dwell
+            value = compiled.recall_duration + compiled.dwell[None, :]
+            self.time_recall_upper = _finite_or(
+                latest_activity - self.arrival_lb - value, time_m)
+            self.time_recall_lower = _finite_or(
+                value - earliest_activity + self.arrival_ub, time_m)
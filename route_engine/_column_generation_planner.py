@@ -0,0 +1,338 @@
+import time
+from typing import Optional
+
+import gurobipy as gurobi
+import numpy as np
+
+from ._compiled_problem import CompiledProblem
+from ._construction import insertion_routes
+from ._construction import order_interchangeable_routes
+from ._problem_description import VehicleRoutingProblem
+from ._problem_description import VehicleRoutingProblemSolution
+from ._route_schedule import RouteEvaluator
+from ._solution_values import solution_from_routes
+
+_tolerance = 1e-9
+
+
+class _Label:
+    """
+    Partial route of the pricing problem, ending at a waypoint
+
+    Vehicles never wait, so the arrival times at the last waypoint that fit every time window
+    so far form an interval, and so do the amounts of cargo carried towards it.
+    """
+
+    __slots__ = ('waypoint', 'parent', 'visited', 'cost',
+                 'arrival_lb', 'arrival_ub', 'cargo_lb', 'cargo_ub')
+
+    def __init__(self, waypoint: int, parent, visited: np.ndarray, cost: float,
+                 arrival_lb: float, arrival_ub: float, cargo_lb: float, cargo_ub: float):
+        self.waypoint = waypoint
+        self.parent = parent
+        self.visited = visited
+        self.cost = cost
+        self.arrival_lb = arrival_lb
+        self.arrival_ub = arrival_ub
+        self.cargo_lb = cargo_lb
+        self.cargo_ub = cargo_ub
+
+    def dominates(self, other) -> bool:
+        # Every extension of the other label, which visited the same waypoints, is also an
+        # extension of this one at no more cost
+        return (
+                self.cost <= other.cost + _tolerance and
+                self.arrival_lb <= other.arrival_lb + _tolerance and
+                self.arrival_ub >= other.arrival_ub - _tolerance and
+                self.cargo_lb <= other.cargo_lb + _tolerance and
+                self.cargo_ub >= other.cargo_ub - _tolerance
+        )
+
+    def route(self) -> list[int]:
+        route = list()
+        label = self
+        while label is not None:
+            route.append(label.waypoint)
+            label = label.parent
+        return route[::-1]
+
+
+class _RoutePricer:
+    """
+    Finds routes of negative reduced cost by labeling, a resource constrained shortest path
+    search over elementary routes respecting time windows, activity windows and cargo limits
+    """
+
+    def __init__(self, compiled: CompiledProblem, max_labels_per_waypoint: int | None):
+        self.compiled = compiled
+        self._max_labels_per_waypoint = max_labels_per_waypoint
+
+        # Dense trip matrices, infinite between waypoints without a trip
+        num_waypoints = compiled.num_waypoints
+        self._trip_cost = np.full((num_waypoints, num_waypoints), np.inf)
+        self._trip_cost[compiled.trip_origin, compiled.trip_target] = compiled.trip_cost
+        self._trip_duration = np.full((num_waypoints, num_waypoints), np.inf)
+        self._trip_duration[compiled.trip_origin, compiled.trip_target] = compiled.trip_duration
+        self._targets = [
+            compiled.trip_target[arcs] for arcs in compiled.trips_out_of
+        ]
+        self._min_trip_duration = np.min(self._trip_duration, axis=1, initial=np.inf)
+
+    def price(self, v: int, waypoint_duals: np.ndarray, vehicle_dual: float,
+              max_routes: int) -> list[list[int]]:
+        """
+        Searches for routes of a vehicle with negative reduced cost
+        :param v: vehicle index
+        :param waypoint_duals: duals of the rows visiting each waypoint once
+        :param vehicle_dual: dual of the row limiting the routes of the vehicle
+        :param max_routes: number of routes to return at most
+        :return: routes of the most negative reduced costs, most negative first
+        """
+        compiled = self.compiled
+        num_waypoints = compiled.num_waypoints
+        demand = compiled.cargo_demand
+        dwell = compiled.dwell
+        capacity = compiled.cargo_capacity[v]
+        earliest_activity = compiled.earliest_activity[v]
+        latest_activity = compiled.latest_activity[v]
+
+        # Waypoint duals are collected on arrival, and the vehicle dual on return
+        trip_cost = self._trip_cost - waypoint_duals[None, :]
+        dispatch_cost = compiled.dispatch_cost[v] - waypoint_duals
+        recall_cost = compiled.recall_cost[v] - vehicle_dual
+        recall_ready = latest_activity - dwell - compiled.recall_duration[v]
+
+        # Vehicles leaving a waypoint either return or take a trip, so they must arrive early
+        # enough to do the shorter of the two before the end of their activity window
+        trip_ready = np.where(
+            np.isfinite(self._min_trip_duration),
+            latest_activity - dwell - self._min_trip_duration, -np.inf)
+        latest_arrival = np.minimum(
+            compiled.latest_arrival,
+            np.maximum(np.where(compiled.recall_allowed[v], recall_ready, -np.inf), trip_ready)
+        )
+
+        # Labels are extended one waypoint at a time, so each round holds routes of one length.
+        # Of these, only routes visiting the same waypoints and ending at the same one can
+        # dominate each other.
+        def _keep(_labels: list[_Label]) -> list[_Label]:
+            kept = list()
+            num_kept = np.zeros(num_waypoints, dtype=np.int64)
+            states: dict[tuple[int, bytes], list[_Label]] = dict()
+            for _label in sorted(_labels, key=lambda _other: _other.cost):
+                if self._max_labels_per_waypoint is not None and \
+                        num_kept[_label.waypoint] >= self._max_labels_per_waypoint:
+                    continue
+                state = states.setdefault((_label.waypoint, _label.visited.tobytes()), list())
+                if not any(other.dominates(_label) for other in state):
+                    state.append(_label)
+                    kept.append(_label)
+                    num_kept[_label.waypoint] += 1
+            return kept
+
+        labels = list()
+        for j in np.flatnonzero(compiled.dispatch_allowed[v]).tolist():
+            arrival_lb = max(earliest_activity + compiled.dispatch_duration[v, j],
+                             compiled.earliest_arrival[j])
+            arrival_ub = min(latest_activity + compiled.dispatch_duration[v, j],
+                             latest_arrival[j])
+            cargo_lb = max(demand[j], 0)
+            if arrival_lb > arrival_ub + _tolerance or cargo_lb > capacity + _tolerance:
+                continue
+
+            visited = np.zeros(num_waypoints, dtype=bool)
+            visited[j] = True
+            labels.append(_Label(j, None, visited, dispatch_cost[j], arrival_lb, arrival_ub,
+                                 cargo_lb, capacity))
+
+        routes: dict[tuple[int, ...], float] = dict()
+        labels = _keep(labels)
+        while labels:
+            extended = list()
+            for label in labels:
+                i = label.waypoint
+                if compiled.recall_allowed[v, i] and \
+                        label.arrival_lb <= recall_ready[i] + _tolerance:
+                    reduced_cost = label.cost + recall_cost[i]
+                    if reduced_cost < -_tolerance:
+                        routes[tuple(label.route())] = reduced_cost
+
+                # Extensions along every trip leaving the waypoint, checked at once
+                targets = self._targets[i]
+                targets = targets[~label.visited[targets]]
+                shift = dwell[i] + self._trip_duration[i, targets]
+                arrival_lb = np.maximum(
+                    label.arrival_lb + shift, compiled.earliest_arrival[targets])
+                arrival_ub = np.minimum(label.arrival_ub + shift, latest_arrival[targets])
+                cargo_lb = np.maximum(
+                    label.cargo_lb - demand[targets], np.maximum(demand[targets], 0))
+                cargo_ub = np.minimum(label.cargo_ub - demand[targets], capacity)
+                feasible = (
+                        (arrival_lb <= arrival_ub + _tolerance) &
+                        (cargo_lb <= cargo_ub + _tolerance)
+                )
+                costs = label.cost + trip_cost[i, targets]
+
+                for k in np.flatnonzero(feasible).tolist():
+                    j = int(targets[k])
+                    visited = label.visited.copy()
+                    visited[j] = True
+                    extended.append(_Label(j, label, visited, costs[k], arrival_lb[k],
+                                           arrival_ub[k], cargo_lb[k], cargo_ub[k]))
+            labels = _keep(extended)
+
+        best = sorted(routes.items(), key=lambda item: item[1])[:max_routes]
+        return [list(route) for route, _ in best]
+
+
+class ColumnGenerationTourPlanner:
+    """
+    Plans tours by column generation over a set partitioning model
+
+    The master problem chooses routes so that every waypoint is visited once and each group of
+    interchangeable vehicles drives at most as many routes as it has vehicles. Its linear
+    relaxation is solved over a growing set of routes, starting from the routes of a cheapest
+    insertion heuristic, and the pricing problem adds the routes whose reduced cost is negative
+    under the duals of the relaxation. Once no route prices out, the master problem is solved
+    over the generated routes with integer variables.
+
+    The pricing problem is an elementary resource constrained shortest path problem, solved by
+    labeling with the time window, activity window and cargo limits of the Gurobi model. It is
+    exact without a limit on the labels kept per waypoint, and the relaxation then bounds the
+    cost of any plan. Like ALNSTourPlanner, this planner minimizes the cost of trips,
+    dispatches and recalls.
+    """
+
+    def __init__(self, max_iterations: int = 100, routes_per_iteration: int = 20,
+                 max_labels_per_waypoint: int | None = 20,
+                 time_limit_seconds: float | None = None, gurobi_params: Optional[dict] = None):
+        if gurobi_params is None:
+            gurobi_params = dict()
+
+        # Column generation stops after this many rounds of pricing, or this much time
+        self._max_iterations = max_iterations
+        self._time_limit_seconds = time_limit_seconds
+
+        # Routes added per group of interchangeable vehicles in each round
+        self._routes_per_iteration = routes_per_iteration
+
+        # Labels kept per waypoint by the pricing search, or None to price exactly
+        self._max_labels_per_waypoint = max_labels_per_waypoint
+
+        self._gurobi_params = gurobi_params
+
+    def solve(self, problem: VehicleRoutingProblem) -> VehicleRoutingProblemSolution:
+        compiled = CompiledProblem(problem)
+        evaluator = RouteEvaluator(compiled)
+        routes = self.plan_routes(compiled, evaluator=evaluator)
+        return solution_from_routes(compiled, routes, evaluator)
+
+    def plan_routes(self, compiled: CompiledProblem,
+                    evaluator: RouteEvaluator | None = None) -> list[list[int]]:
+        """
+        Generates routes and picks the cheapest set of them visiting every waypoint once
+        :param compiled: problem to plan routes for
+        :param evaluator: evaluator of the same problem, to share its cached arrays
+        :return: waypoint indices visited by each vehicle
+        """
+        start_time = time.monotonic()
+        if evaluator is None:
+            evaluator = RouteEvaluator(compiled)
+
+        model = gurobi.Model()
+        for param, val in self._gurobi_params.items():
+            model.setParam(param, val)
+
+        # Waypoints left out are penalized beyond the cost of any set of routes, which keeps
+        # the master problem feasible before routes visiting every waypoint are generated
+        unassigned_penalty = 2 * (
+                np.sum(compiled.trip_cost) +
+                np.sum(np.max(compiled.dispatch_cost + compiled.recall_cost, axis=0)) + 1
+        )
+        unassigned = [
+            model.addVar(obj=unassigned_penalty, name=f'unassigned_{waypoint}')
+            for waypoint in compiled.waypoints
+        ]
+        model.update()
+
+        # Each waypoint is visited once
+        visit_constrs = [
+            model.addConstr(unassigned[j] == 1, name=f'visit[{waypoint}]')
+            for j, waypoint in enumerate(compiled.waypoints)
+        ]
+
+        # Each group of interchangeable vehicles drives at most one route per vehicle
+        groups = compiled.vehicle_groups
+        fleet_constrs = [
+            model.addConstr(gurobi.LinExpr() <= len(group), name=f'fleet[{g}]')
+            for g, group in enumerate(groups)
+        ]
+
+        # Routes by the group of vehicles driving them
+        columns: dict[tuple[int, tuple[int, ...]], gurobi.Var] = dict()
+
+        def _add_column(_g: int, _route: list[int]) -> bool:
+            key = _g, tuple(_route)
+            if not _route or key in columns:
+                return False
+            column = gurobi.Column(
+                [1.0] * (len(_route) + 1),
+                [visit_constrs[j] for j in _route] + [fleet_constrs[_g]]
+            )
+            columns[key] = model.addVar(
+                obj=evaluator.cost(groups[_g][0], _route), column=column,
+                name=f'route_{_g}_{len(columns)}')
+            return True
+
+        group_of = np.empty(compiled.num_vehicles, dtype=np.int64)
+        for g, group in enumerate(groups):
+            group_of[group] = g
+
+        initial_routes = insertion_routes(compiled)
+        if initial_routes is not None:
+            for v, route in enumerate(initial_routes):
+                _add_column(int(group_of[v]), route)
+
+        pricer = _RoutePricer(compiled, self._max_labels_per_waypoint)
+        for _ in range(self._max_iterations):
+            if self._time_limit_seconds is not None and \
+                    time.monotonic() - start_time >= self._time_limit_seconds:
+                break
+
+            model.optimize()
+            if model.Status != gurobi.GRB.OPTIMAL:
+                raise RuntimeError(
+                    f'Unable to solve the master problem: Gurobi stopped with status '
+                    f'{model.Status}.')
+
+            waypoint_duals = np.array(model.getAttr('Pi', visit_constrs))
+            fleet_duals = model.getAttr('Pi', fleet_constrs)
+
+            added = 0
+            for g, group in enumerate(groups):
+                for route in pricer.price(group[0], waypoint_duals, fleet_duals[g],
+                                          self._routes_per_iteration):
+                    added += _add_column(g, route)
+            if added == 0:
+                break
+
+        # Price and round: the master problem over the generated routes, with binary variables
+        route_vars = list(columns.values())
+        model.setAttr('VType', route_vars, [gurobi.GRB.BINARY] * len(route_vars))
+        model.optimize()
+        if model.SolCount == 0:
+            raise RuntimeError(
+                f'No solution found before Gurobi stopped with status {model.Status}.')
+
+        num_unassigned = sum(value > 0.5 for value in model.getAttr('X', unassigned))
+        if num_unassigned > 0:
+            raise RuntimeError(
+                f'Unable to fit {num_unassigned} waypoints into feasible tours.')
+
+        routes: list[list[int]] = [list() for _ in range(compiled.num_vehicles)]
+        drivers = [list(group) for group in groups]
+        for (g, route), value in zip(columns.keys(), model.getAttr('X', route_vars)):
+            if value > 0.5:
+                routes[drivers[g].pop(0)] = list(route)
+
+        return order_interchangeable_routes(compiled, routes)
@@ -0,0 +1,142 @@
+import numpy as np
+
+from ._problem_description import Trip
+from ._problem_description import Vehicle
+from ._problem_description import VehicleRoutingProblem
+from ._problem_description import Waypoint
+from ._problem_description import _or_default
+
+
+def _group_equal(items: list) -> list[list[int]]:
+    groups: list[list[int]] = list()
+    for index, item in enumerate(items):
+        for group in groups:
+            if items[group[0]] == item:
+                group.append(index)
+                break
+        else:
+            groups.append([index])
+    return groups
+
+
+def _group_arcs_by(endpoints: np.ndarray, num_waypoints: int) -> list[np.ndarray]:
+    order = np.argsort(endpoints, kind='stable')
+    counts = np.bincount(endpoints, minlength=num_waypoints)
+    return np.split(order, np.cumsum(counts)[:-1])
+
+
+class CompiledProblem:
+    """
+    Array view of a planned VehicleRoutingProblem
+
+    Vehicles and waypoints are numbered in the order the problem lists them. Missing time
+    windows and capacities become infinite bounds. Trips are also numbered as arcs in the order
+    of problem.trips, with the arcs entering and leaving each waypoint precomputed.
+    """
+
+    def __init__(self, problem: VehicleRoutingProblem):
+        self.problem = problem
+
+        self.vehicles: list[Vehicle] = list(problem.vehicles)
+        self.waypoints: list[Waypoint] = problem.waypoints
+        self.trips: list[Trip] = list(problem.trips)
+
+        self.vehicle_index = {vehicle: v for v, vehicle in enumerate(self.vehicles)}
+        self.waypoint_index = {waypoint: j for j, waypoint in enumerate(self.waypoints)}
+
+        num_vehicles = len(self.vehicles)
+        num_waypoints = len(self.waypoints)
+
+        vehicle_params = [problem.vehicle_params(vehicle) for vehicle in self.vehicles]
+        self.earliest_activity = np.array([
+            _or_default(params.earliest_activity_hour, -np.inf) for params in vehicle_params
+        ], dtype=np.float64)
+        self.latest_activity = np.array([
+            _or_default(params.latest_activity_hour, np.inf) for params in vehicle_params
+        ], dtype=np.float64)
+        self.cargo_capacity = np.array([
+            _or_default(params.cargo_capacity, np.inf) for params in vehicle_params
+        ], dtype=np.float64)
+
+        # Vehicles with equal parameters share a depot and limits, so they are interchangeable
+        self.vehicle_groups = _group_equal(vehicle_params)
+
+        waypoint_params = [problem.waypoint_params(waypoint) for waypoint in self.waypoints]
+        self.cargo_demand = np.array([
+            params.cargo_demand for params in waypoint_params
+        ], dtype=np.float64)
+        self.dwell = np.array([
+            params.dwell_hours for params in waypoint_params
+        ], dtype=np.float64)
+        self.earliest_arrival = np.array([
+            _or_default(params.earliest_arrival_hour, -np.inf) for params in waypoint_params
+        ], dtype=np.float64)
+        self.latest_arrival = np.array([
+            _or_default(params.latest_arrival_hour, np.inf) for params in waypoint_params
+        ], dtype=np.float64)
+
+        # Trips as arcs between waypoint indices
+        self.trip_origin = np.array(
+            [self.waypoint_index[i] for i, _ in self.trips], dtype=np.int64)
+        self.trip_target = np.array(
+            [self.waypoint_index[j] for _, j in self.trips], dtype=np.int64)
+        self.trip_cost = np.array(
+            [problem.trip_params(trip).cost for trip in self.trips], dtype=np.float64)
+        self.trip_duration = np.array(
+            [problem.trip_params(trip).duration_hours for trip in self.trips], dtype=np.float64)
+
+        # Arc index of the trip between two waypoints, or -1 without one
+        self.trip_index = np.full((num_waypoints, num_waypoints), -1, dtype=np.int64)
+        self.trip_index[self.trip_origin, self.trip_target] = np.arange(len(self.trips))
+
+        # Arcs entering and leaving each waypoint
+        self.trips_into = _group_arcs_by(self.trip_target, num_waypoints)
+        self.trips_out_of = _group_arcs_by(self.trip_origin, num_waypoints)
+
+        # Dispatch and recall data by vehicle and waypoint index. Pairs pruned by trip planning
+        # are marked as not allowed and have zero cost and duration.
+        self.dispatch_allowed = np.zeros((num_vehicles, num_waypoints), dtype=bool)
+        self.dispatch_cost = np.zeros((num_vehicles, num_waypoints), dtype=np.float64)
+        self.dispatch_duration = np.zeros((num_vehicles, num_waypoints), dtype=np.float64)
+        self.recall_allowed = np.zeros((num_vehicles, num_waypoints), dtype=bool)
+        self.recall_cost = np.zeros((num_vehicles, num_waypoints), dtype=np.float64)
+        self.recall_duration = np.zeros((num_vehicles, num_waypoints), dtype=np.float64)
+        for v, vehicle in enumerate(self.vehicles):
+            for j, waypoint in enumerate(self.waypoints):
+                if problem.can_dispatch(vehicle, waypoint):
+                    dispatch_params = problem.dispatch_params(vehicle, waypoint)
+                    self.dispatch_allowed[v, j] = True
+                    self.dispatch_cost[v, j] = dispatch_params.cost
+                    self.dispatch_duration[v, j] = dispatch_params.duration_hours
+
+                if problem.can_recall(vehicle, waypoint):
+                    recall_params = problem.recall_params(vehicle, waypoint)
+                    self.recall_allowed[v, j] = True
+                    self.recall_cost[v, j] = recall_params.cost
+                    self.recall_duration[v, j] = recall_params.duration_hours
+
+    def interchangeable_vehicle_pairs(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Pairs up each vehicle with the next one in its group of interchangeable vehicles
+        :return: indices of the earlier and the later vehicle of each pair
+        """
+        pairs = [
+            (group[k], group[k + 1])
+            for group in self.vehicle_groups
+            for k in range(len(group) - 1)
+        ]
+        earlier = np.array([v for v, _ in pairs], dtype=np.int64)
+        later = np.array([w for _, w in pairs], dtype=np.int64)
+        return earlier, later
+
+    @property
+    def num_vehicles(self) -> int:
+        return len(self.vehicles)
+
+    @property
+    def num_waypoints(self) -> int:
+        return len(self.waypoints)
+
+    @property
+    def num_trips(self) -> int:
+        return len(self.trips)
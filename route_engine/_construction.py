@@ -0,0 +1,42 @@
+import numpy as np
+
+from ._compiled_problem import CompiledProblem
+from ._insertion import InsertionSlots
+
+
+def order_interchangeable_routes(compiled: CompiledProblem,
+                                 routes: list[list[int]]) -> list[list[int]]:
+    """
+    Hands the routes of interchangeable vehicles out in the order the planner's symmetry
+    breaking constraints expect: used vehicles first, by ascending first waypoint index.
+    """
+    routes = list(routes)
+    for group in compiled.vehicle_groups:
+        group_routes = sorted(
+            (routes[v] for v in group),
+            key=lambda _route: (not _route, _route[0] if _route else 0)
+        )
+        for v, route in zip(group, group_routes):
+            routes[v] = route
+    return routes
+
+
+def insertion_routes(compiled: CompiledProblem) -> list[list[int]] | None:
+    """
+    Builds routes by cheapest feasible insertion, taking waypoints with the tightest time
+    windows first
+    :param compiled: problem to build routes for
+    :return: waypoint indices visited by each vehicle, or None if a waypoint fits nowhere
+    """
+    routes: list[list[int]] = [list() for _ in range(compiled.num_vehicles)]
+    slots = InsertionSlots(compiled, routes)
+
+    waypoint_order = np.lexsort((compiled.earliest_arrival, compiled.latest_arrival))
+    for j in waypoint_order.tolist():
+        costs = slots.costs(j)
+        slot = int(np.argmin(costs))
+        if not np.isfinite(costs[slot]):
+            return None
+        slots.insert(j, slot)
+
+    return order_interchangeable_routes(compiled, routes)
@@ -0,0 +1,187 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import gurobipy as gurobi
+import numpy as np
+
+from gis_backend.query_provider import get_coord_of_node
+
+from ._alns_planner import ALNSTourPlanner
+from ._compiled_problem import CompiledProblem
+from ._gurobi_delegate import GurobiTourPlanner
+from ._problem_description import VehicleRoutingProblem
+from ._problem_description import VehicleRoutingProblemSolution
+from ._route_schedule import RouteEvaluator
+from ._solution_values import routes_from_solution
+from ._solution_values import solution_from_routes
+
+_km_per_degree = 111.2
+
+
+def _solve_subproblem(task) -> VehicleRoutingProblemSolution | None:
+    planner, subproblem = task
+    try:
+        return planner.solve(subproblem)
+    except (RuntimeError, gurobi.GurobiError):
+        # Such as license limits on model size or on concurrent solves. The repair pass places
+        # the waypoints of the cluster.
+        return None
+
+
+class DecompositionTourPlanner:
+    """
+    Plans tours by splitting the waypoints into clusters solved separately
+
+    Waypoints are clustered by location and by the middle of their time windows, and each
+    cluster is given a share of the vehicles in proportion to its size, picking the vehicles
+    whose depots serve it most cheaply. The subproblems are solved in a process pool and their
+    solutions combined. A repair pass then searches the combined routes with ALNSTourPlanner,
+    which moves waypoints across cluster boundaries and places the waypoints of clusters whose
+    subproblem could not be solved.
+    """
+
+    def __init__(self, sub_planner=None, max_cluster_size: int = 25,
+                 time_weight_km_per_hour: float = 30.0, workers: int | None = None,
+                 repair_seconds: float = 5.0, subproblem_seconds: float = 30.0,
+                 seed: int | None = None):
+        if max_cluster_size < 1:
+            raise ValueError(f'Invalid maximum cluster size {max_cluster_size}.')
+
+        # Any planner with a solve method taking a problem. The default planner returns its best
+        # solution after subproblem_seconds, and uses one thread per worker process when several
+        # subproblems run at once.
+        if sub_planner is None:
+            gurobi_params = dict() if workers is not None and workers <= 1 else {'Threads': 1}
+            sub_planner = GurobiTourPlanner(gurobi_params, time_limit_seconds=subproblem_seconds)
+        self._sub_planner = sub_planner
+
+        # Clusters aim for this many waypoints, and never outnumber the vehicles
+        self._max_cluster_size = max_cluster_size
+
+        # Hours between the time windows of two waypoints count as this many kilometers apart
+        self._time_weight_km_per_hour = time_weight_km_per_hour
+
+        # Subproblems are solved in this many worker processes, or in this process if one
+        self._workers = workers
+
+        # Time spent on the repair pass, none if zero
+        self._repair_seconds = repair_seconds
+        self._seed = seed
+
+    def solve(self, problem: VehicleRoutingProblem) -> VehicleRoutingProblemSolution:
+        compiled = CompiledProblem(problem)
+        clusters = self._cluster_waypoints(compiled)
+        fleets = self._assign_vehicles(compiled, clusters)
+
+        tasks = [
+            (self._sub_planner, problem.subproblem(
+                [compiled.vehicles[v] for v in fleet],
+                [compiled.waypoints[j] for j in cluster]
+            ))
+            for cluster, fleet in zip(clusters, fleets)
+        ]
+
+        if self._workers is not None and self._workers <= 1:
+            sub_solutions = list(map(_solve_subproblem, tasks))
+        else:
+            with ProcessPoolExecutor(max_workers=self._workers) as executor:
+                sub_solutions = list(executor.map(_solve_subproblem, tasks))
+
+        if self._repair_seconds <= 0:
+            if any(sub_solution is None for sub_solution in sub_solutions):
+                raise RuntimeError('Unable to solve the subproblem of a cluster.')
+            return self._stitch(problem, sub_solutions)
+
+        routes = [list() for _ in range(compiled.num_vehicles)]
+        for sub_solution in sub_solutions:
+            if sub_solution is None:
+                continue
+            for v, route in enumerate(routes_from_solution(compiled, sub_solution)):
+                routes[v].extend(route)
+
+        evaluator = RouteEvaluator(compiled)
+        repair_planner = ALNSTourPlanner(time_limit_seconds=self._repair_seconds, seed=self._seed)
+        routes = repair_planner.plan_routes(compiled, initial_routes=routes, evaluator=evaluator)
+        return solution_from_routes(compiled, routes, evaluator)
+
+    def _cluster_waypoints(self, compiled: CompiledProblem) -> list[np.ndarray]:
+        # scikit-learn is slow to import and only needed for clustering
+        from sklearn.cluster import KMeans
+
+        num_waypoints = compiled.num_waypoints
+        num_clusters = min(
+            math.ceil(num_waypoints / self._max_cluster_size), compiled.num_vehicles)
+        if num_clusters <= 1:
+            return [np.arange(num_waypoints)]
+
+        # Locations on a local flat projection in kilometers
+        coords = np.array([
+            get_coord_of_node(compiled.problem.waypoint_params(waypoint).gis_node)
+            for waypoint in compiled.waypoints
+        ])
+        lat, long = np.radians(coords).T
+        north = _km_per_degree * np.degrees(lat)
+        east = _km_per_degree * np.degrees(long) * np.cos(np.mean(lat))
+
+        # Waypoints without a time window are placed in the middle of the others
+        with np.errstate(invalid='ignore'):
+            window_center = (compiled.earliest_arrival + compiled.latest_arrival) / 2
+        lower = np.where(np.isfinite(compiled.earliest_arrival), compiled.earliest_arrival,
+                         compiled.latest_arrival)
+        upper = np.where(np.isfinite(compiled.latest_arrival), compiled.latest_arrival,
+                         compiled.earliest_arrival)
+        window_center = np.where(np.isfinite(window_center), window_center,
+                                 np.where(np.isfinite(lower), lower, upper))
+        finite = np.isfinite(window_center)
+        window_center[~finite] = np.mean(window_center[finite]) if np.any(finite) else 0
+
+        features = np.column_stack([
+            north, east, self._time_weight_km_per_hour * window_center,
+        ])
+        labels = KMeans(
+            n_clusters=num_clusters, n_init=10, random_state=self._seed).fit_predict(features)
+
+        clusters = [np.flatnonzero(labels == label) for label in range(num_clusters)]
+        return [cluster for cluster in clusters if len(cluster) > 0]
+
+    @staticmethod
+    def _assign_vehicles(compiled: CompiledProblem,
+                         clusters: list[np.ndarray]) -> list[list[int]]:
+        # Every cluster gets a vehicle, and the rest are shared out by largest remainder
+        sizes = np.array([len(cluster) for cluster in clusters], dtype=np.float64)
+        spare = compiled.num_vehicles - len(clusters)
+        shares = spare * sizes / max(sizes.sum(), 1)
+        quotas = 1 + np.floor(shares).astype(np.int64)
+        remainders = np.argsort(-(shares - np.floor(shares)), kind='stable')
+        quotas[remainders[:spare - (quotas.sum() - len(clusters))]] += 1
+
+        # Vehicles go to the largest clusters first, cheapest to dispatch and recall on average
+        serving_cost = (
+                np.where(compiled.dispatch_allowed, compiled.dispatch_cost, np.inf) +
+                np.where(compiled.recall_allowed, compiled.recall_cost, np.inf)
+        )
+        available = np.ones(compiled.num_vehicles, dtype=bool)
+        fleets: list[list[int]] = [list() for _ in clusters]
+        for c in np.argsort(-sizes, kind='stable').tolist():
+            mean_cost = np.mean(serving_cost[:, clusters[c]], axis=1)
+            candidates = np.flatnonzero(available)
+            chosen = candidates[np.argsort(mean_cost[candidates], kind='stable')[:quotas[c]]]
+            available[chosen] = False
+            fleets[c] = sorted(chosen.tolist())
+        return fleets
+
+    @staticmethod
+    def _stitch(problem: VehicleRoutingProblem, sub_solutions: list[VehicleRoutingProblemSolution]):
+        solution = VehicleRoutingProblemSolution(problem=problem)
+        for sub_solution in sub_solutions:
+            for vehicle in sub_solution.problem.vehicles:
+                dispatch = sub_solution.dispatch_activity(vehicle)
+                if dispatch is None:
+                    continue
+                solution.add_dispatch(vehicle, dispatch.params.target, dispatch)
+                for activity in sub_solution.trip_activities(vehicle):
+                    trip = activity.params.origin, activity.params.target
+                    solution.add_trip(vehicle, trip, activity)
+                recall = sub_solution.recall_activity(vehicle)
+                solution.add_recall(vehicle, recall.params.origin, recall)
+        return solution
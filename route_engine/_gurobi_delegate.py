@@ -1,368 +1,616 @@
+import queue
+import threading
+import time
+from collections.abc import Callable
+from collections.abc import Iterator
 from typing import Optional
 
 import gurobipy as gurobi
+import numpy as np
 
-from . import VehicleRoutingProblemSolution
-from ._problem_description import DispatchActivity
-from ._problem_description import RecallActivity
-from ._problem_description import TripActivity
+from ._big_m import BigMConstants
+from ._compiled_problem import CompiledProblem
+from ._construction import insertion_routes
+from ._matrix_formulation import MatrixFormulation
 from ._problem_description import VehicleRoutingProblem
-
-
-def _is_gurobi_binary_variable_set(gurobi_var):
-    return gurobi_var.X > 0.5
-
-
-def _get_gurobi_variable_value(gurobi_var):
-    return gurobi_var.X
-
-
-class GurobiTourPlanner:
-    def __init__(self, gurobi_params: Optional[dict] = None,
-                 infeasible_filename: str = 'infeasible.ilp'):
-        if gurobi_params is None:
-            gurobi_params = dict()
-
-        self._gurobi_params = gurobi_params
-        self._infeasible_filename = infeasible_filename
-
-    def solve(self, problem: VehicleRoutingProblem):
-        num_waypoints = len(problem.waypoints)
-        model = gurobi.Model()
-
-        # Set gurobi parameters on the model
-        for param, val in self._gurobi_params.items():
-            model.setParam(param, val)
-
-        # Binary decision variables
-        # A value of 1 indicates the trip between two waypoints is included in the tour of a vehicle
-        x = {
-            v: {ij: model.addVar(vtype=gurobi.GRB.BINARY, name=f'x_{ij}') for ij in problem.trips}
-            for v in problem.vehicles
-        }
-
-        # Binary decision variables
-        # A value of 1 indicates the vehicle is dispatched to the waypoint at the beginning of its
-        # tour.
-        x_dispatch = {
-            v: {j: model.addVar(vtype=gurobi.GRB.BINARY, name=f'x_{v, j}') for j in
-                problem.waypoints}
-            for v in problem.vehicles
-        }
-
-        # Binary decision variables
-        # A value of 1 indicates the vehicle is recalled from the waypoint at the end of its tour.
-        x_recall = {
-            v: {j: model.addVar(vtype=gurobi.GRB.BINARY, name=f'x_{j, v}') for j in
-                problem.waypoints}
-            for v in problem.vehicles
-        }
-
-        # Flow control constraint
-        # A vehicle that enters a waypoint must exit it.
-        # For any vehicle, the total number of enabled edges terminating at any waypoint must be
-        # equal to the number of enabled edges originating from it.
-        model.addConstrs((
-            x_dispatch[v][j] + gurobi.quicksum(x[v][ij] for ij in problem.trips_to(j)) ==
-            x_recall[v][j] + gurobi.quicksum(x[v][ji] for ji in problem.trips_from(j))
-            for v in problem.vehicles
-            for j in problem.waypoints
-        ), name='3.2-1')
-
-        # Flow control constraint
-        # A waypoint must be visited once.
-        # The total number of enabled edges of vehicles terminating at a waypoint must sum to one.
-        model.addConstrs((
-            gurobi.quicksum(
-                x_dispatch[v][j] + gurobi.quicksum(x[v][ij] for ij in problem.trips_to(j))
-                for v in problem.vehicles
-            ) == 1
-            for j in problem.waypoints
-        ), name='3.2-2')
-
-        # Flow control constraint
-        # A vehicle can be dispatched to and recalled from at most one waypoint.
-        model.addConstrs((
-            gurobi.quicksum(x_dispatch[v][j] for j in problem.waypoints) <= 1
-            for v in problem.vehicles
-        ), name='3.2-3a')
-        model.addConstrs((
-            gurobi.quicksum(x_recall[v][j] for j in problem.waypoints) <= 1
-            for v in problem.vehicles
-        ), name='3.2-3b')
-
+from ._problem_description import VehicleRoutingProblemSolution
+from ._route_schedule import RouteEvaluator
+from ._solution_values import route_values
+from ._solution_values import solution_from_values
+from ._subtours import find_subtours
+
+
+def _get_gurobi_variable_values(model: gurobi.Model, gurobi_vars,
+                                in_callback: bool = False) -> np.ndarray:
+    if isinstance(gurobi_vars, gurobi.MVar):
+        return model.cbGetSolution(gurobi_vars) if in_callback else gurobi_vars.X
+
+    # Values are fetched in one call rather than one call per variable
+    gurobi_vars = np.array(gurobi_vars, dtype=object)
+    flat_vars = gurobi_vars.ravel().tolist()
+    values = model.cbGetSolution(flat_vars) if in_callback else model.getAttr('X', flat_vars)
+    return np.reshape(np.array(values, dtype=np.float64), gurobi_vars.shape)
+
+
+def _set_gurobi_start_values(model: gurobi.Model, gurobi_vars, values: np.ndarray):
+    # Values left out of the start are completed by Gurobi
+    values = np.where(np.isnan(values), gurobi.GRB.UNDEFINED, values)
+    if isinstance(gurobi_vars, gurobi.MVar):
+        gurobi_vars.Start = values
+    else:
+        flat_vars = np.ravel(np.array(gurobi_vars, dtype=object)).tolist()
+        model.setAttr('Start', flat_vars, values.ravel().tolist())
+
+
+def _build_expression_model(model: gurobi.Model, compiled: CompiledProblem,
+                            subtour_elimination: str, symmetry_breaking: bool) -> dict:
+    vehicles = range(compiled.num_vehicles)
+    waypoints = range(compiled.num_waypoints)
+    trips = range(compiled.num_trips)
+    trip_origin = compiled.trip_origin.tolist()
+    trip_target = compiled.trip_target.tolist()
+    num_waypoints = compiled.num_waypoints
+
+    # Trips, dispatches and recalls reaching waypoints a vehicle cannot visit in time, or pruned
+    # by trip planning, are fixed to zero
+    big_m = BigMConstants(compiled)
+    trip_allowed = big_m.trip_allowed.tolist()
+    dispatch_allowed = big_m.dispatch_allowed.tolist()
+    recall_allowed = big_m.recall_allowed.tolist()
+
+    # Binary decision variables
+    # A value of 1 indicates the trip between two waypoints is included in the tour of a vehicle
+    x = [
+        [
+            model.addVar(vtype=gurobi.GRB.BINARY, ub=int(trip_allowed[v][ij]),
+                         name=f'x_{compiled.trips[ij]}')
+            for ij in trips
+        ]
+        for v in vehicles
+    ]
+
+    # Binary decision variables
+    # A value of 1 indicates the vehicle is dispatched to the waypoint at the beginning of its
+    # tour.
+    x_dispatch = [
+        [
+            model.addVar(vtype=gurobi.GRB.BINARY, ub=int(dispatch_allowed[v][j]),
+                         name=f'x_{compiled.vehicles[v], compiled.waypoints[j]}')
+            for j in waypoints
+        ]
+        for v in vehicles
+    ]
+
+    # Binary decision variables
+    # A value of 1 indicates the vehicle is recalled from the waypoint at the end of its tour.
+    x_recall = [
+        [
+            model.addVar(vtype=gurobi.GRB.BINARY, ub=int(recall_allowed[v][j]),
+                         name=f'x_{compiled.waypoints[j], compiled.vehicles[v]}')
+            for j in waypoints
+        ]
+        for v in vehicles
+    ]
+
+    # Flow control constraint
+    # A vehicle that enters a waypoint must exit it.
+    # For any vehicle, the total number of enabled edges terminating at any waypoint must be
+    # equal to the number of enabled edges originating from it.
+    model.addConstrs((
+        x_dispatch[v][j] + gurobi.quicksum(x[v][ij] for ij in compiled.trips_into[j]) ==
+        x_recall[v][j] + gurobi.quicksum(x[v][ji] for ji in compiled.trips_out_of[j])
+        for v in vehicles
+        for j in waypoints
+    ), name='3.2-1')
+
+    # Flow control constraint
+    # A waypoint must be visited once.
+    # The total number of enabled edges of vehicles terminating at a waypoint must sum to one.
+    model.addConstrs((
+        gurobi.quicksum(
+            x_dispatch[v][j] + gurobi.quicksum(x[v][ij] for ij in compiled.trips_into[j])
+            for v in vehicles
+        ) == 1
+        for j in waypoints
+    ), name='3.2-2')
+
+    # Flow control constraint
+    # A vehicle can be dispatched to and recalled from at most one waypoint.
+    model.addConstrs((
+        gurobi.quicksum(x_dispatch[v][j] for j in waypoints) <= 1
+        for v in vehicles
+    ), name='3.2-3a')
+    model.addConstrs((
+        gurobi.quicksum(x_recall[v][j] for j in waypoints) <= 1
+        for v in vehicles
+    ), name='3.2-3b')
+
+    if subtour_elimination == 'mtz':
         # Sub-tour elimination decision variable
         # Accumulated Miller-Tucker-Zemlin demand
-        subtour_u = {
-            v: {
-                j: model.addVar(vtype=gurobi.GRB.CONTINUOUS, lb=1, ub=num_waypoints,
-                                name=f'subtour_u_{v, j}')
-                for j in problem.waypoints
-            }
-            for v in problem.vehicles
-        }
+        subtour_u = [
+            [
+                model.addVar(vtype=gurobi.GRB.CONTINUOUS, lb=1, ub=num_waypoints,
+                             name=f'subtour_u_{compiled.vehicles[v], compiled.waypoints[j]}')
+                for j in waypoints
+            ]
+            for v in vehicles
+        ]
 
         # Sub-tour elimination constraint
         # Miller-Tucker-Zemlin formulation
         model.addConstrs((
-            subtour_u[v][j] - subtour_u[v][i] >= 1 - num_waypoints * (1 - x[v][i, j])
-            for v in problem.vehicles
-            for i, j in problem.trips
+            subtour_u[v][trip_target[ij]] - subtour_u[v][trip_origin[ij]] >=
+            1 - num_waypoints * (1 - x[v][ij])
+            for v in vehicles
+            for ij in trips
         ), name='3.3-1')
 
-        def _get_cargo_capacity(_vehicle):
-            capacity = problem.vehicle_params(_vehicle).cargo_capacity
-            return capacity if capacity is not None else gurobi.GRB.INFINITY
-
-        def _get_cargo_demand(_waypoint):
-            demand = problem.waypoint_params(_waypoint).cargo_demand
-            return demand
-
-        # Non-negative continuous decision variables
-        # The amount of cargo en route to waypoint
-        capacity_u = {
-            v: {
-                j: model.addVar(lb=0, ub=_get_cargo_capacity(v), name=f'capacity_u{v, j}')
-                for j in problem.waypoints
-            }
-            for v in problem.vehicles
-        }
-
-        # Cargo capacity constraints
-        # M-value is set to the sum of the absolute value of demands.
-        capacity_m = sum(abs(_get_cargo_demand(j)) for j in problem.waypoints)
-
-        # Cargo capacity constraints
-        # Conditional equality using Big-M formulation
-        model.addConstrs((
-            capacity_u[v][i] - capacity_u[v][j] <= _get_cargo_demand(j) + capacity_m * (
-                    1 - x[v][i, j])
-            for v in problem.vehicles
-            for i, j in problem.trips
-        ), name='3.4-1a')
-        model.addConstrs((
-            capacity_u[v][i] - capacity_u[v][j] >= _get_cargo_demand(j) - capacity_m * (
-                    1 - x[v][i, j])
-            for v in problem.vehicles
-            for i, j in problem.trips
-        ), name='3.4-1b')
-        model.addConstrs((
-            capacity_u[v][j] >= _get_cargo_demand(j)
-            for v in problem.vehicles
-            for j in problem.waypoints
-        ), name='3.4-1c')
-
-        def _get_earliest_arrival_time(_waypoint):
-            time = problem.waypoint_params(_waypoint).earliest_arrival_hour
-            return time if time is not None else -gurobi.GRB.INFINITY
-
-        def _get_latest_arrival_time(_waypoint):
-            time = problem.waypoint_params(_waypoint).latest_arrival_hour
-            return time if time is not None else gurobi.GRB.INFINITY
-
-        def _get_earliest_activity_time(_vehicle):
-            time = problem.vehicle_params(_vehicle).earliest_activity_hour
-            return time if time is not None else -gurobi.GRB.INFINITY
-
-        def _get_latest_activity_time(_vehicle):
-            time = problem.vehicle_params(_vehicle).latest_activity_hour
-            return time if time is not None else gurobi.GRB.INFINITY
-
-        def _get_dispatch_duration(_vehicle, _waypoint):
-            return problem.dispatch_params(_vehicle, _waypoint).duration_hours
-
-        def _get_recall_duration(_vehicle, _waypoint):
-            return problem.recall_params(_vehicle, _waypoint).duration_hours
-
-        def _get_trip_duration(_trip):
-            return problem.trip_params(_trip).duration_hours
-
-        def _get_waypoint_dwell(_waypoint):
-            return problem.waypoint_params(_waypoint).dwell_hours
-
-        # Continuous decision variables
-        # The time each vehicle arrives at waypoint j
-        time_u = {
-            v: {
-                j: model.addVar(
-                    lb=_get_earliest_arrival_time(j),
-                    ub=_get_latest_arrival_time(j),
-                    name=f'time_u{v, j}'
-                )
-                for j in problem.waypoints
-            }
-            for v in problem.vehicles
-        }
-
-        # Continuous decision variables
-        # The time each vehicle departs from the departing facility of its depot.
-        time_s = {
-            v: model.addVar(
-                lb=_get_earliest_activity_time(v),
-                ub=_get_latest_activity_time(v),
-                name=f'time_s{v}'
+    cargo_capacity = [
+        capacity if np.isfinite(capacity) else gurobi.GRB.INFINITY
+        for capacity in compiled.cargo_capacity.tolist()
+    ]
+    cargo_demand = compiled.cargo_demand.tolist()
+
+    # Non-negative continuous decision variables
+    # The amount of cargo en route to waypoint
+    capacity_u = [
+        [
+            model.addVar(lb=0, ub=cargo_capacity[v],
+                         name=f'capacity_u{compiled.vehicles[v], compiled.waypoints[j]}')
+            for j in waypoints
+        ]
+        for v in vehicles
+    ]
+
+    # Cargo capacity constraints
+    # M-values are set per trip from the range of cargo en route to its endpoints.
+    capacity_trip_upper = big_m.capacity_trip_upper.tolist()
+    capacity_trip_lower = big_m.capacity_trip_lower.tolist()
+
+    # Cargo capacity constraints
+    # Conditional equality using Big-M formulation
+    model.addConstrs((
+        capacity_u[v][trip_origin[ij]] - capacity_u[v][trip_target[ij]] <=
+        cargo_demand[trip_target[ij]] + capacity_trip_upper[v][ij] * (1 - x[v][ij])
+        for v in vehicles
+        for ij in trips
+    ), name='3.4-1a')
+    model.addConstrs((
+        capacity_u[v][trip_origin[ij]] - capacity_u[v][trip_target[ij]] >=
+        cargo_demand[trip_target[ij]] - capacity_trip_lower[v][ij] * (1 - x[v][ij])
+        for v in vehicles
+        for ij in trips
+    ), name='3.4-1b')
+    model.addConstrs((
+        capacity_u[v][j] >= cargo_demand[j]
+        for v in vehicles
+        for j in waypoints
+    ), name='3.4-1c')
+
+    def _as_gurobi_bounds(_times):
+        return np.clip(_times, -gurobi.GRB.INFINITY, gurobi.GRB.INFINITY).tolist()
+
+    earliest_arrival_time = _as_gurobi_bounds(big_m.arrival_lb)
+    latest_arrival_time = _as_gurobi_bounds(big_m.arrival_ub)
+    earliest_activity_time = _as_gurobi_bounds(compiled.earliest_activity)
+    latest_activity_time = _as_gurobi_bounds(compiled.latest_activity)
+
+    dispatch_duration = compiled.dispatch_duration.tolist()
+    recall_duration = compiled.recall_duration.tolist()
+    trip_duration = compiled.trip_duration.tolist()
+    waypoint_dwell = compiled.dwell.tolist()
+
+    # Continuous decision variables
+    # The time each vehicle arrives at waypoint j, within the time window of the waypoint and the
+    # activity window of the vehicle
+    time_u = [
+        [
+            model.addVar(
+                lb=earliest_arrival_time[v][j],
+                ub=latest_arrival_time[v][j],
+                name=f'time_u{compiled.vehicles[v], compiled.waypoints[j]}'
             )
-            for v in problem.vehicles
-        }
-
-        # Continuous decision variables
-        # The time each vehicle arrives at the arrival facility of its depot.
-        time_e = {
-            v: model.addVar(
-                lb=_get_earliest_activity_time(v),
-                ub=_get_latest_activity_time(v),
-                name=f'time_e{v}'
-            )
-            for v in problem.vehicles
-        }
-
-        # Time window constraints
-        # M-value is set to the sum of all the time delays.
-        time_m = (
-                sum(
-                    _get_dispatch_duration(v, j) + _get_recall_duration(v, j)
-                    for v in problem.vehicles
-                    for j in problem.waypoints
-                ) +
-                sum(_get_waypoint_dwell(j) for j in problem.waypoints) +
-                sum(_get_trip_duration(trip) for trip in problem.trips)
+            for j in waypoints
+        ]
+        for v in vehicles
+    ]
+
+    # Continuous decision variables
+    # The time each vehicle departs from the departing facility of its depot.
+    time_s = [
+        model.addVar(
+            lb=earliest_activity_time[v],
+            ub=latest_activity_time[v],
+            name=f'time_s{compiled.vehicles[v]}'
         )
-
-        # Time window constraints
-        # The time on each vehicle must update as more waypoints are traveled.
-        # Uses the Big-M formulation for conditional equality.
-        model.addConstrs((
-            time_u[v][j] - time_u[v][i] <=
-            _get_trip_duration((i, j)) + _get_waypoint_dwell(i) + time_m * (1 - x[v][i, j])
-
-            for v in problem.vehicles
-            for i, j in problem.trips
-        ), name='3.5-1a')
-
+        for v in vehicles
+    ]
+
+    # Continuous decision variables
+    # The time each vehicle arrives at the arrival facility of its depot.
+    time_e = [
+        model.addVar(
+            lb=earliest_activity_time[v],
+            ub=latest_activity_time[v],
+            name=f'time_e{compiled.vehicles[v]}'
+        )
+        for v in vehicles
+    ]
+
+    # Time window constraints
+    # M-values are set per row from the range of times of the variables in it.
+    time_trip_upper = big_m.time_trip_upper.tolist()
+    time_trip_lower = big_m.time_trip_lower.tolist()
+    time_dispatch_upper = big_m.time_dispatch_upper.tolist()
+    time_dispatch_lower = big_m.time_dispatch_lower.tolist()
+    time_recall_upper = big_m.time_recall_upper.tolist()
+    time_recall_lower = big_m.time_recall_lower.tolist()
+
+    # Time window constraints
+    # The time on each vehicle must update as more waypoints are traveled.
+    # Uses the Big-M formulation for conditional equality.
+    model.addConstrs((
+        time_u[v][trip_target[ij]] - time_u[v][trip_origin[ij]] <=
+        trip_duration[ij] + waypoint_dwell[trip_origin[ij]] +
+        time_trip_upper[v][ij] * (1 - x[v][ij])
+
+        for v in vehicles
+        for ij in trips
+    ), name='3.5-1a')
+
+    model.addConstrs((
+        time_u[v][trip_target[ij]] - time_u[v][trip_origin[ij]] >=
+        trip_duration[ij] + waypoint_dwell[trip_origin[ij]] -
+        time_trip_lower[v][ij] * (1 - x[v][ij])
+
+        for v in vehicles
+        for ij in trips
+    ), name='3.5-1b')
+
+    model.addConstrs((
+        time_u[v][j] - time_s[v] <=
+        dispatch_duration[v][j] + time_dispatch_upper[v][j] * (1 - x_dispatch[v][j])
+
+        for v in vehicles
+        for j in waypoints
+        if dispatch_allowed[v][j]
+    ), name='3.5-2a')
+
+    model.addConstrs((
+        time_u[v][j] - time_s[v] >=
+        dispatch_duration[v][j] - time_dispatch_lower[v][j] * (1 - x_dispatch[v][j])
+
+        for v in vehicles
+        for j in waypoints
+        if dispatch_allowed[v][j]
+    ), name='3.5-2b')
+
+    model.addConstrs((
+        time_e[v] - time_u[v][j] <=
+        recall_duration[v][j] + waypoint_dwell[j] +
+        time_recall_upper[v][j] * (1 - x_recall[v][j])
+
+        for v in vehicles
+        for j in waypoints
+        if recall_allowed[v][j]
+    ), name='3.5-3a')
+
+    model.addConstrs((
+        time_e[v] - time_u[v][j] >=
+        recall_duration[v][j] + waypoint_dwell[j] -
+        time_recall_lower[v][j] * (1 - x_recall[v][j])
+
+        for v in vehicles
+        for j in waypoints
+        if recall_allowed[v][j]
+    ), name='3.5-3b')
+
+    if symmetry_breaking:
+        earlier, later = compiled.interchangeable_vehicle_pairs()
+        vehicle_pairs = list(zip(earlier.tolist(), later.tolist()))
+
+        # Symmetry breaking constraint
+        # Interchangeable vehicles are used in order.
         model.addConstrs((
-            time_u[v][j] - time_u[v][i] >=
-            _get_trip_duration((i, j)) + _get_waypoint_dwell(i) - time_m * (1 - x[v][i, j])
-
-            for v in problem.vehicles
-            for i, j in problem.trips
-        ), name='3.5-1b')
+            gurobi.quicksum(x_dispatch[w][j] for j in waypoints) <=
+            gurobi.quicksum(x_dispatch[v][j] for j in waypoints)
+            for v, w in vehicle_pairs
+        ), name='3.6-1')
 
+        # Symmetry breaking constraint
+        # Used interchangeable vehicles are dispatched to waypoints in ascending index order.
         model.addConstrs((
-            time_u[v][j] - time_s[v] <=
-            _get_dispatch_duration(v, j) + time_m * (1 - x_dispatch[v][j])
+            gurobi.quicksum((j + 1) * x_dispatch[w][j] for j in waypoints) >=
+            gurobi.quicksum((j + 1) * x_dispatch[v][j] for j in waypoints) + 1 -
+            (num_waypoints + 1) * (1 - gurobi.quicksum(x_dispatch[w][j] for j in waypoints))
+            for v, w in vehicle_pairs
+        ), name='3.6-2')
+
+    trip_cost = compiled.trip_cost.tolist()
+    dispatch_cost = compiled.dispatch_cost.tolist()
+    recall_cost = compiled.recall_cost.tolist()
+
+    # Objective
+    # The objective is to minimize the cost of tours, dispatching, and returning all vehicles
+    # to all depots.
+    model.setObjective(
+        gurobi.quicksum(
+            trip_cost[ij] * x[v][ij]
+            for v in vehicles
+            for ij in trips
+        ) +
+        gurobi.quicksum(
+            dispatch_cost[v][j] * x_dispatch[v][j]
+            for v in vehicles
+            for j in waypoints
+        ) +
+        gurobi.quicksum(
+            recall_cost[v][j] * x_recall[v][j]
+            for v in vehicles
+            for j in waypoints
+        ) +
+
+        # Keep initial cargo as low as possible
+        gurobi.quicksum(
+            capacity_u[v][j]
+            for v in vehicles
+            for j in waypoints
+        ) +
+
+        # Keep dispatch time as late as possible
+        -gurobi.quicksum(
+            time_s[v]
+            for v in vehicles
+        )
+    )
+
+    return {
+        'x': x,
+        'x_dispatch': x_dispatch,
+        'x_recall': x_recall,
+        'capacity_u': capacity_u,
+        'time_u': time_u,
+        'time_s': time_s,
+        'time_e': time_e,
+    }
+
+
+def _build_matrix_model(model: gurobi.Model, compiled: CompiledProblem,
+                        subtour_elimination: str, symmetry_breaking: bool) -> dict:
+    formulation = MatrixFormulation(compiled, subtour_elimination=subtour_elimination,
+                                    symmetry_breaking=symmetry_breaking)
+    variables = model.addMVar(
+        formulation.num_vars,
+        lb=formulation.lb,
+        ub=formulation.ub,
+        obj=formulation.obj,
+        vtype=formulation.vtype,
+    )
+    for block in formulation.constraints:
+        model.addMConstr(block.matrix, variables, block.sense, block.rhs, name=block.name)
+
+    return {
+        name: variables[offset:offset + int(np.prod(shape))].reshape(shape)
+        for name, (offset, shape) in formulation.blocks.items()
+    }
+
+
+_model_builders = {
+    'expressions': _build_expression_model,
+    'matrix': _build_matrix_model,
+}
+
+_subtour_elimination_modes = ['mtz', 'lazy']
+
+
+class _LazySubtourCallback:
+    def __init__(self, compiled: CompiledProblem, x):
+        self._compiled = compiled
+
+        # Trip variables of each vehicle, whether built one by one or as an MVar
+        self._x = [list(x_v) for x_v in (x.tolist() if isinstance(x, gurobi.MVar) else x)]
+        self._flat_x = [var for x_v in self._x for var in x_v]
+
+    def __call__(self, model: gurobi.Model, where):
+        if where == gurobi.GRB.Callback.MIPSOL:
+            self.add_cuts(model)
+
+    def add_cuts(self, model: gurobi.Model) -> bool:
+        """
+        Cuts off the subtours of the integer solution Gurobi found
+        :param model: model in a MIPSOL callback
+        :return: whether the solution had subtours
+        """
+        compiled = self._compiled
+        x_values = np.reshape(model.cbGetSolution(self._flat_x), (compiled.num_vehicles, -1))
+        subtours = find_subtours(compiled, x_values > 0.5)
+        for subtour in subtours:
+            # Every waypoint is entered exactly once, so no vehicle may use as many trips between
+            # the waypoints of a subtour as there are waypoints in it.
+            in_subtour = np.zeros(compiled.num_waypoints, dtype=bool)
+            in_subtour[subtour] = True
+            arcs = np.nonzero(in_subtour[compiled.trip_origin] & in_subtour[compiled.trip_target])
+            model.cbLazy(
+                gurobi.quicksum(x_v[ij] for x_v in self._x for ij in arcs[0].tolist()) <=
+                len(subtour) - 1
+            )
+        return len(subtours) > 0
+
+
+class _IncumbentCallback:
+    def __init__(self, compiled: CompiledProblem, variables: dict,
+                 subtour_callback: _LazySubtourCallback | None,
+                 on_incumbent: Callable[[VehicleRoutingProblemSolution], None] | None,
+                 stop_event: threading.Event | None):
+        self._compiled = compiled
+        self._variables = variables
+        self._subtour_callback = subtour_callback
+        self._on_incumbent = on_incumbent
+        self._stop_event = stop_event
+        self._best_objective = np.inf
+
+    def __call__(self, model: gurobi.Model, where):
+        if self._stop_event is not None and self._stop_event.is_set():
+            model.terminate()
+            return
+
+        if where != gurobi.GRB.Callback.MIPSOL:
+            return
+
+        # Solutions cut off by lazy constraints never become incumbents
+        if self._subtour_callback is not None and self._subtour_callback.add_cuts(model):
+            return
+
+        objective = model.cbGet(gurobi.GRB.Callback.MIPSOL_OBJ)
+        if self._on_incumbent is None or objective >= self._best_objective:
+            return
+
+        self._best_objective = objective
+        values = {
+            name: _get_gurobi_variable_values(model, gurobi_vars, in_callback=True)
+            for name, gurobi_vars in self._variables.items()
+        }
+        self._on_incumbent(solution_from_values(self._compiled, values))
 
-            for v in problem.vehicles
-            for j in problem.waypoints
-        ), name='3.5-2a')
 
-        model.addConstrs((
-            time_u[v][j] - time_s[v] >=
-            _get_dispatch_duration(v, j) - time_m * (1 - x_dispatch[v][j])
+class GurobiTourPlanner:
+    def __init__(self, gurobi_params: Optional[dict] = None,
+                 infeasible_filename: str = 'infeasible.ilp',
+                 builder: str = 'expressions', subtour_elimination: str = 'mtz',
+                 symmetry_breaking: bool = True, warm_start: bool = True,
+                 time_limit_seconds: float | None = None, mip_gap: float | None = None):
+        if gurobi_params is None:
+            gurobi_params = dict()
 
-            for v in problem.vehicles
-            for j in problem.waypoints
-        ), name='3.5-2b')
+        if builder not in _model_builders:
+            raise ValueError(f'Unknown model builder {builder}.')
 
-        model.addConstrs((
-            time_e[v] - time_u[v][j] <=
-            _get_recall_duration(v, j) + _get_waypoint_dwell(j) + time_m * (1 - x_recall[v][j])
+        if subtour_elimination not in _subtour_elimination_modes:
+            raise ValueError(f'Unknown subtour elimination mode {subtour_elimination}.')
 
-            for v in problem.vehicles
-            for j in problem.waypoints
-        ), name='3.5-3a')
+        self._gurobi_params = gurobi_params
+        self._infeasible_filename = infeasible_filename
 
-        model.addConstrs((
-            time_e[v] - time_u[v][j] >=
-            _get_recall_duration(v, j) + _get_waypoint_dwell(j) - time_m * (1 - x_recall[v][j])
-
-            for v in problem.vehicles
-            for j in problem.waypoints
-        ), name='3.5-3b')
-
-        # Objective
-        # The objective is to minimize the cost of tours, dispatching, and returning all vehicles
-        # to all depots.
-        model.setObjective(
-            gurobi.quicksum(
-                problem.trip_params(ij).cost * x[v][ij]
-                for v in problem.vehicles
-                for ij in problem.trips
-            ) +
-            gurobi.quicksum(
-                problem.dispatch_params(v, j).cost * x_dispatch[v][j]
-                for v in problem.vehicles
-                for j in problem.waypoints
-            ) +
-            gurobi.quicksum(
-                problem.recall_params(v, j).cost * x_recall[v][j]
-                for v in problem.vehicles
-                for j in problem.waypoints
-            ) +
-
-            # Keep initial cargo as low as possible
-            gurobi.quicksum(
-                capacity_u[v][j]
-                for v in problem.vehicles
-                for j in problem.waypoints
-            ) +
-
-            # Keep dispatch time as late as possible
-            -gurobi.quicksum(
-                time_s[v]
-                for v in problem.vehicles
-            )
-        )
+        # The expression builder creates one Python expression per constraint. The matrix builder
+        # passes the same formulation to Gurobi as sparse matrices.
+        self._builder = builder
+
+        # Miller-Tucker-Zemlin constraints are part of the model. Lazy elimination leaves them out
+        # and cuts off subtours in the integer solutions Gurobi finds.
+        self._subtour_elimination = subtour_elimination
+
+        # Vehicles with equal parameters are ordered so that the solver does not explore their
+        # permutations. Solutions then map onto concrete vehicles as they are.
+        self._symmetry_breaking = symmetry_breaking
+
+        # Routes from a construction heuristic are passed to Gurobi as its first incumbent
+        self._warm_start = warm_start
+
+        # Solving stops once the wall-clock budget, counted from the start of model building,
+        # runs out or the relative gap target is met, returning the best solution found
+        self._time_limit_seconds = time_limit_seconds
+        self._mip_gap = mip_gap
+
+    def solve(self, problem: VehicleRoutingProblem,
+              on_incumbent: Callable[[VehicleRoutingProblemSolution], None] | None = None):
+        """
+        Plans tours, returning the best solution found when a limit stops Gurobi early
+        :param problem: problem to plan tours for
+        :param on_incumbent: called with each improved solution as Gurobi finds it
+        :return: the best solution found
+        """
+        return self._solve(problem, on_incumbent)
+
+    def iter_solutions(self, problem: VehicleRoutingProblem
+                       ) -> Iterator[VehicleRoutingProblemSolution]:
+        """
+        Plans tours in a background thread, yielding each improved solution as Gurobi finds it.
+        The last solution yielded is the best one found. Closing the iterator stops Gurobi.
+        :param problem: problem to plan tours for
+        :return: iterator of improving solutions
+        """
+        solutions = queue.Queue()
+        stop_event = threading.Event()
+        finished = object()
+        outcome = dict()
+
+        def _run():
+            try:
+                outcome['solution'] = self._solve(problem, solutions.put, stop_event)
+            except Exception as error:
+                outcome['error'] = error
+            finally:
+                solutions.put(finished)
+
+        thread = threading.Thread(target=_run, daemon=True)
+        thread.start()
+        yielded = False
+        try:
+            while (solution := solutions.get()) is not finished:
+                yielded = True
+                yield solution
+        finally:
+            stop_event.set()
+            thread.join()
+
+        if 'error' in outcome:
+            raise outcome['error']
+
+        # Gurobi may find its only solution without reporting it to the callback
+        if not yielded:
+            yield outcome['solution']
+
+    def _solve(self, problem: VehicleRoutingProblem,
+               on_incumbent: Callable[[VehicleRoutingProblemSolution], None] | None = None,
+               stop_event: threading.Event | None = None) -> VehicleRoutingProblemSolution:
+        start_time = time.monotonic()
+        compiled = CompiledProblem(problem)
+        model = gurobi.Model()
 
-        model.optimize()
-        if model.Status != gurobi.GRB.OPTIMAL:
-            model.computeIIS()
-            model.write(self._infeasible_filename)
-            raise RuntimeError(f'Model is infeasible.')
-
-        solution = VehicleRoutingProblemSolution(problem=problem)
-
-        # Scan for enabled trips
-        for vehicle in problem.vehicles:
-            for trip_start, trip_end in problem.trips:
-                if _is_gurobi_binary_variable_set(x[vehicle][trip_start, trip_end]):
-                    activity = TripActivity(
-                        cargo_level=_get_gurobi_variable_value(capacity_u[vehicle][trip_end]),
-                        cargo_to_drop_off=_get_cargo_demand(trip_end),
-                        scheduled_start_hour=(
-                                _get_gurobi_variable_value(time_u[vehicle][trip_start]) +
-                                _get_waypoint_dwell(trip_start)
-                        ),
-                        scheduled_end_hour=_get_gurobi_variable_value(time_u[vehicle][trip_end]),
-                    )
-                    solution.add_trip(vehicle, (trip_start, trip_end), activity)
-
-        # Scan for enabled dispatching edges
-        for vehicle in problem.vehicles:
-            for waypoint in problem.waypoints:
-                if _is_gurobi_binary_variable_set(x_dispatch[vehicle][waypoint]):
-                    activity = DispatchActivity(
-                        cargo_level=_get_gurobi_variable_value(capacity_u[vehicle][waypoint]),
-                        cargo_to_drop_off=_get_cargo_demand(waypoint),
-                        scheduled_start_hour=_get_gurobi_variable_value(time_s[vehicle]),
-                        scheduled_end_hour=_get_gurobi_variable_value(time_u[vehicle][waypoint])
-                    )
-                    solution.add_dispatch(vehicle, waypoint, activity)
-
-        # Scan for enabled recall edges
-        for vehicle in problem.vehicles:
-            for waypoint in problem.waypoints:
-                if _is_gurobi_binary_variable_set(x_recall[vehicle][waypoint]):
-                    activity = RecallActivity(
-                        cargo_level=(
-                                _get_gurobi_variable_value(capacity_u[vehicle][waypoint]) -
-                                _get_cargo_demand(waypoint)
-                        ),
-                        scheduled_start_hour=(
-                                _get_gurobi_variable_value(time_u[vehicle][waypoint]) +
-                                _get_waypoint_dwell(waypoint)
-                        ),
-                        scheduled_end_hour=_get_gurobi_variable_value(time_e[vehicle]),
-                    )
-                    solution.add_recall(vehicle, waypoint, activity)
-
-        return solution
+        # Set gurobi parameters on the model
+        for param, val in self._gurobi_params.items():
+            model.setParam(param, val)
+        if self._mip_gap is not None:
+            model.setParam('MIPGap', self._mip_gap)
+
+        variables = _model_builders[self._builder](
+            model, compiled, self._subtour_elimination, self._symmetry_breaking)
+
+        if self._warm_start:
+            evaluator = RouteEvaluator(compiled)
+            routes = insertion_routes(compiled)
+            if routes is not None:
+                start_values = route_values(compiled, routes, evaluator)
+                for name, values in start_values.items():
+                    _set_gurobi_start_values(model, variables[name], values)
+
+        subtour_callback = None
+        if self._subtour_elimination == 'lazy':
+            model.setParam('LazyConstraints', 1)
+            subtour_callback = _LazySubtourCallback(compiled, variables['x'])
+
+        callback = subtour_callback
+        if on_incumbent is not None or stop_event is not None:
+            callback = _IncumbentCallback(
+                compiled, variables, subtour_callback, on_incumbent, stop_event)
+
+        # Model building and warm starting count towards the time budget
+        if self._time_limit_seconds is not None:
+            elapsed_seconds = time.monotonic() - start_time
+            model.setParam('TimeLimit', max(self._time_limit_seconds - elapsed_seconds, 0))
+
+        model.optimize(callback)
+        if model.SolCount == 0:
+            if model.Status in (gurobi.GRB.INFEASIBLE, gurobi.GRB.INF_OR_UNBD):
+                model.computeIIS()
+                model.write(self._infeasible_filename)
+                raise RuntimeError(f'Model is infeasible.')
+            raise RuntimeError(
+                f'No solution found before Gurobi stopped with status {model.Status}.')
+
+        values = {
+            name: _get_gurobi_variable_values(model, gurobi_vars)
+            for name, gurobi_vars in variables.items()
+        }
+        return solution_from_values(compiled, values)
@@ -0,0 +1,161 @@
+import time
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+import scipy.sparse as sparse
+from scipy.optimize import Bounds
+from scipy.optimize import LinearConstraint
+from scipy.optimize import milp
+
+from ._compiled_problem import CompiledProblem
+from ._matrix_formulation import MatrixFormulation
+from ._problem_description import VehicleRoutingProblem
+from ._problem_description import VehicleRoutingProblemSolution
+from ._solution_values import solution_from_values
+from ._subtours import find_subtours
+
+_subtour_elimination_modes = ['mtz', 'lazy']
+
+# Statuses of scipy.optimize.milp
+_status_infeasible = 2
+
+
+def _row_bounds(sense: str, rhs: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    if sense == '<':
+        return np.full_like(rhs, -np.inf), rhs
+    if sense == '>':
+        return rhs, np.full_like(rhs, np.inf)
+    return rhs, rhs
+
+
+def _solve_problem(task) -> VehicleRoutingProblemSolution | None:
+    planner, problem = task
+    try:
+        return planner.solve(problem)
+    except RuntimeError:
+        return None
+
+
+class HiGHSTourPlanner:
+    """
+    Plans tours with the HiGHS solver shipped with SciPy
+
+    The model is the sparse matrix formulation GurobiTourPlanner builds with its matrix builder,
+    passed to scipy.optimize.milp. HiGHS needs no license, so any number of solves can run at
+    once, see solve_many. It takes no callbacks or starting solutions, so lazy subtour
+    elimination solves the model again with the subtours of each solution cut off until none
+    remain, and no warm start is given.
+    """
+
+    def __init__(self, highs_options: Optional[dict] = None, subtour_elimination: str = 'mtz',
+                 symmetry_breaking: bool = True, time_limit_seconds: float | None = None,
+                 mip_gap: float | None = None):
+        if highs_options is None:
+            highs_options = dict()
+
+        if subtour_elimination not in _subtour_elimination_modes:
+            raise ValueError(f'Unknown subtour elimination mode {subtour_elimination}.')
+
+        # Options of scipy.optimize.milp, such as disp and presolve
+        self._highs_options = highs_options
+
+        self._subtour_elimination = subtour_elimination
+        self._symmetry_breaking = symmetry_breaking
+
+        # Solving stops once the wall-clock budget, counted from the start of model building,
+        # runs out or the relative gap target is met, returning the best solution found
+        self._time_limit_seconds = time_limit_seconds
+        self._mip_gap = mip_gap
+
+    def solve(self, problem: VehicleRoutingProblem) -> VehicleRoutingProblemSolution:
+        """
+        Plans tours, returning the best solution found when a limit stops HiGHS early
+        :param problem: problem to plan tours for
+        :return: the best solution found
+        """
+        start_time = time.monotonic()
+        compiled = CompiledProblem(problem)
+        formulation = MatrixFormulation(compiled, subtour_elimination=self._subtour_elimination,
+                                        symmetry_breaking=self._symmetry_breaking)
+
+        matrices = [block.matrix for block in formulation.constraints]
+        row_lb, row_ub = zip(*(
+            _row_bounds(block.sense, block.rhs) for block in formulation.constraints
+        ))
+        row_lb, row_ub = list(row_lb), list(row_ub)
+        bounds = Bounds(formulation.lb, formulation.ub)
+        integrality = (formulation.vtype == 'B').astype(np.int64)
+        x_offset, x_shape = formulation.blocks['x']
+
+        options = dict(self._highs_options)
+        if self._mip_gap is not None:
+            options['mip_rel_gap'] = self._mip_gap
+
+        while True:
+            # Model building and earlier rounds of subtour elimination count towards the budget
+            if self._time_limit_seconds is not None:
+                elapsed_seconds = time.monotonic() - start_time
+                options['time_limit'] = max(self._time_limit_seconds - elapsed_seconds, 0)
+
+            result = milp(
+                formulation.obj,
+                integrality=integrality,
+                bounds=bounds,
+                constraints=LinearConstraint(
+                    sparse.vstack(matrices, format='csr'),
+                    np.concatenate(row_lb),
+                    np.concatenate(row_ub)
+                ),
+                options=options,
+            )
+            if result.x is None:
+                if result.status == _status_infeasible:
+                    raise RuntimeError('Model is infeasible.')
+                raise RuntimeError(
+                    f'No solution found before HiGHS stopped with status {result.status}: '
+                    f'{result.message}')
+
+            if self._subtour_elimination != 'lazy':
+                break
+
+            x_values = result.x[x_offset:x_offset + int(np.prod(x_shape))].reshape(x_shape)
+            subtours = find_subtours(compiled, x_values > 0.5)
+            if not subtours:
+                break
+            if result.status != 0:
+                raise RuntimeError(
+                    f'No solution without subtours found before HiGHS stopped with status '
+                    f'{result.status}: {result.message}')
+
+            # Every waypoint is entered exactly once, so no vehicle may use as many trips between
+            # the waypoints of a subtour as there are waypoints in it.
+            cuts = sparse.lil_matrix((len(subtours), formulation.num_vars))
+            vehicles = np.arange(compiled.num_vehicles)[:, None]
+            for row, subtour in enumerate(subtours):
+                in_subtour = np.zeros(compiled.num_waypoints, dtype=bool)
+                in_subtour[subtour] = True
+                arcs = np.flatnonzero(
+                    in_subtour[compiled.trip_origin] & in_subtour[compiled.trip_target])
+                cuts[row, formulation.column('x', vehicles, arcs[None, :]).ravel()] = 1
+            matrices.append(cuts.tocsr())
+            row_lb.append(np.full(len(subtours), -np.inf))
+            row_ub.append(np.array([len(subtour) - 1 for subtour in subtours], dtype=np.float64))
+
+        return solution_from_values(compiled, formulation.unpack(result.x))
+
+    def solve_many(self, problems: Iterable[VehicleRoutingProblem], workers: int | None = None
+                   ) -> list[VehicleRoutingProblemSolution | None]:
+        """
+        Plans tours for several problems in a process pool
+        :param problems: problems to plan tours for
+        :param workers: number of worker processes, as many as processors by default
+        :return: the solution of each problem, or None where no solution was found
+        """
+        tasks = [(self, problem) for problem in problems]
+        if workers is not None and workers <= 1:
+            return list(map(_solve_problem, tasks))
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_solve_problem, tasks))
@@ -0,0 +1,479 @@
+from collections.abc import Iterable
+from typing import Optional
+
+import gurobipy as gurobi
+import numpy as np
+
+from ._big_m import BigMConstants
+from ._compiled_problem import CompiledProblem
+from ._gurobi_delegate import _LazySubtourCallback
+from ._gurobi_delegate import _get_gurobi_variable_values
+from ._gurobi_delegate import _set_gurobi_start_values
+from ._insertion import InsertionSlots
+from ._problem_description import Trip
+from ._problem_description import Vehicle
+from ._problem_description import VehicleRoutingProblem
+from ._problem_description import VehicleRoutingProblemSolution
+from ._problem_description import Waypoint
+from ._problem_description import WaypointParams
+from ._route_schedule import RouteEvaluator
+from ._solution_values import route_values
+from ._solution_values import solution_from_values
+
+# Conditional equalities keyed by trips, and the BigMConstants attributes of their M-values
+_trip_rows = {
+    '3.4-1': ('capacity_trip_upper', 'capacity_trip_lower'),
+    '3.5-1': ('time_trip_upper', 'time_trip_lower'),
+}
+
+# Conditional equalities keyed by waypoints, and the BigMConstants attributes of their M-values
+_waypoint_rows = {
+    '3.5-2': ('time_dispatch_upper', 'time_dispatch_lower'),
+    '3.5-3': ('time_recall_upper', 'time_recall_lower'),
+}
+
+
+def _as_gurobi_bound(value: float) -> float:
+    return float(np.clip(value, -gurobi.GRB.INFINITY, gurobi.GRB.INFINITY))
+
+
+class IncrementalTourPlanner:
+    """
+    Re-plans the tours of a problem as waypoints are added, cancelled or executed
+
+    The Gurobi model of the problem is kept between solves. Adding waypoints routes only their
+    own trips, dispatches and recalls, and adds their variables and constraints to the model,
+    while cancelling waypoints removes them. Each solve starts from the routes of the last one,
+    with the waypoints not on them inserted at their cheapest feasible positions.
+
+    The model is the one built by GurobiTourPlanner, keyed by vehicles, waypoints and trips
+    rather than indices so that it survives changes to the problem. Subtours are eliminated
+    lazily, since the Miller-Tucker-Zemlin constraints depend on the number of waypoints, and
+    interchangeable vehicles are not ordered, since executed routes could contradict the order.
+    """
+
+    def __init__(self, problem: VehicleRoutingProblem, gurobi_params: Optional[dict] = None):
+        if gurobi_params is None:
+            gurobi_params = dict()
+
+        self._problem = problem
+        self._model = gurobi.Model()
+        for param, val in gurobi_params.items():
+            self._model.setParam(param, val)
+        self._model.setParam('LazyConstraints', 1)
+
+        # Variables and constraints by the vehicles, waypoints and trips they belong to
+        self._x: dict[tuple[Vehicle, Trip], gurobi.Var] = dict()
+        self._x_dispatch: dict[tuple[Vehicle, Waypoint], gurobi.Var] = dict()
+        self._x_recall: dict[tuple[Vehicle, Waypoint], gurobi.Var] = dict()
+        self._capacity_u: dict[tuple[Vehicle, Waypoint], gurobi.Var] = dict()
+        self._time_u: dict[tuple[Vehicle, Waypoint], gurobi.Var] = dict()
+        self._time_s: dict[Vehicle, gurobi.Var] = dict()
+        self._time_e: dict[Vehicle, gurobi.Var] = dict()
+        self._constrs: dict[tuple, gurobi.Constr] = dict()
+
+        # Binary variable, value and M-values of each conditional equality, kept to raise the
+        # M-values as the problem grows
+        self._conditionals: dict[tuple, tuple[gurobi.Var, float, float, float]] = dict()
+
+        # Waypoints visited by each vehicle in the last solution, the executed part of them, and
+        # the vehicles whose recall has started
+        self._solution: VehicleRoutingProblemSolution | None = None
+        self._routes: dict[Vehicle, list[Waypoint]] = {
+            vehicle: list() for vehicle in problem.vehicles
+        }
+        self._executed: dict[Vehicle, list[Waypoint]] = {
+            vehicle: list() for vehicle in problem.vehicles
+        }
+        self._returned: set[Vehicle] = set()
+
+        self._add_vehicles()
+        self._add_waypoints(list(problem.waypoints))
+
+    @property
+    def problem(self) -> VehicleRoutingProblem:
+        return self._problem
+
+    def add_waypoints(self, waypoint_params: Iterable[WaypointParams], batched=True,
+                      use_route_cache=True, workers: int | None = None, prune_arcs=True):
+        """
+        Adds waypoints to a problem whose trips have been planned
+        :param waypoint_params: params of the waypoints to add
+        :param batched: whether to route with one shortest path tree per distinct endpoint
+        :param use_route_cache: whether to read and write the persistent route cache
+        :param workers: number of routing processes
+        :param prune_arcs: whether to drop arcs that no schedule can use
+        """
+        waypoints = list()
+        for params in waypoint_params:
+            self._problem.add_waypoint(params.waypoint, params)
+            waypoints.append(params.waypoint)
+
+        self._problem.run_incremental_trip_planning(
+            waypoints, batched=batched, use_route_cache=use_route_cache, workers=workers,
+            prune_arcs=prune_arcs)
+        self._add_waypoints(waypoints)
+
+    def remove_waypoints(self, waypoints: Iterable[Waypoint]):
+        """
+        Cancels waypoints that have not been visited
+        :param waypoints: waypoints to remove
+        """
+        waypoints = list(dict.fromkeys(waypoints))
+        executed = {waypoint for route in self._executed.values() for waypoint in route}
+        for waypoint in waypoints:
+            if waypoint in executed:
+                raise ValueError(f'Cannot remove waypoint: Waypoint "{waypoint}" was visited.')
+
+        model = self._model
+        for waypoint in waypoints:
+            trips = list(dict.fromkeys(
+                (*self._problem.trips_from(waypoint), *self._problem.trips_to(waypoint))))
+
+            keys = [('3.2-2', waypoint)]
+            for vehicle in self._problem.vehicles:
+                keys.extend([('3.2-1', vehicle, waypoint), ('3.4-1c', vehicle, waypoint)])
+                keys.extend(
+                    (name + suffix, vehicle, trip)
+                    for name in _trip_rows for trip in trips for suffix in ('', 'a', 'b'))
+                keys.extend(
+                    (name + suffix, vehicle, waypoint)
+                    for name in _waypoint_rows for suffix in ('', 'a', 'b'))
+
+                model.remove([self._x.pop((vehicle, trip)) for trip in trips])
+                model.remove([
+                    self._x_dispatch.pop((vehicle, waypoint)),
+                    self._x_recall.pop((vehicle, waypoint)),
+                    self._capacity_u.pop((vehicle, waypoint)),
+                    self._time_u.pop((vehicle, waypoint)),
+                ])
+
+            model.remove([self._constrs.pop(key) for key in keys if key in self._constrs])
+            for key in keys:
+                self._conditionals.pop(key, None)
+
+            self._problem.remove_waypoint(waypoint)
+            for route in self._routes.values():
+                if waypoint in route:
+                    route.remove(waypoint)
+
+    def fix_executed(self, hour: float):
+        """
+        Fixes the dispatches, trips and recalls of the last solution started by an hour
+        :param hour: current hour
+        """
+        if self._solution is None:
+            raise ValueError('Cannot fix executed activities: No solution has been found.')
+
+        solution = self._solution
+        for vehicle in self._problem.vehicles:
+            dispatch = solution.dispatch_activity(vehicle)
+            if dispatch is None or dispatch.scheduled_start_hour > hour:
+                continue
+
+            waypoint = dispatch.params.target
+            executed = [waypoint]
+            self._fix(self._x_dispatch[vehicle, waypoint], 1)
+            self._fix(self._time_s[vehicle], dispatch.scheduled_start_hour)
+            self._fix(self._time_u[vehicle, waypoint], dispatch.scheduled_end_hour)
+
+            for activity in solution.trip_activities(vehicle):
+                if activity.scheduled_start_hour > hour:
+                    break
+                trip = activity.params.origin, activity.params.target
+                executed.append(trip[1])
+                self._fix(self._x[vehicle, trip], 1)
+                self._fix(self._time_u[vehicle, trip[1]], activity.scheduled_end_hour)
+            else:
+                recall = solution.recall_activity(vehicle)
+                if recall.scheduled_start_hour <= hour:
+                    self._fix(self._x_recall[vehicle, recall.params.origin], 1)
+                    self._fix(self._time_e[vehicle], recall.scheduled_end_hour)
+                    self._returned.add(vehicle)
+
+            self._executed[vehicle] = executed
+
+    def solve(self) -> VehicleRoutingProblemSolution:
+        """
+        Plans tours, starting from the routes of the last solution
+        :return: the best solution found
+        """
+        model = self._model
+        compiled = CompiledProblem(self._problem)
+        variables = {
+            'x': [
+                [self._x[vehicle, trip] for trip in compiled.trips]
+                for vehicle in compiled.vehicles
+            ],
+            'x_dispatch': self._by_vehicle_and_waypoint(compiled, self._x_dispatch),
+            'x_recall': self._by_vehicle_and_waypoint(compiled, self._x_recall),
+            'capacity_u': self._by_vehicle_and_waypoint(compiled, self._capacity_u),
+            'time_u': self._by_vehicle_and_waypoint(compiled, self._time_u),
+            'time_s': [self._time_s[vehicle] for vehicle in compiled.vehicles],
+            'time_e': [self._time_e[vehicle] for vehicle in compiled.vehicles],
+        }
+
+        routes = self._start_routes(compiled)
+        if routes is not None:
+            start_values = route_values(compiled, routes, RouteEvaluator(compiled))
+
+            # Schedules of vehicles under way are fixed, so Gurobi completes their times
+            for v, vehicle in enumerate(compiled.vehicles):
+                if self._executed[vehicle]:
+                    start_values['time_u'][v] = np.nan
+                    start_values['time_s'][v] = np.nan
+                    start_values['time_e'][v] = np.nan
+
+            for name, values in start_values.items():
+                _set_gurobi_start_values(model, variables[name], values)
+
+        model.optimize(_LazySubtourCallback(compiled, variables['x']))
+        if model.SolCount == 0:
+            if model.Status in (gurobi.GRB.INFEASIBLE, gurobi.GRB.INF_OR_UNBD):
+                raise RuntimeError('Model is infeasible.')
+            raise RuntimeError(
+                f'No solution found before Gurobi stopped with status {model.Status}.')
+
+        values = {
+            name: _get_gurobi_variable_values(model, gurobi_vars)
+            for name, gurobi_vars in variables.items()
+        }
+        solution = solution_from_values(compiled, values)
+        for vehicle in compiled.vehicles:
+            dispatch = solution.dispatch_activity(vehicle)
+            self._routes[vehicle] = list() if dispatch is None else [dispatch.params.target] + [
+                activity.params.target for activity in solution.trip_activities(vehicle)
+            ]
+
+        self._solution = solution
+        return solution
+
+    @staticmethod
+    def _fix(var: gurobi.Var, value: float):
+        var.LB = value
+        var.UB = value
+
+    @staticmethod
+    def _by_vehicle_and_waypoint(compiled: CompiledProblem, variables: dict) -> list:
+        return [
+            [variables[vehicle, waypoint] for waypoint in compiled.waypoints]
+            for vehicle in compiled.vehicles
+        ]
+
+    def _start_routes(self, compiled: CompiledProblem) -> list[list[int]] | None:
+        # Routes that cancellations made infeasible are cut back to their executed part
+        evaluator = RouteEvaluator(compiled)
+        routes = list()
+        for v, vehicle in enumerate(compiled.vehicles):
+            route = [compiled.waypoint_index[waypoint] for waypoint in self._routes[vehicle]]
+            if route and evaluator.schedule(v, route) is None:
+                route = [compiled.waypoint_index[waypoint] for waypoint in self._executed[vehicle]]
+                if route and evaluator.schedule(v, route) is None:
+                    return None
+            routes.append(route)
+
+        # Waypoints not on the routes are inserted after their executed part, earliest deadline
+        # first, and never into the routes of vehicles on their way back
+        min_position = np.array([
+            np.inf if vehicle in self._returned else len(self._executed[vehicle])
+            for vehicle in compiled.vehicles
+        ])
+        slots = InsertionSlots(compiled, routes)
+        visited = {j for route in routes for j in route}
+        pending = [j for j in range(compiled.num_waypoints) if j not in visited]
+        for j in sorted(pending, key=lambda _j: compiled.latest_arrival[_j]):
+            costs = np.where(
+                slots.slot_position >= min_position[slots.slot_vehicle], slots.costs(j), np.inf)
+            slot = int(np.argmin(costs))
+            if not np.isfinite(costs[slot]):
+                return None
+            slots.insert(j, slot)
+        return routes
+
+    def _add_vehicles(self):
+        model = self._model
+        for vehicle in self._problem.vehicles:
+            params = self._problem.vehicle_params(vehicle)
+            earliest = _as_gurobi_bound(
+                -np.inf if params.earliest_activity_hour is None else params.earliest_activity_hour)
+            latest = _as_gurobi_bound(
+                np.inf if params.latest_activity_hour is None else params.latest_activity_hour)
+
+            # Keep dispatch time as late as possible
+            self._time_s[vehicle] = model.addVar(
+                lb=earliest, ub=latest, obj=-1, name=f'time_s{vehicle}')
+            self._time_e[vehicle] = model.addVar(lb=earliest, ub=latest, name=f'time_e{vehicle}')
+
+            # A vehicle can be dispatched to and recalled from at most one waypoint. Dispatches
+            # and recalls join these rows as waypoints are added.
+            self._constrs['3.2-3a', vehicle] = model.addConstr(
+                gurobi.LinExpr() <= 1, name=f'3.2-3a[{vehicle}]')
+            self._constrs['3.2-3b', vehicle] = model.addConstr(
+                gurobi.LinExpr() <= 1, name=f'3.2-3b[{vehicle}]')
+
+    def _add_waypoints(self, waypoints: list[Waypoint]):
+        model = self._model
+        problem = self._problem
+        compiled = CompiledProblem(problem)
+        big_m = BigMConstants(compiled)
+
+        added = set(waypoints)
+        trips = list(dict.fromkeys(
+            trip
+            for waypoint in waypoints
+            for trip in (*problem.trips_from(waypoint), *problem.trips_to(waypoint))
+        ))
+
+        for v, vehicle in enumerate(compiled.vehicles):
+            capacity = _as_gurobi_bound(compiled.cargo_capacity[v])
+            for waypoint in waypoints:
+                j = compiled.waypoint_index[waypoint]
+                self._x_dispatch[vehicle, waypoint] = model.addVar(
+                    vtype=gurobi.GRB.BINARY, ub=int(big_m.dispatch_allowed[v, j]),
+                    obj=compiled.dispatch_cost[v, j], name=f'x_{vehicle, waypoint}')
+                self._x_recall[vehicle, waypoint] = model.addVar(
+                    vtype=gurobi.GRB.BINARY, ub=int(big_m.recall_allowed[v, j]),
+                    obj=compiled.recall_cost[v, j], name=f'x_{waypoint, vehicle}')
+
+                # Keep initial cargo as low as possible
+                self._capacity_u[vehicle, waypoint] = model.addVar(
+                    lb=0, ub=capacity, obj=1, name=f'capacity_u{vehicle, waypoint}')
+                self._time_u[vehicle, waypoint] = model.addVar(
+                    lb=_as_gurobi_bound(big_m.arrival_lb[v, j]),
+                    ub=_as_gurobi_bound(big_m.arrival_ub[v, j]),
+                    name=f'time_u{vehicle, waypoint}')
+
+            for trip in trips:
+                ij = compiled.trip_index[
+                    compiled.waypoint_index[trip[0]], compiled.waypoint_index[trip[1]]]
+                self._x[vehicle, trip] = model.addVar(
+                    vtype=gurobi.GRB.BINARY, ub=int(big_m.trip_allowed[v, ij]),
+                    obj=compiled.trip_cost[ij], name=f'x_{trip}')
+        model.update()
+
+        # Rows falling back to the global M-values of the model need larger ones as it grows
+        self._raise_big_m(compiled, big_m)
+
+        for v, vehicle in enumerate(compiled.vehicles):
+            for waypoint in waypoints:
+                self._add_waypoint_constraints(compiled, big_m, v, waypoint)
+            for trip in trips:
+                self._add_trip_constraints(compiled, big_m, v, trip)
+
+            # Added dispatches, recalls and trips join the flow control rows already in the model
+            for waypoint in waypoints:
+                model.chgCoeff(
+                    self._constrs['3.2-3a', vehicle], self._x_dispatch[vehicle, waypoint], 1)
+                model.chgCoeff(
+                    self._constrs['3.2-3b', vehicle], self._x_recall[vehicle, waypoint], 1)
+            for trip in trips:
+                origin, target = trip
+                if origin not in added:
+                    model.chgCoeff(
+                        self._constrs['3.2-1', vehicle, origin], self._x[vehicle, trip], -1)
+                if target not in added:
+                    model.chgCoeff(
+                        self._constrs['3.2-1', vehicle, target], self._x[vehicle, trip], 1)
+                    model.chgCoeff(self._constrs['3.2-2', target], self._x[vehicle, trip], 1)
+
+        for waypoint in waypoints:
+            # A waypoint must be visited once.
+            self._constrs['3.2-2', waypoint] = model.addConstr(
+                gurobi.quicksum(
+                    self._x_dispatch[vehicle, waypoint] +
+                    gurobi.quicksum(self._x[vehicle, trip] for trip in problem.trips_to(waypoint))
+                    for vehicle in problem.vehicles
+                ) == 1,
+                name=f'3.2-2[{waypoint}]'
+            )
+
+    def _add_waypoint_constraints(self, compiled: CompiledProblem, big_m: BigMConstants, v: int,
+                                  waypoint: Waypoint):
+        model = self._model
+        problem = self._problem
+        vehicle = compiled.vehicles[v]
+        j = compiled.waypoint_index[waypoint]
+        time_u = self._time_u[vehicle, waypoint]
+
+        # A vehicle that enters a waypoint must exit it.
+        self._constrs['3.2-1', vehicle, waypoint] = model.addConstr(
+            self._x_dispatch[vehicle, waypoint] +
+            gurobi.quicksum(self._x[vehicle, trip] for trip in problem.trips_to(waypoint)) ==
+            self._x_recall[vehicle, waypoint] +
+            gurobi.quicksum(self._x[vehicle, trip] for trip in problem.trips_from(waypoint)),
+            name=f'3.2-1[{vehicle},{waypoint}]'
+        )
+        self._constrs['3.4-1c', vehicle, waypoint] = model.addConstr(
+            self._capacity_u[vehicle, waypoint] >= compiled.cargo_demand[j],
+            name=f'3.4-1c[{vehicle},{waypoint}]'
+        )
+
+        if big_m.dispatch_allowed[v, j]:
+            self._add_conditional_equality(
+                ('3.5-2', vehicle, waypoint), time_u - self._time_s[vehicle],
+                self._x_dispatch[vehicle, waypoint], compiled.dispatch_duration[v, j],
+                big_m.time_dispatch_upper[v, j], big_m.time_dispatch_lower[v, j])
+
+        if big_m.recall_allowed[v, j]:
+            self._add_conditional_equality(
+                ('3.5-3', vehicle, waypoint), self._time_e[vehicle] - time_u,
+                self._x_recall[vehicle, waypoint],
+                compiled.recall_duration[v, j] + compiled.dwell[j],
+                big_m.time_recall_upper[v, j], big_m.time_recall_lower[v, j])
+
+    def _add_trip_constraints(self, compiled: CompiledProblem, big_m: BigMConstants, v: int,
+                              trip: Trip):
+        vehicle = compiled.vehicles[v]
+        origin, target = trip
+        i, j = compiled.waypoint_index[origin], compiled.waypoint_index[target]
+        ij = compiled.trip_index[i, j]
+        x = self._x[vehicle, trip]
+
+        self._add_conditional_equality(
+            ('3.4-1', vehicle, trip),
+            self._capacity_u[vehicle, origin] - self._capacity_u[vehicle, target], x,
+            compiled.cargo_demand[j],
+            big_m.capacity_trip_upper[v, ij], big_m.capacity_trip_lower[v, ij])
+        self._add_conditional_equality(
+            ('3.5-1', vehicle, trip),
+            self._time_u[vehicle, target] - self._time_u[vehicle, origin], x,
+            compiled.trip_duration[ij] + compiled.dwell[i],
+            big_m.time_trip_upper[v, ij], big_m.time_trip_lower[v, ij])
+
+    def _add_conditional_equality(self, key: tuple, expr: gurobi.LinExpr, x: gurobi.Var,
+                                  value: float, upper_m: float, lower_m: float):
+        # Conditional equality using the Big-M formulation, with the binary variable moved to
+        # the left so that its M-value is a single coefficient
+        name, vehicle, item = key
+        self._constrs[name + 'a', vehicle, item] = self._model.addConstr(
+            expr + upper_m * x <= value + upper_m, name=f'{name}a[{vehicle},{item}]')
+        self._constrs[name + 'b', vehicle, item] = self._model.addConstr(
+            expr - lower_m * x >= value - lower_m, name=f'{name}b[{vehicle},{item}]')
+        self._conditionals[key] = x, value, upper_m, lower_m
+
+    def _raise_big_m(self, compiled: CompiledProblem, big_m: BigMConstants):
+        model = self._model
+        for key, (x, value, upper_m, lower_m) in self._conditionals.items():
+            name, vehicle, item = key
+            v = compiled.vehicle_index[vehicle]
+            if name in _trip_rows:
+                upper_attribute, lower_attribute = _trip_rows[name]
+                index = compiled.trip_index[
+                    compiled.waypoint_index[item[0]], compiled.waypoint_index[item[1]]]
+            else:
+                upper_attribute, lower_attribute = _waypoint_rows[name]
+                index = compiled.waypoint_index[item]
+
+            # M-values only grow, so rows stay valid for every waypoint added so far
+            new_upper_m = max(upper_m, getattr(big_m, upper_attribute)[v, index])
+            new_lower_m = max(lower_m, getattr(big_m, lower_attribute)[v, index])
+            if new_upper_m == upper_m and new_lower_m == lower_m:
+                continue
+
+            upper_row = self._constrs[name + 'a', vehicle, item]
+            model.chgCoeff(upper_row, x, new_upper_m)
+            upper_row.RHS = value + new_upper_m
+            lower_row = self._constrs[name + 'b', vehicle, item]
+            model.chgCoeff(lower_row, x, -new_lower_m)
+            lower_row.RHS = value - new_lower_m
+            self._conditionals[key] = x, value, new_upper_m, new_lower_m
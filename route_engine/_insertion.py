@@ -0,0 +1,195 @@
+import numpy as np
+
+from ._compiled_problem import CompiledProblem
+
+# Arrays describing the positions at which a waypoint can be inserted into one route. Position p
+# inserts before the p-th waypoint of the route, so a route of n waypoints has n + 1 positions.
+# Times are offsets from the dispatch time. Cargo sums are cumulative demands along the route.
+#
+# prev, next:           Waypoints around the position, or -1 for the depot.
+# leave_prev:           Offset at which the vehicle leaves the previous waypoint.
+# next_offset:          Offset of arrival at the next waypoint.
+# link_cost:            Cost of the trip, dispatch or recall spanning the position.
+# total:                Offset of the return to the depot.
+# prefix_earliest:      Earliest dispatch time fitting the windows before the position.
+# prefix_latest:        Latest dispatch time fitting the windows before the position.
+# suffix_earliest:      Earliest dispatch time fitting the windows after the position.
+# suffix_latest:        Latest dispatch time fitting the windows after the position.
+# demand_before:        Cumulative demand before the position.
+# prefix_need:          Cargo needed at dispatch for the waypoints before the position.
+# prefix_slack:         Smallest cumulative demand before the position.
+# suffix_need:          Cargo needed at dispatch for the waypoints after the position.
+# suffix_slack:         Smallest cumulative demand after the position.
+_slot_fields = [
+    'prev', 'next', 'leave_prev', 'next_offset', 'link_cost', 'total',
+    'prefix_earliest', 'prefix_latest', 'suffix_earliest', 'suffix_latest',
+    'demand_before', 'prefix_need', 'prefix_slack', 'suffix_need', 'suffix_slack',
+]
+
+_tolerance = 1e-9
+
+
+def _prefix(initial, values, accumulate):
+    return accumulate(np.concatenate([[initial], values]))
+
+
+def _suffix(final, values, accumulate):
+    return accumulate(np.concatenate([values, [final]])[::-1])[::-1]
+
+
+class InsertionSlots:
+    """
+    Every position at which a waypoint can be inserted into a set of routes
+
+    Insertion costs and feasibility are evaluated for all positions at once from per-route
+    prefix and suffix bounds, so checking a candidate does not walk the routes.
+    """
+
+    def __init__(self, compiled: CompiledProblem, routes: list[list[int]]):
+        self.compiled = compiled
+        self.routes = routes
+
+        # Dense trip matrices, infinite between waypoints without a trip
+        num_waypoints = compiled.num_waypoints
+        self.trip_cost = np.full((num_waypoints, num_waypoints), np.inf)
+        self.trip_cost[compiled.trip_origin, compiled.trip_target] = compiled.trip_cost
+        self.trip_duration = np.full((num_waypoints, num_waypoints), np.inf)
+        self.trip_duration[compiled.trip_origin, compiled.trip_target] = compiled.trip_duration
+
+        # Dispatch and recall costs, infinite where trip planning pruned them
+        self.dispatch_cost = np.where(compiled.dispatch_allowed, compiled.dispatch_cost, np.inf)
+        self.recall_cost = np.where(compiled.recall_allowed, compiled.recall_cost, np.inf)
+
+        self._route_slots = [self._slots_of(v) for v in range(compiled.num_vehicles)]
+        self._stack()
+
+    def _slots_of(self, v: int) -> dict[str, np.ndarray]:
+        compiled = self.compiled
+        route = np.array(self.routes[v], dtype=np.int64)
+        none = np.array([-1], dtype=np.int64)
+
+        if len(route) == 0:
+            offsets = np.zeros(0)
+            link_cost = np.zeros(1)
+            total = 0.0
+        else:
+            steps = self.trip_duration[route[:-1], route[1:]] + compiled.dwell[route[:-1]]
+            offsets = np.concatenate([[0], np.cumsum(steps)])
+            offsets += compiled.dispatch_duration[v, route[0]]
+            link_cost = np.concatenate([
+                [self.dispatch_cost[v, route[0]]],
+                self.trip_cost[route[:-1], route[1:]],
+                [self.recall_cost[v, route[-1]]],
+            ])
+            total = offsets[-1] + compiled.dwell[route[-1]] + compiled.recall_duration[v, route[-1]]
+
+        earliest = compiled.earliest_arrival[route] - offsets
+        latest = compiled.latest_arrival[route] - offsets
+        demand = compiled.cargo_demand[route]
+        cumulative_demand = np.cumsum(demand)
+        need = cumulative_demand + np.maximum(demand, 0)
+
+        return {
+            'prev': np.concatenate([none, route]),
+            'next': np.concatenate([route, none]),
+            'leave_prev': np.concatenate([[0], offsets + compiled.dwell[route]]),
+            'next_offset': np.concatenate([offsets, [0]]),
+            'link_cost': link_cost,
+            'total': np.full(len(route) + 1, total),
+            'prefix_earliest': _prefix(compiled.earliest_activity[v], earliest,
+                                       np.maximum.accumulate),
+            'prefix_latest': _prefix(compiled.latest_activity[v], latest, np.minimum.accumulate),
+            'suffix_earliest': _suffix(-np.inf, earliest, np.maximum.accumulate),
+            'suffix_latest': _suffix(np.inf, latest, np.minimum.accumulate),
+            'demand_before': np.concatenate([[0], cumulative_demand]),
+            'prefix_need': _prefix(-np.inf, need, np.maximum.accumulate),
+            'prefix_slack': _prefix(np.inf, cumulative_demand, np.minimum.accumulate),
+            'suffix_need': _suffix(-np.inf, need, np.maximum.accumulate),
+            'suffix_slack': _suffix(np.inf, cumulative_demand, np.minimum.accumulate),
+        }
+
+    def _stack(self):
+        self.slots = {
+            field: np.concatenate([slots[field] for slots in self._route_slots])
+            for field in _slot_fields
+        }
+
+        sizes = [len(route) + 1 for route in self.routes]
+        self.route_offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+        self.slot_vehicle = np.repeat(np.arange(len(self.routes)), sizes)
+        self.slot_position = (
+                np.arange(len(self.slot_vehicle)) - self.route_offsets[self.slot_vehicle])
+
+    def update(self, vehicles):
+        for v in vehicles:
+            self._route_slots[v] = self._slots_of(v)
+        self._stack()
+
+    def costs(self, j: int) -> np.ndarray:
+        """
+        Added cost of inserting a waypoint at every position
+        :param j: waypoint index
+        :return: added cost of each position, infinite where the insertion is infeasible
+        """
+        compiled = self.compiled
+        slots = self.slots
+        vehicle = self.slot_vehicle
+        has_prev = slots['prev'] >= 0
+        has_next = slots['next'] >= 0
+        prev = np.where(has_prev, slots['prev'], 0)
+        after = np.where(has_next, slots['next'], 0)
+
+        with np.errstate(invalid='ignore'):
+            offset = np.where(
+                has_prev,
+                slots['leave_prev'] + self.trip_duration[prev, j],
+                compiled.dispatch_duration[vehicle, j]
+            )
+            leave = offset + compiled.dwell[j]
+            delta = np.where(
+                has_next, leave + self.trip_duration[j, after] - slots['next_offset'], 0)
+            total = np.where(
+                has_next, slots['total'] + delta, leave + compiled.recall_duration[vehicle, j])
+
+            earliest = np.maximum.reduce([
+                slots['prefix_earliest'],
+                np.full_like(offset, compiled.earliest_arrival[j]) - offset,
+                slots['suffix_earliest'] - delta,
+            ])
+            latest = np.minimum.reduce([
+                slots['prefix_latest'],
+                np.full_like(offset, compiled.latest_arrival[j]) - offset,
+                slots['suffix_latest'] - delta,
+                compiled.latest_activity[vehicle] - total,
+            ])
+
+            demand = compiled.cargo_demand[j]
+            demand_at = slots['demand_before'] + demand
+            need = np.maximum.reduce([
+                slots['prefix_need'],
+                demand_at + max(demand, 0),
+                slots['suffix_need'] + demand,
+            ])
+            slack = np.minimum.reduce([
+                slots['prefix_slack'],
+                demand_at,
+                slots['suffix_slack'] + demand,
+            ])
+
+            cost_in = np.where(
+                has_prev, self.trip_cost[prev, j], self.dispatch_cost[vehicle, j])
+            cost_out = np.where(
+                has_next, self.trip_cost[j, after], self.recall_cost[vehicle, j])
+            cost = cost_in + cost_out - slots['link_cost']
+
+            feasible = (
+                    np.isfinite(cost) &
+                    (earliest <= latest + _tolerance) &
+                    (need <= compiled.cargo_capacity[vehicle] + slack + _tolerance)
+            )
+        return np.where(feasible, cost, np.inf)
+
+    def insert(self, j: int, slot: int):
+        v = int(self.slot_vehicle[slot])
+        self.routes[v].insert(int(self.slot_position[slot]), j)
+        self.update([v])
@@ -3,8 +3,8 @@ from collections.abc import Hashable
 from collections.abc import Iterable
 from typing import Any
 
-from gis_backend.query_provider import get_node_near_address
-from gis_backend.query_provider import get_node_near_coord
+from gis_backend.query_provider import get_nodes_near_coords
+from gis_backend.query_provider import get_nodes_near_addresses
 from ._problem_description import VehicleParams
 from ._problem_description import VehicleRoutingProblem
 from ._problem_description import WaypointParams
@@ -43,18 +43,26 @@ class JSONStorageProvider:
         vehicle_model_data_by_id = _reindex_by_primary_key(vehicle_model_json, key='id')
         stop_data_by_id = _reindex_by_primary_key(stop_json, key='id')
 
+        # Resolve every distinct address of the problem in one batch
+        recall_address = '303 Ashe Ave Raleigh, NC 27606 United States'
+        nodes_near_addresses = get_nodes_near_addresses(
+            {stop_data['address'] for stop_data in stop_data_by_id.values()} | {recall_address}
+        )
+
+        # Snap every depot in one batch
+        dispatch_nodes = get_nodes_near_coords(
+            lats=[depot_data['latitude'] for depot_data in depot_data_by_id.values()],
+            longs=[depot_data['longitude'] for depot_data in depot_data_by_id.values()]
+        )
+
         # Fixup depot data fields
-        for depot_id, depot_data in depot_data_by_id.items():
-            depot_data['dispatch_osm_node'] = get_node_near_coord(
-                lat=depot_data['latitude'],
-                long=depot_data['longitude']
-            )
-            depot_data['recall_osm_node'] = get_node_near_address(
-                '303 Ashe Ave Raleigh, NC 27606 United States')
+        for depot_data, dispatch_node in zip(depot_data_by_id.values(), dispatch_nodes):
+            depot_data['dispatch_osm_node'] = dispatch_node
+            depot_data['recall_osm_node'] = nodes_near_addresses[recall_address]
 
         # Fixup stop data fields
         for stop_id, stop_data in stop_data_by_id.items():
-            stop_data['osm_node'] = get_node_near_address(stop_data['address'])
+            stop_data['osm_node'] = nodes_near_addresses[stop_data['address']]
 
         # Construct problem
         problem = VehicleRoutingProblem()
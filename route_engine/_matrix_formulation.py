@@ -0,0 +1,295 @@
+from dataclasses import dataclass
+
+import numpy as np
+import scipy.sparse as sparse
+
+from ._big_m import BigMConstants
+from ._compiled_problem import CompiledProblem
+
+
+@dataclass
+class ConstraintBlock:
+    name: str
+    matrix: sparse.csr_matrix
+    sense: str
+    rhs: np.ndarray
+
+
+class _RowBuilder:
+    def __init__(self, num_rows: int):
+        self.num_rows = num_rows
+        self._rows = list()
+        self._cols = list()
+        self._vals = list()
+
+    def add(self, rows, cols, vals):
+        rows, cols, vals = np.broadcast_arrays(rows, cols, vals)
+        self._rows.append(rows.ravel())
+        self._cols.append(cols.ravel())
+        self._vals.append(vals.ravel().astype(np.float64))
+
+    def matrix(self, num_cols: int) -> sparse.csr_matrix:
+        return sparse.csr_matrix(
+            (np.concatenate(self._vals), (np.concatenate(self._rows), np.concatenate(self._cols))),
+            shape=(self.num_rows, num_cols)
+        )
+
+
+class MatrixFormulation:
+    """
+    The tour planning model as a sparse matrix program
+
+    All variables live in one vector made of named blocks, each shaped by vehicle and waypoint
+    or vehicle and trip index. Constraint blocks keep the names of the expression-built model.
+    Miller-Tucker-Zemlin subtour elimination is left out unless subtour_elimination is 'mtz'.
+    Conditional equalities use the per-row constants of BigMConstants.
+    """
+
+    def __init__(self, compiled: CompiledProblem, subtour_elimination='mtz',
+                 symmetry_breaking=True):
+        self.compiled = compiled
+        self.big_m = big_m = BigMConstants(compiled)
+
+        num_vehicles = compiled.num_vehicles
+        num_waypoints = compiled.num_waypoints
+        num_trips = compiled.num_trips
+
+        self.num_vars = 0
+        self.blocks: dict[str, tuple[int, tuple[int, ...]]] = dict()
+        self._lb = list()
+        self._ub = list()
+        self._obj = list()
+        self._vtype = list()
+        self.constraints: list[ConstraintBlock] = list()
+
+        vehicle_by_waypoint = (num_vehicles, num_waypoints)
+        vehicle_by_trip = (num_vehicles, num_trips)
+
+        # Binary decision variables for trips, dispatching and recalls
+        self._add_block('x', vehicle_by_trip, 0, big_m.trip_allowed, compiled.trip_cost, 'B')
+        self._add_block('x_dispatch', vehicle_by_waypoint, 0, big_m.dispatch_allowed,
+                        compiled.dispatch_cost, 'B')
+        self._add_block('x_recall', vehicle_by_waypoint, 0, big_m.recall_allowed,
+                        compiled.recall_cost, 'B')
+
+        # Accumulated Miller-Tucker-Zemlin demand
+        if subtour_elimination == 'mtz':
+            self._add_block('subtour_u', vehicle_by_waypoint, 1, num_waypoints, 0, 'C')
+
+        # The amount of cargo en route to waypoint, kept as low as possible
+        self._add_block('capacity_u', vehicle_by_waypoint, 0, compiled.cargo_capacity[:, None],
+                        1, 'C')
+
+        # Arrival time at waypoints, dispatch time kept as late as possible, and return time
+        self._add_block('time_u', vehicle_by_waypoint, big_m.arrival_lb, big_m.arrival_ub, 0,
+                        'C')
+        self._add_block('time_s', (num_vehicles,), compiled.earliest_activity,
+                        compiled.latest_activity, -1, 'C')
+        self._add_block('time_e', (num_vehicles,), compiled.earliest_activity,
+                        compiled.latest_activity, 0, 'C')
+
+        self._add_flow_constraints()
+        if subtour_elimination == 'mtz':
+            self._add_subtour_constraints()
+        self._add_capacity_constraints()
+        self._add_time_constraints()
+        if symmetry_breaking:
+            self._add_symmetry_constraints()
+
+    def _add_block(self, name, shape, lb, ub, obj, vtype):
+        size = int(np.prod(shape))
+        self.blocks[name] = self.num_vars, shape
+        self.num_vars += size
+        self._lb.append(np.broadcast_to(lb, shape).ravel())
+        self._ub.append(np.broadcast_to(ub, shape).ravel())
+        self._obj.append(np.broadcast_to(obj, shape).ravel())
+        self._vtype.append(np.full(size, vtype))
+
+    def column(self, name, *index) -> np.ndarray:
+        offset, shape = self.blocks[name]
+        return offset + np.ravel_multi_index(np.broadcast_arrays(*index), shape)
+
+    @property
+    def lb(self) -> np.ndarray:
+        return np.concatenate(self._lb).astype(np.float64)
+
+    @property
+    def ub(self) -> np.ndarray:
+        return np.concatenate(self._ub).astype(np.float64)
+
+    @property
+    def obj(self) -> np.ndarray:
+        return np.concatenate(self._obj).astype(np.float64)
+
+    @property
+    def vtype(self) -> np.ndarray:
+        return np.concatenate(self._vtype)
+
+    def unpack(self, values: np.ndarray) -> dict[str, np.ndarray]:
+        return {
+            name: values[offset:offset + int(np.prod(shape))].reshape(shape)
+            for name, (offset, shape) in self.blocks.items()
+        }
+
+    def _add_constraints(self, name, rows: _RowBuilder, sense, rhs):
+        self.constraints.append(ConstraintBlock(
+            name=name,
+            matrix=rows.matrix(self.num_vars),
+            sense=sense,
+            rhs=np.broadcast_to(np.asarray(rhs, dtype=np.float64).ravel(), rows.num_rows).copy(),
+        ))
+
+    def _add_conditional_equality(self, name, shape, terms, binary_cols, value, upper_m,
+                                  lower_m, mask=None):
+        # lhs == value whenever the binary variable is set. Otherwise lhs may exceed value by
+        # upper_m and fall short of it by lower_m. Rows are only added where the mask is set.
+        if mask is None:
+            mask = np.ones(shape, dtype=bool)
+
+        def _select(_array):
+            return np.broadcast_to(_array, shape)[mask]
+
+        row_index = np.arange(np.count_nonzero(mask))
+        for suffix, sign, big_m in (('a', 1, upper_m), ('b', -1, lower_m)):
+            rows = _RowBuilder(row_index.size)
+            for cols, coeff in terms:
+                rows.add(row_index, _select(cols), _select(coeff))
+            rows.add(row_index, _select(binary_cols), _select(sign * big_m))
+            sense = '<' if sign > 0 else '>'
+            self._add_constraints(f'{name}{suffix}', rows, sense, _select(value + sign * big_m))
+
+    def _add_flow_constraints(self):
+        compiled = self.compiled
+        num_vehicles = compiled.num_vehicles
+        num_waypoints = compiled.num_waypoints
+        vehicles = np.arange(num_vehicles)[:, None]
+        waypoints = np.arange(num_waypoints)[None, :]
+        trips = np.arange(compiled.num_trips)[None, :]
+
+        # A vehicle that enters a waypoint must exit it.
+        rows = _RowBuilder(num_vehicles * num_waypoints)
+        vehicle_rows = vehicles * num_waypoints
+        rows.add(vehicle_rows + waypoints, self.column('x_dispatch', vehicles, waypoints), 1)
+        rows.add(vehicle_rows + waypoints, self.column('x_recall', vehicles, waypoints), -1)
+        rows.add(vehicle_rows + compiled.trip_target, self.column('x', vehicles, trips), 1)
+        rows.add(vehicle_rows + compiled.trip_origin, self.column('x', vehicles, trips), -1)
+        self._add_constraints('3.2-1', rows, '=', 0)
+
+        # A waypoint must be visited once.
+        rows = _RowBuilder(num_waypoints)
+        rows.add(waypoints, self.column('x_dispatch', vehicles, waypoints), 1)
+        rows.add(compiled.trip_target, self.column('x', vehicles, trips), 1)
+        self._add_constraints('3.2-2', rows, '=', 1)
+
+        # A vehicle can be dispatched to and recalled from at most one waypoint.
+        for name, block in (('3.2-3a', 'x_dispatch'), ('3.2-3b', 'x_recall')):
+            rows = _RowBuilder(num_vehicles)
+            rows.add(vehicles, self.column(block, vehicles, waypoints), 1)
+            self._add_constraints(name, rows, '<', 1)
+
+    def _add_subtour_constraints(self):
+        compiled = self.compiled
+        num_waypoints = compiled.num_waypoints
+        vehicles = np.arange(compiled.num_vehicles)[:, None]
+        trips = np.arange(compiled.num_trips)[None, :]
+
+        # Miller-Tucker-Zemlin formulation
+        rows = _RowBuilder(compiled.num_vehicles * compiled.num_trips)
+        row_index = vehicles * compiled.num_trips + trips
+        rows.add(row_index, self.column('subtour_u', vehicles, compiled.trip_target), 1)
+        rows.add(row_index, self.column('subtour_u', vehicles, compiled.trip_origin), -1)
+        rows.add(row_index, self.column('x', vehicles, trips), -num_waypoints)
+        self._add_constraints('3.3-1', rows, '>', 1 - num_waypoints)
+
+    def _add_capacity_constraints(self):
+        compiled = self.compiled
+        vehicles = np.arange(compiled.num_vehicles)[:, None]
+        waypoints = np.arange(compiled.num_waypoints)[None, :]
+        trips = np.arange(compiled.num_trips)[None, :]
+
+        self._add_conditional_equality(
+            '3.4-1', (compiled.num_vehicles, compiled.num_trips),
+            [
+                (self.column('capacity_u', vehicles, compiled.trip_origin), 1),
+                (self.column('capacity_u', vehicles, compiled.trip_target), -1),
+            ],
+            self.column('x', vehicles, trips),
+            compiled.cargo_demand[compiled.trip_target],
+            self.big_m.capacity_trip_upper,
+            self.big_m.capacity_trip_lower
+        )
+
+        rows = _RowBuilder(compiled.num_vehicles * compiled.num_waypoints)
+        rows.add(vehicles * compiled.num_waypoints + waypoints,
+                 self.column('capacity_u', vehicles, waypoints), 1)
+        demand = np.broadcast_to(compiled.cargo_demand, (vehicles.size, waypoints.size))
+        self._add_constraints('3.4-1c', rows, '>', demand)
+
+    def _add_time_constraints(self):
+        compiled = self.compiled
+        num_vehicles = compiled.num_vehicles
+        vehicles = np.arange(num_vehicles)[:, None]
+        waypoints = np.arange(compiled.num_waypoints)[None, :]
+        trips = np.arange(compiled.num_trips)[None, :]
+        big_m = self.big_m
+
+        self._add_conditional_equality(
+            '3.5-1', (num_vehicles, compiled.num_trips),
+            [
+                (self.column('time_u', vehicles, compiled.trip_target), 1),
+                (self.column('time_u', vehicles, compiled.trip_origin), -1),
+            ],
+            self.column('x', vehicles, trips),
+            compiled.trip_duration + compiled.dwell[compiled.trip_origin],
+            big_m.time_trip_upper,
+            big_m.time_trip_lower
+        )
+
+        self._add_conditional_equality(
+            '3.5-2', (num_vehicles, compiled.num_waypoints),
+            [
+                (self.column('time_u', vehicles, waypoints), 1),
+                (self.column('time_s', vehicles), -1),
+            ],
+            self.column('x_dispatch', vehicles, waypoints),
+            compiled.dispatch_duration,
+            big_m.time_dispatch_upper,
+            big_m.time_dispatch_lower,
+            mask=big_m.dispatch_allowed
+        )
+
+        self._add_conditional_equality(
+            '3.5-3', (num_vehicles, compiled.num_waypoints),
+            [
+                (self.column('time_e', vehicles), 1),
+                (self.column('time_u', vehicles, waypoints), -1),
+            ],
+            self.column('x_recall', vehicles, waypoints),
+            compiled.recall_duration + compiled.dwell,
+            big_m.time_recall_upper,
+            big_m.time_recall_lower,
+            mask=big_m.recall_allowed
+        )
+
+    def _add_symmetry_constraints(self):
+        compiled = self.compiled
+        num_waypoints = compiled.num_waypoints
+        earlier, later = compiled.interchangeable_vehicle_pairs()
+        if len(earlier) == 0:
+            return
+
+        pairs = np.arange(len(earlier))[:, None]
+        waypoints = np.arange(num_waypoints)[None, :]
+        earlier, later = earlier[:, None], later[:, None]
+
+        # Interchangeable vehicles are used in order.
+        rows = _RowBuilder(len(pairs))
+        rows.add(pairs, self.column('x_dispatch', later, waypoints), 1)
+        rows.add(pairs, self.column('x_dispatch', earlier, waypoints), -1)
+        self._add_constraints('3.6-1', rows, '<', 0)
+
+        # Used interchangeable vehicles are dispatched to waypoints in ascending index order.
+        rows = _RowBuilder(len(pairs))
+        rows.add(pairs, self.column('x_dispatch', later, waypoints), waypoints - num_waypoints)
+        rows.add(pairs, self.column('x_dispatch', earlier, waypoints), -(waypoints + 1))
+        self._add_constraints('3.6-2', rows, '>', -num_waypoints)
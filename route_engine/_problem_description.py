@@ -1,17 +1,58 @@
 from collections.abc import Hashable
 from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from itertools import permutations
 from pprint import pformat
 
-from gis_backend.query_provider import get_path_metric
-from gis_backend.query_provider import get_shortest_path_between
+import numpy as np
+
+from gis_backend.query_provider import GraphQueryProvider
+from gis_backend.query_provider import Route
+from gis_backend.query_provider import cache_routes
+from gis_backend.query_provider import get_cached_routes
+from gis_backend.query_provider import get_default_provider
+from gis_backend.query_provider import get_duration_lower_bounds
+from gis_backend.query_provider import get_shortest_route_between
+from gis_backend.query_provider import get_shortest_routes_from
+from gis_backend.query_provider import get_shortest_routes_to
+from gis_backend.query_provider import set_default_provider
+
+from ._arc_pruning import feasible_dispatches
+from ._arc_pruning import feasible_recalls
+from ._arc_pruning import feasible_trips
 
 GISNode = Hashable
 Depot = Hashable
 Vehicle = Hashable
 Waypoint = Hashable
 Trip = tuple[Waypoint, Waypoint]
+RouteKey = tuple[GISNode, GISNode, str]
+
+
+def _init_routing_worker(gis_folder):
+    set_default_provider(GraphQueryProvider(gis_folder))
+
+
+def _find_routes_of_tree(task) -> dict[RouteKey, Route]:
+    root_node, leaf_nodes, metric, reverse = task
+
+    if reverse:
+        routes = get_shortest_routes_to(root_node, leaf_nodes, metric=metric)
+        return {
+            (leaf_node, root_node, metric): route
+            for leaf_node, route in routes.items()
+        }
+
+    routes = get_shortest_routes_from(root_node, leaf_nodes, metric=metric)
+    return {
+        (root_node, leaf_node, metric): route
+        for leaf_node, route in routes.items()
+    }
+
+
+def _or_default(value, default):
+    return default if value is None else value
 
 
 @dataclass
@@ -86,12 +127,14 @@ class VehicleRoutingProblem:
         self._vehicles: dict[Vehicle, VehicleParams] = dict()
         self._waypoints: dict[Waypoint, WaypointParams] = dict()
         self._trips: dict[Trip, TripParams] = dict()
+        self._trips_to: dict[Waypoint, list[Trip]] = dict()
+        self._trips_from: dict[Waypoint, list[Trip]] = dict()
         self._dispatches: dict[tuple[Vehicle, Waypoint], DispatchParams] = dict()
         self._recalls: dict[tuple[Vehicle, Waypoint], RecallParams] = dict()
 
-        self._trip_geometries: dict[Trip, list[GISNode]] = dict()
-        self._dispatch_geometries: dict[tuple[Vehicle, Waypoint], list[GISNode]] = dict()
-        self._recall_geometries: dict[tuple[Vehicle, Waypoint], list[GISNode]] = dict()
+        # Routing results shared by every trip, dispatch and recall between the same GIS nodes.
+        # Geometries are read from here rather than stored per vehicle.
+        self._routes: dict[RouteKey, Route] = dict()
 
     def __str__(self):
         lines = list()
@@ -132,14 +175,26 @@ class VehicleRoutingProblem:
     def recall_params(self, vehicle: Vehicle, waypoint: Waypoint) -> RecallParams:
         return self._recalls[vehicle, waypoint]
 
+    def can_dispatch(self, vehicle: Vehicle, waypoint: Waypoint) -> bool:
+        return (vehicle, waypoint) in self._dispatches
+
+    def can_recall(self, vehicle: Vehicle, waypoint: Waypoint) -> bool:
+        return (vehicle, waypoint) in self._recalls
+
+    def _route_geometry(self, origin_gis_node: GISNode, target_gis_node: GISNode) -> list[GISNode]:
+        return self._routes[origin_gis_node, target_gis_node, self._cost_metric].path
+
     def dispatch_geometry(self, vehicle: Vehicle, waypoint: Waypoint) -> list[GISNode]:
-        return self._dispatch_geometries[vehicle, waypoint]
+        params = self._dispatches[vehicle, waypoint]
+        return self._route_geometry(params.origin_gis_node, params.target_gis_node)
 
     def recall_geometry(self, vehicle: Vehicle, waypoint: Waypoint) -> list[GISNode]:
-        return self._recall_geometries[vehicle, waypoint]
+        params = self._recalls[vehicle, waypoint]
+        return self._route_geometry(params.origin_gis_node, params.target_gis_node)
 
     def trip_geometry(self, trip: Trip) -> list[GISNode]:
-        return self._trip_geometries[trip]
+        params = self._trips[trip]
+        return self._route_geometry(params.origin_gis_node, params.target_gis_node)
 
     @property
     def vehicles(self) -> Iterable[Vehicle]:
@@ -154,76 +209,395 @@ class VehicleRoutingProblem:
         return self._trips
 
     def trips_to(self, waypoint: Waypoint) -> Iterable[Trip]:
-        for trip_from, trip_to in self.trips:
-            if trip_to == waypoint:
-                yield trip_from, trip_to
+        return self._trips_to.get(waypoint, list())
 
     def trips_from(self, waypoint: Waypoint) -> Iterable[Trip]:
-        for trip_from, trip_to in self.trips:
-            if trip_from == waypoint:
-                yield trip_from, trip_to
+        return self._trips_from.get(waypoint, list())
+
+    def _index_trips(self) -> None:
+        self._trips_to = dict()
+        self._trips_from = dict()
+        for trip in self._trips:
+            trip_from, trip_to = trip
+            self._trips_to.setdefault(trip_to, list()).append(trip)
+            self._trips_from.setdefault(trip_from, list()).append(trip)
+
+    def subproblem(self, vehicles: Iterable[Vehicle],
+                   waypoints: Iterable[Waypoint]) -> 'VehicleRoutingProblem':
+        """
+        Restricts a planned problem to some of its vehicles and waypoints
+        :param vehicles: vehicles kept in the subproblem
+        :param waypoints: waypoints kept in the subproblem
+        :return: a planned problem sharing the params and routes of this one
+        """
+        problem = VehicleRoutingProblem()
+        problem._cost_metric = self._cost_metric
+        problem._vehicles = {vehicle: self._vehicles[vehicle] for vehicle in vehicles}
+        problem._waypoints = {waypoint: self._waypoints[waypoint] for waypoint in waypoints}
+
+        problem._trips = {
+            trip: self._trips[trip]
+            for waypoint in problem._waypoints
+            for trip in self.trips_from(waypoint)
+            if trip[1] in problem._waypoints
+        }
+        problem._index_trips()
+        problem._dispatches = {
+            (vehicle, waypoint): self._dispatches[vehicle, waypoint]
+            for vehicle in problem._vehicles
+            for waypoint in problem._waypoints
+            if (vehicle, waypoint) in self._dispatches
+        }
+        problem._recalls = {
+            (vehicle, waypoint): self._recalls[vehicle, waypoint]
+            for vehicle in problem._vehicles
+            for waypoint in problem._waypoints
+            if (vehicle, waypoint) in self._recalls
+        }
 
-    def run_trip_planning(self, metric):
-        self._cost_metric = metric
+        # Only the routes of the arcs kept are carried over
+        for params in (*problem._trips.values(), *problem._dispatches.values(),
+                       *problem._recalls.values()):
+            route_key = params.origin_gis_node, params.target_gis_node, self._cost_metric
+            problem._routes[route_key] = self._routes[route_key]
 
-        for trip in permutations(self._waypoints, r=2):
-            trip_start, trip_end = trip
+        return problem
 
-            path = get_shortest_path_between(
-                self._waypoints[trip_start].gis_node,
-                self._waypoints[trip_end].gis_node,
-                metric=metric
+    def _route_pairs(self, trips: list[Trip], dispatches: list[tuple[Vehicle, Waypoint]],
+                     recalls: list[tuple[Vehicle, Waypoint]]) -> set[tuple[GISNode, GISNode]]:
+        pairs = {
+            (self._waypoints[trip_start].gis_node, self._waypoints[trip_end].gis_node)
+            for trip_start, trip_end in trips
+        }
+        pairs.update(
+            (self._vehicles[vehicle].dispatch_from_gis_node, self._waypoints[waypoint].gis_node)
+            for vehicle, waypoint in dispatches
+        )
+        pairs.update(
+            (self._waypoints[waypoint].gis_node, self._vehicles[vehicle].recall_to_gis_node)
+            for vehicle, waypoint in recalls
+        )
+        return pairs
+
+    def _routed_durations(self, src_nodes, dst_nodes, metric) -> np.ndarray:
+        durations = np.full((len(src_nodes), len(dst_nodes)), np.inf)
+        for row, src_node in enumerate(src_nodes):
+            for column, dst_node in enumerate(dst_nodes):
+                route = self._routes.get((src_node, dst_node, metric))
+                if route is not None:
+                    durations[row, column] = route.duration_hours
+        return durations
+
+    def _prune_arcs(self, trip_groups: list[list[Trip]],
+                    dispatches: list[tuple[Vehicle, Waypoint]],
+                    recalls: list[tuple[Vehicle, Waypoint]], durations_between, exact: bool):
+        # Durations are looked up between the origins and targets of each group of trips, and
+        # between all vehicles and the waypoints of dispatches and recalls
+        vehicle_params = list(self._vehicles.values())
+        vehicle_index = {vehicle: v for v, vehicle in enumerate(self._vehicles)}
+        activity_earliest = np.array([
+            _or_default(params.earliest_activity_hour, -np.inf) for params in vehicle_params
+        ], dtype=np.float64)
+        activity_latest = np.array([
+            _or_default(params.latest_activity_hour, np.inf) for params in vehicle_params
+        ], dtype=np.float64)
+        max_capacity = max(
+            (_or_default(params.cargo_capacity, np.inf) for params in vehicle_params),
+            default=np.inf
+        )
+
+        def _windows(_waypoints):
+            _params = [self._waypoints[waypoint] for waypoint in _waypoints]
+            return (
+                {waypoint: j for j, waypoint in enumerate(_waypoints)},
+                [params.gis_node for params in _params],
+                np.array([
+                    _or_default(params.earliest_arrival_hour, -np.inf) for params in _params
+                ], dtype=np.float64),
+                np.array([
+                    _or_default(params.latest_arrival_hour, np.inf) for params in _params
+                ], dtype=np.float64),
+                np.array([params.dwell_hours for params in _params], dtype=np.float64),
+                np.array([params.cargo_demand for params in _params], dtype=np.float64),
             )
 
-            trip_params = TripParams(
-                origin=trip_start,
-                target=trip_end,
-                cost=get_path_metric(path, metric=metric),
-                duration_hours=get_path_metric(path, metric='travel_time'),
-                origin_gis_node=self._waypoints[trip_start].gis_node,
-                target_gis_node=self._waypoints[trip_end].gis_node,
+        feasible_trip_groups = list()
+        for trips in trip_groups:
+            if not trips:
+                feasible_trip_groups.append(list())
+                continue
+
+            origin_index, origin_nodes, origin_earliest, origin_latest, origin_dwell, \
+                origin_demand = _windows(list(dict.fromkeys(i for i, _ in trips)))
+            target_index, target_nodes, target_earliest, target_latest, _, \
+                target_demand = _windows(list(dict.fromkeys(j for _, j in trips)))
+
+            trip_mask = feasible_trips(
+                origin_earliest, origin_latest, origin_dwell, origin_demand,
+                target_earliest, target_latest, target_demand, max_capacity,
+                durations_between(origin_nodes, target_nodes), exact
+            )
+            feasible_trip_groups.append([
+                trip for trip in trips
+                if trip_mask[origin_index[trip[0]], target_index[trip[1]]]
+            ])
+
+        dispatch_nodes = list({params.dispatch_from_gis_node for params in vehicle_params})
+        recall_nodes = list({params.recall_to_gis_node for params in vehicle_params})
+        dispatch_rows = [
+            dispatch_nodes.index(params.dispatch_from_gis_node) for params in vehicle_params
+        ]
+        recall_columns = [
+            recall_nodes.index(params.recall_to_gis_node) for params in vehicle_params
+        ]
+
+        if dispatches:
+            waypoint_index, waypoint_nodes, earliest, latest, _, _ = _windows(
+                list(dict.fromkeys(waypoint for _, waypoint in dispatches)))
+            dispatch_mask = feasible_dispatches(
+                activity_earliest, activity_latest, earliest, latest,
+                durations_between(dispatch_nodes, waypoint_nodes)[dispatch_rows], exact
             )
+            dispatches = [
+                (vehicle, waypoint) for vehicle, waypoint in dispatches
+                if dispatch_mask[vehicle_index[vehicle], waypoint_index[waypoint]]
+            ]
+
+        if recalls:
+            waypoint_index, waypoint_nodes, earliest, latest, dwell, _ = _windows(
+                list(dict.fromkeys(waypoint for _, waypoint in recalls)))
+            recall_mask = feasible_recalls(
+                activity_earliest, activity_latest, earliest, latest, dwell,
+                durations_between(waypoint_nodes, recall_nodes).T[recall_columns], exact
+            )
+            recalls = [
+                (vehicle, waypoint) for vehicle, waypoint in recalls
+                if recall_mask[vehicle_index[vehicle], waypoint_index[waypoint]]
+            ]
+
+        return feasible_trip_groups, dispatches, recalls
+
+    def _find_routes_pairwise(self, pairs: set[tuple[GISNode, GISNode]], metric) -> None:
+        for origin_node, target_node in pairs:
+            self._routes[origin_node, target_node, metric] = get_shortest_route_between(
+                origin_node, target_node, metric=metric)
+
+    def _find_routes_batched(self, pairs: set[tuple[GISNode, GISNode]], metric,
+                             workers: int | None = None,
+                             reverse_nodes: set[GISNode] | None = None) -> None:
+        targets_by_origin: dict[GISNode, set[GISNode]] = dict()
+        for origin_node, target_node in pairs:
+            targets_by_origin.setdefault(origin_node, set()).add(target_node)
+
+        recall_nodes = {params.recall_to_gis_node for params in self._vehicles.values()}
+        if reverse_nodes is not None:
+            recall_nodes |= reverse_nodes
+        origins_by_recall_node: dict[GISNode, set[GISNode]] = dict()
+        for origin_node, target_node in pairs:
+            if target_node in recall_nodes:
+                origins_by_recall_node.setdefault(target_node, set()).add(origin_node)
+                targets_by_origin[origin_node].discard(target_node)
+
+        # One forward search per distinct origin covers every trip and dispatch leaving it.
+        # One reverse search per recall facility, or other reverse node, covers every route
+        # arriving there.
+        tasks = [
+            (origin_node, list(target_nodes), metric, False)
+            for origin_node, target_nodes in targets_by_origin.items()
+            if target_nodes
+        ]
+        tasks.extend(
+            (target_node, list(origin_nodes), metric, True)
+            for target_node, origin_nodes in origins_by_recall_node.items()
+        )
+
+        if workers is None or workers <= 1:
+            for routes in map(_find_routes_of_tree, tasks):
+                self._routes.update(routes)
+            return
+
+        # Workers memory-map the same compiled graph files as this process, so the operating
+        # system shares one copy of the graph between all of them. Results are merged in task
+        # order regardless of which worker finishes first.
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_routing_worker,
+                initargs=(get_default_provider().folder,)
+        ) as executor:
+            chunk_size = max(1, len(tasks) // (4 * workers))
+            for routes in executor.map(_find_routes_of_tree, tasks, chunksize=chunk_size):
+                self._routes.update(routes)
+
+    def run_trip_planning(self, metric, batched=True, use_route_cache=True,
+                          workers: int | None = None, prune_arcs=True):
+        self._cost_metric = metric
+        self._trips = dict()
+        self._dispatches = dict()
+        self._recalls = dict()
+        self._index_trips()
+
+        trips = list(permutations(self._waypoints, r=2))
+        dispatches = [
+            (vehicle, waypoint) for vehicle in self._vehicles for waypoint in self._waypoints
+        ]
+        recalls = list(dispatches)
+        self._plan_arcs([trips], dispatches, recalls, batched, use_route_cache, workers,
+                        prune_arcs)
 
-            self._trips[trip] = trip_params
-            self._trip_geometries[trip] = path
+    def run_incremental_trip_planning(self, waypoints: Iterable[Waypoint], batched=True,
+                                      use_route_cache=True, workers: int | None = None,
+                                      prune_arcs=True):
+        """
+        Plans the trips, dispatches and recalls of waypoints added after trip planning, keeping
+        the ones already planned
+        :param waypoints: waypoints added since trip planning last ran
+        :param batched: whether to route with one shortest path tree per distinct endpoint
+        :param use_route_cache: whether to read and write the persistent route cache
+        :param workers: number of routing processes
+        :param prune_arcs: whether to drop arcs that no schedule can use
+        """
+        if self._cost_metric is None:
+            raise ValueError('Cannot plan trips incrementally: Trip planning has not run.')
+
+        waypoints = list(dict.fromkeys(waypoints))
+        added = set(waypoints)
+        trips_from_added = [
+            (waypoint, other) for waypoint in waypoints for other in self._waypoints
+            if other != waypoint
+        ]
+        trips_to_added = [
+            (other, waypoint) for other in self._waypoints if other not in added
+            for waypoint in waypoints
+        ]
+        dispatches = [
+            (vehicle, waypoint) for vehicle in self._vehicles for waypoint in waypoints
+        ]
+        recalls = list(dispatches)
 
-        for vehicle, vehicle_params in self._vehicles.items():
-            for waypoint, waypoint_params in self._waypoints.items():
-                dispatch_path = get_shortest_path_between(
-                    vehicle_params.dispatch_from_gis_node,
-                    waypoint_params.gis_node,
-                    metric=metric
-                )
+        # Routes into the added waypoints are found by searching backwards from them
+        reverse_nodes = {self._waypoints[waypoint].gis_node for waypoint in waypoints}
+        self._plan_arcs([trips_from_added, trips_to_added], dispatches, recalls, batched,
+                        use_route_cache, workers, prune_arcs, reverse_nodes)
 
-                recall_path = get_shortest_path_between(
-                    waypoint_params.gis_node,
-                    vehicle_params.recall_to_gis_node,
-                    metric=metric
-                )
+    def remove_waypoint(self, waypoint: Waypoint) -> None:
+        """
+        Removes a waypoint with its trips, dispatches and recalls
+        :param waypoint: waypoint to remove
+        """
+        if waypoint not in self._waypoints:
+            raise ValueError(f'Cannot remove waypoint: Waypoint "{waypoint}" does not exist.')
+
+        for trip in self._trips_from.pop(waypoint, list()):
+            del self._trips[trip]
+            self._trips_to[trip[1]].remove(trip)
+        for trip in self._trips_to.pop(waypoint, list()):
+            del self._trips[trip]
+            self._trips_from[trip[0]].remove(trip)
+        for vehicle in self._vehicles:
+            self._dispatches.pop((vehicle, waypoint), None)
+            self._recalls.pop((vehicle, waypoint), None)
+        del self._waypoints[waypoint]
+
+    def _plan_arcs(self, trip_groups: list[list[Trip]],
+                   dispatches: list[tuple[Vehicle, Waypoint]],
+                   recalls: list[tuple[Vehicle, Waypoint]], batched, use_route_cache, workers,
+                   prune_arcs, reverse_nodes: set[GISNode] | None = None):
+        metric = self._cost_metric
+
+        # Arcs that no schedule can use are dropped before routing, judged by travel time lower
+        # bounds, and again after routing, judged by the routed travel times.
+        if prune_arcs:
+            trip_groups, dispatches, recalls = self._prune_arcs(
+                trip_groups, dispatches, recalls, get_duration_lower_bounds, exact=False)
+        trips = [trip for trips in trip_groups for trip in trips]
+
+        # Node pairs routed by an earlier call with the same metric are reused
+        pairs = {
+            (origin_node, target_node)
+            for origin_node, target_node in self._route_pairs(trips, dispatches, recalls)
+            if (origin_node, target_node, metric) not in self._routes
+        }
+
+        if use_route_cache:
+            for (origin_node, target_node), route in get_cached_routes(pairs, metric).items():
+                self._routes[origin_node, target_node, metric] = route
+                pairs.discard((origin_node, target_node))
+
+        if batched:
+            self._find_routes_batched(pairs, metric, workers=workers, reverse_nodes=reverse_nodes)
+        else:
+            self._find_routes_pairwise(pairs, metric)
+
+        if use_route_cache:
+            cache_routes({
+                (origin_node, target_node): self._routes[origin_node, target_node, metric]
+                for origin_node, target_node in pairs
+            }, metric)
+
+        if prune_arcs:
+            trip_groups, dispatches, recalls = self._prune_arcs(
+                trip_groups, dispatches, recalls,
+                lambda _src_nodes, _dst_nodes: self._routed_durations(
+                    _src_nodes, _dst_nodes, metric),
+                exact=True
+            )
+            trips = [trip for trips in trip_groups for trip in trips]
+
+        for trip in trips:
+            trip_start, trip_end = trip
+            origin_gis_node = self._waypoints[trip_start].gis_node
+            target_gis_node = self._waypoints[trip_end].gis_node
+            route = self._routes[origin_gis_node, target_gis_node, metric]
 
-                dispatch_params = DispatchParams(
+            self._trips[trip] = TripParams(
+                origin=trip_start,
+                target=trip_end,
+                cost=route.metric(metric),
+                duration_hours=route.duration_hours,
+                origin_gis_node=origin_gis_node,
+                target_gis_node=target_gis_node,
+            )
+            self._trips_to.setdefault(trip_end, list()).append(trip)
+            self._trips_from.setdefault(trip_start, list()).append(trip)
+
+        # Vehicles of the same depot leave from and return to the same GIS nodes, so they refer
+        # to one shared params object per waypoint instead of holding copies.
+        shared_dispatches: dict[tuple[Depot, GISNode, Waypoint], DispatchParams] = dict()
+        shared_recalls: dict[tuple[Depot, GISNode, Waypoint], RecallParams] = dict()
+
+        for vehicle, waypoint in dispatches:
+            vehicle_params = self._vehicles[vehicle]
+            waypoint_params = self._waypoints[waypoint]
+            dispatch_key = vehicle_params.depot, vehicle_params.dispatch_from_gis_node, waypoint
+            if dispatch_key not in shared_dispatches:
+                route = self._routes[
+                    vehicle_params.dispatch_from_gis_node, waypoint_params.gis_node, metric]
+                shared_dispatches[dispatch_key] = DispatchParams(
                     depot=vehicle_params.depot,
                     target=waypoint,
-                    cost=get_path_metric(dispatch_path, metric=metric),
-                    duration_hours=get_path_metric(dispatch_path, metric='travel_time'),
+                    cost=route.metric(metric),
+                    duration_hours=route.duration_hours,
                     origin_gis_node=vehicle_params.dispatch_from_gis_node,
                     target_gis_node=waypoint_params.gis_node
                 )
-
-                recall_params = RecallParams(
+            self._dispatches[vehicle, waypoint] = shared_dispatches[dispatch_key]
+
+        for vehicle, waypoint in recalls:
+            vehicle_params = self._vehicles[vehicle]
+            waypoint_params = self._waypoints[waypoint]
+            recall_key = vehicle_params.depot, vehicle_params.recall_to_gis_node, waypoint
+            if recall_key not in shared_recalls:
+                route = self._routes[
+                    waypoint_params.gis_node, vehicle_params.recall_to_gis_node, metric]
+                shared_recalls[recall_key] = RecallParams(
                     depot=vehicle_params.depot,
                     origin=waypoint,
-                    cost=get_path_metric(recall_path, metric=metric),
-                    duration_hours=get_path_metric(recall_path, metric='travel_time'),
+                    cost=route.metric(metric),
+                    duration_hours=route.duration_hours,
                     origin_gis_node=waypoint_params.gis_node,
                     target_gis_node=vehicle_params.recall_to_gis_node,
                 )
-
-                self._dispatches[vehicle, waypoint] = dispatch_params
-                self._recalls[vehicle, waypoint] = recall_params
-
-                self._dispatch_geometries[vehicle, waypoint] = dispatch_path
-                self._recall_geometries[vehicle, waypoint] = recall_path
+            self._recalls[vehicle, waypoint] = shared_recalls[recall_key]
 
 
 @dataclass
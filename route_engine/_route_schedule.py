@@ -0,0 +1,123 @@
+from dataclasses import dataclass
+from math import inf
+
+import numpy as np
+
+from ._compiled_problem import CompiledProblem
+
+_tolerance = 1e-9
+
+
+@dataclass
+class RouteSchedule:
+    cost: float
+    start_hour: float
+    arrival_hours: list[float]
+    end_hour: float
+    cargo_levels: list[float]
+
+
+class RouteEvaluator:
+    """
+    Schedules routes given as waypoint indices in visiting order
+
+    Schedules follow the tour planning model. Vehicles never wait, so the dispatch time fixes
+    every arrival, and the latest dispatch time fitting all time windows is chosen. Cargo is
+    loaded at dispatch and kept as low as the demands along the route allow.
+    """
+
+    def __init__(self, compiled: CompiledProblem):
+        self.compiled = compiled
+
+        # Routes are evaluated one waypoint at a time, which is much faster on lists
+        self._trip_index = compiled.trip_index.tolist()
+        self._trip_cost = compiled.trip_cost.tolist()
+        self._trip_duration = compiled.trip_duration.tolist()
+        self._dispatch_cost = np.where(
+            compiled.dispatch_allowed, compiled.dispatch_cost, inf).tolist()
+        self._dispatch_duration = compiled.dispatch_duration.tolist()
+        self._recall_cost = np.where(
+            compiled.recall_allowed, compiled.recall_cost, inf).tolist()
+        self._recall_duration = compiled.recall_duration.tolist()
+        self._dwell = compiled.dwell.tolist()
+        self._demand = compiled.cargo_demand.tolist()
+        self._earliest_arrival = compiled.earliest_arrival.tolist()
+        self._latest_arrival = compiled.latest_arrival.tolist()
+        self._earliest_activity = compiled.earliest_activity.tolist()
+        self._latest_activity = compiled.latest_activity.tolist()
+        self._cargo_capacity = compiled.cargo_capacity.tolist()
+
+    def trip(self, i: int, j: int) -> int:
+        return self._trip_index[i][j]
+
+    def cost(self, v: int, route: list[int]) -> float:
+        if not route:
+            return 0.0
+
+        cost = self._dispatch_cost[v][route[0]] + self._recall_cost[v][route[-1]]
+        for i, j in zip(route[:-1], route[1:]):
+            ij = self._trip_index[i][j]
+            if ij < 0:
+                return inf
+            cost += self._trip_cost[ij]
+        return cost
+
+    def schedule(self, v: int, route: list[int]) -> RouteSchedule | None:
+        """
+        Schedules a route of a vehicle
+        :param v: vehicle index
+        :param route: waypoint indices in visiting order, not empty
+        :return: the schedule, or None if the route is infeasible
+        """
+        # Dispatch and recall costs are infinite where planning pruned them
+        cost = self._dispatch_cost[v][route[0]] + self._recall_cost[v][route[-1]]
+        if cost == inf:
+            return None
+
+        # Offsets of arrivals from the dispatch time, narrowing the dispatch window as they go
+        offset = self._dispatch_duration[v][route[0]]
+        earliest_start = self._earliest_activity[v]
+        latest_start = self._latest_activity[v]
+        offsets = list()
+
+        # Cargo carried towards each waypoint, relative to the cargo loaded at dispatch
+        load = 0.0
+        min_initial_cargo = 0.0
+        max_initial_cargo = self._cargo_capacity[v]
+        relative_cargo = list()
+
+        previous = None
+        for j in route:
+            if previous is not None:
+                ij = self._trip_index[previous][j]
+                if ij < 0:
+                    return None
+                offset += self._dwell[previous] + self._trip_duration[ij]
+                cost += self._trip_cost[ij]
+                load -= self._demand[j]
+
+            offsets.append(offset)
+            earliest_start = max(earliest_start, self._earliest_arrival[j] - offset)
+            latest_start = min(latest_start, self._latest_arrival[j] - offset)
+
+            relative_cargo.append(load)
+            min_initial_cargo = max(min_initial_cargo, self._demand[j] - load, -load)
+            max_initial_cargo = min(max_initial_cargo, self._cargo_capacity[v] - load)
+            previous = j
+
+        total_duration = offset + self._dwell[route[-1]] + self._recall_duration[v][route[-1]]
+        earliest_start = max(earliest_start, self._earliest_activity[v] - total_duration)
+        latest_start = min(latest_start, self._latest_activity[v] - total_duration)
+        if earliest_start > latest_start + _tolerance or \
+                min_initial_cargo > max_initial_cargo + _tolerance:
+            return None
+
+        # The model keeps dispatch times as late and cargo as low as possible
+        start = latest_start if latest_start < inf else max(earliest_start, 0.0)
+        return RouteSchedule(
+            cost=cost,
+            start_hour=start,
+            arrival_hours=[start + offset for offset in offsets],
+            end_hour=start + total_duration,
+            cargo_levels=[min_initial_cargo + level for level in relative_cargo],
+        )
@@ -0,0 +1,132 @@
+import numpy as np
+
+from ._compiled_problem import CompiledProblem
+from ._problem_description import DispatchActivity
+from ._problem_description import RecallActivity
+from ._problem_description import TripActivity
+from ._problem_description import VehicleRoutingProblemSolution
+from ._route_schedule import RouteEvaluator
+
+
+def route_values(compiled: CompiledProblem, routes: list[list[int]],
+                 evaluator: RouteEvaluator) -> dict[str, np.ndarray]:
+    """
+    Values of the tour planning model variables for a set of feasible routes
+    :param compiled: problem the routes are planned for
+    :param routes: waypoint indices visited by each vehicle
+    :param evaluator: evaluator used to schedule the routes
+    :return: variable values by name, NaN where the routes do not determine a value
+    """
+    vehicle_by_waypoint = compiled.num_vehicles, compiled.num_waypoints
+    values = {
+        'x': np.zeros((compiled.num_vehicles, compiled.num_trips)),
+        'x_dispatch': np.zeros(vehicle_by_waypoint),
+        'x_recall': np.zeros(vehicle_by_waypoint),
+        'capacity_u': np.full(vehicle_by_waypoint, np.nan),
+        'time_u': np.full(vehicle_by_waypoint, np.nan),
+        'time_s': np.full(compiled.num_vehicles, np.nan),
+        'time_e': np.full(compiled.num_vehicles, np.nan),
+    }
+
+    for v, route in enumerate(routes):
+        if not route:
+            continue
+
+        schedule = evaluator.schedule(v, route)
+        values['x_dispatch'][v, route[0]] = 1
+        values['x_recall'][v, route[-1]] = 1
+        for i, j in zip(route[:-1], route[1:]):
+            values['x'][v, evaluator.trip(i, j)] = 1
+        values['capacity_u'][v, route] = schedule.cargo_levels
+        values['time_u'][v, route] = schedule.arrival_hours
+        values['time_s'][v] = schedule.start_hour
+        values['time_e'][v] = schedule.end_hour
+
+    return values
+
+
+def solution_from_values(compiled: CompiledProblem, values: dict[str, np.ndarray]):
+    problem = compiled.problem
+    trip_origin = compiled.trip_origin.tolist()
+    trip_target = compiled.trip_target.tolist()
+    waypoint_dwell = compiled.dwell.tolist()
+    cargo_demand = compiled.cargo_demand.tolist()
+
+    capacity_u = values['capacity_u'].tolist()
+    time_u = values['time_u'].tolist()
+    time_s = values['time_s'].tolist()
+    time_e = values['time_e'].tolist()
+
+    # Enabled trips, dispatching and recall edges, found for all vehicles at once. Each
+    # vehicle leaves a waypoint by at most one trip, indexed here by vehicle and origin.
+    trip_vehicle, trip_arc = np.nonzero(values['x'] > 0.5)
+    next_trip = np.full((compiled.num_vehicles, compiled.num_waypoints), -1, dtype=np.int64)
+    next_trip[trip_vehicle, compiled.trip_origin[trip_arc]] = trip_arc
+    next_trip = next_trip.tolist()
+    dispatch_waypoint = dict(zip(*np.nonzero(values['x_dispatch'] > 0.5)))
+    recall_waypoint = dict(zip(*np.nonzero(values['x_recall'] > 0.5)))
+
+    solution = VehicleRoutingProblemSolution(problem=problem)
+
+    # Activities of each vehicle are added in route order
+    for v, j in dispatch_waypoint.items():
+        activity = DispatchActivity(
+            cargo_level=capacity_u[v][j],
+            cargo_to_drop_off=cargo_demand[j],
+            scheduled_start_hour=time_s[v],
+            scheduled_end_hour=time_u[v][j]
+        )
+        solution.add_dispatch(compiled.vehicles[v], compiled.waypoints[j], activity)
+
+        ij = next_trip[v][j]
+        while ij >= 0:
+            i, j = trip_origin[ij], trip_target[ij]
+            activity = TripActivity(
+                cargo_level=capacity_u[v][j],
+                cargo_to_drop_off=cargo_demand[j],
+                scheduled_start_hour=time_u[v][i] + waypoint_dwell[i],
+                scheduled_end_hour=time_u[v][j],
+            )
+            solution.add_trip(compiled.vehicles[v], compiled.trips[ij], activity)
+            next_trip[v][i] = -1
+            ij = next_trip[v][j]
+
+    for v, j in recall_waypoint.items():
+        activity = RecallActivity(
+            cargo_level=capacity_u[v][j] - cargo_demand[j],
+            scheduled_start_hour=time_u[v][j] + waypoint_dwell[j],
+            scheduled_end_hour=time_e[v],
+        )
+        solution.add_recall(compiled.vehicles[v], compiled.waypoints[j], activity)
+
+    return solution
+
+
+def routes_from_solution(compiled: CompiledProblem,
+                         solution: VehicleRoutingProblemSolution) -> list[list[int]]:
+    """
+    Reads the routes of a solution, which may be planned for a subproblem of the compiled one
+    :param compiled: problem whose vehicle and waypoint indices the routes use
+    :param solution: solution to read
+    :return: waypoint indices visited by each vehicle
+    """
+    routes: list[list[int]] = [list() for _ in range(compiled.num_vehicles)]
+    for vehicle in solution.problem.vehicles:
+        dispatch = solution.dispatch_activity(vehicle)
+        if dispatch is None:
+            continue
+
+        route = routes[compiled.vehicle_index[vehicle]]
+        route.append(compiled.waypoint_index[dispatch.params.target])
+        route.extend(
+            compiled.waypoint_index[activity.params.target]
+            for activity in solution.trip_activities(vehicle)
+        )
+    return routes
+
+
+def solution_from_routes(compiled: CompiledProblem, routes: list[list[int]],
+                         evaluator: RouteEvaluator | None = None) -> VehicleRoutingProblemSolution:
+    if evaluator is None:
+        evaluator = RouteEvaluator(compiled)
+    return solution_from_values(compiled, route_values(compiled, routes, evaluator))
@@ -0,0 +1,39 @@
+import numpy as np
+
+from ._compiled_problem import CompiledProblem
+
+
+def find_subtours(compiled: CompiledProblem, selected: np.ndarray) -> list[list[int]]:
+    """
+    Finds closed tours that no vehicle is dispatched into
+    :param compiled: problem whose trips the selection refers to
+    :param selected: boolean array of vehicle by trip index marking the trips in use
+    :return: waypoint indices of each subtour, in visiting order
+    """
+    subtours = list()
+    for vehicle_selected in selected:
+        arcs = np.nonzero(vehicle_selected)[0]
+        successor = dict(zip(
+            compiled.trip_origin[arcs].tolist(),
+            compiled.trip_target[arcs].tolist()
+        ))
+
+        # Each waypoint is entered at most once, so the trips form a path from the dispatch
+        # waypoint plus any number of disjoint cycles.
+        unvisited = set(successor)
+        for start in unvisited - set(successor.values()):
+            waypoint = start
+            while waypoint in unvisited:
+                unvisited.remove(waypoint)
+                waypoint = successor[waypoint]
+
+        while unvisited:
+            waypoint = unvisited.pop()
+            subtour = [waypoint]
+            while successor[waypoint] != subtour[0]:
+                waypoint = successor[waypoint]
+                unvisited.remove(waypoint)
+                subtour.append(waypoint)
+            subtours.append(subtour)
+
+    return subtours
@@ -0,0 +1,85 @@
+import gurobipy as gurobi
+import numpy as np
+import pytest
+
+from gis_backend._compiled_graph import save_compiled_graph
+from gis_backend.query_provider import GraphQueryProvider
+from gis_backend.query_provider import set_default_provider
+from route_engine import CompiledProblem
+from route_engine import DecompositionTourPlanner
+from route_engine import VehicleRoutingProblem
+from route_engine._problem_description import VehicleParams
+from route_engine._problem_description import WaypointParams
+from route_engine._solution_values import routes_from_solution
+
+_grid_size = 5
+_grid_spacing_degrees = 0.002
+_grid_spacing_meters = 222.4
+_speed_meters_per_second = 13.4
+
+
+class _FailingPlanner:
+    def solve(self, problem):
+        raise gurobi.GurobiError(10010, 'Model too large for size-limited license')
+
+
+@pytest.fixture
+def grid_provider(tmp_path):
+    # Square grid of streets with two-way edges between neighboring nodes
+    rows, cols = np.divmod(np.arange(_grid_size * _grid_size), _grid_size)
+    edges = sorted(
+        (a, b)
+        for a in range(len(rows)) for b in range(len(rows))
+        if abs(rows[a] - rows[b]) + abs(cols[a] - cols[b]) == 1
+    )
+    sources, targets = np.array(edges).T
+    offsets = np.zeros(len(rows) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=len(rows)), out=offsets[1:])
+    length = np.full(len(edges), _grid_spacing_meters)
+
+    save_compiled_graph({
+        'node_ids': np.arange(len(rows)) + 1000,
+        'lat': 35.77 + _grid_spacing_degrees * rows,
+        'long': -78.65 + _grid_spacing_degrees * cols,
+        'offsets': offsets,
+        'targets': targets,
+        'length': length,
+        'travel_time': length / _speed_meters_per_second,
+    }, tmp_path / 'compiled_graph')
+
+    provider = GraphQueryProvider(tmp_path)
+    set_default_provider(provider)
+    yield provider
+    set_default_provider(None)
+    provider.release()
+
+
+def _grid_problem() -> VehicleRoutingProblem:
+    problem = VehicleRoutingProblem()
+    for v in range(2):
+        problem.add_vehicle(f'V{v}', VehicleParams(
+            depot='D', earliest_activity_hour=7, latest_activity_hour=17,
+            dispatch_from_gis_node=1000, recall_to_gis_node=1000))
+    for j, node in enumerate([1004, 1009, 1014, 1020, 1021, 1022]):
+        problem.add_waypoint(f'W{j}', WaypointParams(
+            waypoint=f'W{j}', gis_node=node, dwell_hours=0.1))
+    problem.run_trip_planning('travel_time', use_route_cache=False)
+    return problem
+
+
+def test_unsolved_clusters_are_repaired(grid_provider):
+    problem = _grid_problem()
+    planner = DecompositionTourPlanner(
+        _FailingPlanner(), max_cluster_size=3, workers=1, repair_seconds=0.5, seed=0)
+    solution = planner.solve(problem)
+
+    routes = routes_from_solution(CompiledProblem(problem), solution)
+    assert sorted(j for route in routes for j in route) == list(range(6))
+
+
+def test_unsolved_clusters_raise_without_repair(grid_provider):
+    problem = _grid_problem()
+    planner = DecompositionTourPlanner(
+        _FailingPlanner(), max_cluster_size=3, workers=1, repair_seconds=0, seed=0)
+    with pytest.raises(RuntimeError):
+        planner.solve(problem)